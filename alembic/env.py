@@ -9,6 +9,7 @@ from alembic import context
 
 from core.database import Base
 from models.user import User
+from models.document import IngestJob, UserDocument
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -5,13 +5,79 @@ class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env")
 
     ollama_base_url: str = "http://localhost:11434"
+    ollama_base_urls: str = "" # comma separated pool, overrides ollama_base_url
     ollama_model: str = "qwen3:8b"
+    ollama_max_connections: int = 20
+    ollama_connect_timeout: float = 5.0
+    ollama_chat_timeout: float = 120.0
+    ollama_facts_timeout: float = 30.0
+    ollama_retries: int = 2
+    ollama_retry_backoff_seconds: float = 0.5
+    ollama_health_interval_seconds: float = 10.0
+    ollama_hedge_percentile: float = 0.0 # e.g. 95 to hedge requests slower than p95, needs 2+ backends
+    ollama_keep_alive: str = "30m" # how long the model stays loaded after a request, -1 = always
+    ollama_num_ctx: int = 8192 # context window sent with every call, 0 = model default
+    ollama_preload: bool = False # load the model on each backend before the first request
+    prompt_layout: str = "stable" # "stable": documents last so ollama reuses its prompt cache, "legacy": all in the system prompt
+    llm_concurrency: int = 2 # generation slots per backend, match OLLAMA_NUM_PARALLEL
+    llm_queue_timeout_seconds: float = 20.0
     # ollama_embedding_model: str = "nomic-embed-text"
     chroma_path: str = "./chroma_db"
+    chroma_shard_mode: str = "user"
+    chroma_shard_buckets: int = 64
+    lexical_search: bool = True
+    lexical_results: int = 10
+    rrf_k: int = 60
     chunk_size: int = 1000
     chunk_overlap: int = 200
     top_k_results: int = 4
+    context_token_budget: int = 1500 # estimated prompt tokens for document context, 0 = no limit
+    context_compression_tokens: int = 0 # keep only the sentences closest to the question up to this, 0 = off
     max_history: int = 10
+    conversation_summary: bool = True # older turns are folded into a rolling summary
+    summary_raw_turns: int = 2 # latest turns still sent verbatim next to the summary
+    summary_max_tokens: int = 300
+    answer_cache_entries: int = 1000
+    answer_cache_ttl_seconds: float = 3600
+    answer_cache_similarity: float = 0.0 # near-duplicate matching, off unless set (e.g. 0.97)
+    embedding_cache_path: str = "./embedding_cache/embeddings.sqlite3"
+    embedding_cache_memory_entries: int = 20000
+    embedding_cache_disk_entries: int = 1000000
+    embed_max_batch: int = 32
+    embed_batch_size: int = 256
+    embed_onnx_threads: int | None = None
+    embed_parallel: int | None = None
+    embed_bulk_workers: int = 1
+    embed_batch_window_ms: float = 5.0
+    reranker_backend: str = "onnx"
+    reranker_model: str = "BAAI/bge-reranker-base"
+    reranker_quantize: bool = False
+    reranker_threads: int | None = None
+    reranker_cache_dir: str = "./reranker_models"
+    reranker_first_stage_model: str = ""
+    rerank_cascade_keep: int = 8
+    rerank_min_candidates: int = 8
+    rerank_max_candidates: int = 20
+    rerank_distance_margin: float = 0.35
+    rerank_skip_gap: float = 0.15
+    rerank_max_requests: int = 16
+    rerank_batch_window_ms: float = 10.0
+    rerank_batch_size: int = 64
+    vector_compression: str = "none"
+    vector_truncate_dims: int = 0
+    vector_rescore_factor: int = 4
+    pdf_workers: int = 4
+    pdf_parallel_min_pages: int = 20
+    pdf_range_pages: int = 25
+    ingest_batch_size: int = 64
+    ingest_queue_batches: int = 2
+    upload_dir: str = "./uploads"
+    max_upload_mb: int = 200
+    worker_concurrency: int = 2
+    job_max_attempts: int = 3
+    job_retry_backoff_seconds: int = 30
+    job_poll_interval: float = 1.0
+    job_stale_after_minutes: int = 30
 
     database_url: str
     jwt_secret: str
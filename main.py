@@ -6,24 +6,49 @@ if __name__ == "__main__":
     main()
 
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI,Request
+from fastapi.responses import JSONResponse
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from core.limiter import limiter
 from core.security import decode_token
 from routes.routes import router
 from routes.auth import router as auth_router
+from services.llm_scheduler import SchedulerBusy
+from services.ollama_client import open_ollama_client, close_ollama_client
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    #one pooled ollama client for the life of the process
+    await open_ollama_client()
+    yield
+    await close_ollama_client()
 
 
 app = FastAPI(
     title="RAG Document Assistant",
     swagger_ui_init_oauth={
     "usePkceWithAuthorizationCodeGrant": True
-    }
+    },
+    lifespan=lifespan
 )
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+
+async def _llm_busy_handler(request: Request, exc: SchedulerBusy):
+    #shed load fast instead of letting the request sit until the ollama timeout
+    return JSONResponse(
+        status_code=503,
+        content={"detail":"The model is busy, please retry shortly"},
+        headers={"Retry-After":str(exc.retry_after)}
+    )
+
+
+app.add_exception_handler(SchedulerBusy, _llm_busy_handler)
+
 @app.middleware("http")
 async def set_user_id_middleware(request:Request, call_next):
     token = request.headers.get("Authorization","").replace("Bearer ", "")
@@ -0,0 +1,34 @@
+from sqlalchemy import Column, String, DateTime, Integer, BigInteger, ForeignKey, Text, UniqueConstraint
+from sqlalchemy.sql import func
+from core.database import Base
+
+
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+
+    id = Column(String, primary_key=True, index=True) # uuid, doubles as the upload task_id
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    filename = Column(String, nullable=False)
+    file_path = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued", index=True) # queued, running, done, failed
+    progress = Column(Text, nullable=False, default="") # newline separated progress messages
+    error = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    run_after = Column(DateTime(timezone=True),server_default=func.now())
+    created_at = Column(DateTime(timezone=True),server_default=func.now())
+    updated_at = Column(DateTime(timezone=True),server_default=func.now(),onupdate=func.now())
+
+
+class UserDocument(Base):
+    __tablename__ = "user_documents"
+    __table_args__ = (UniqueConstraint("user_id", "filename", name="uq_user_documents_user_filename"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    filename = Column(String, nullable=False)
+    chunk_count = Column(Integer, nullable=False, default=0)
+    page_count = Column(Integer, nullable=False, default=0)
+    size_bytes = Column(BigInteger, nullable=False, default=0)
+    file_hash = Column(String, nullable=True)
+    ingested_at = Column(DateTime(timezone=True),server_default=func.now(),onupdate=func.now())
@@ -15,6 +15,7 @@ class User(Base):
     refresh_tokens = relationship("RefreshToken",back_populates="user")
     conversations = relationship("Conversation",back_populates="user")
     memories = relationship("UserMemory",back_populates="user")
+    conversation_summary = relationship("ConversationSummary",back_populates="user",uselist=False)
 
 
 class RefreshToken(Base):
@@ -51,3 +52,15 @@ class UserMemory(Base):
 
     user = relationship("User",back_populates="memories")
 
+
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True, index=True)
+    summary = Column(String, nullable=False, default="")
+    #newest Conversation folded into the summary, later ones are still sent raw
+    last_conversation_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True),server_default=func.now(),onupdate=func.now())
+
+    user = relationship("User",back_populates="conversation_summary")
@@ -4,18 +4,30 @@ from core.security import get_current_user
 from models.user import User,Conversation,UserMemory
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from core.database import get_db
-from services.chroma_service import store_chunks, query, clear, has_documents, collection
-from services.reranker_service import rerank
-from services.pdf_service import extract_content_by_page,chunk_text
-from services.ollama_service import get_embeddings_batch,get_embedding,ask,extract_facts
+from core.database import get_db, AsyncSessionLocal
+from services.chroma_service import store_chunks, query, clear, has_documents, delete_document as delete_stored_document
+from services.reranker_service import rerank_batcher_stats
+from services.retrieval_policy import retrieve, retrieval_policy_stats
+from services.answer_cache import get_answer_cache, context_key
+from services import catalog_service
+from services.job_service import enqueue_job, get_job, spool_upload, remove_spooled, UploadTooLarge
+from services.ollama_service import get_embeddings_batch,get_embedding,ask,ask_stream,extract_facts,get_embedding_cache,query_batcher_stats,bulk_embedding_stats,llm_scheduler_stats
+from services.llm_scheduler import SchedulerBusy
+from services.ollama_client import ollama_client_stats
+from services.context_packer import context_packing_stats
+from services.context_compressor import compress_context, context_compression_stats
+from services.summary_service import load_history, schedule_summary_update
 from services.chroma_service import store_chunks,query,clear,has_documents
 from core.config import settings
 from core.limiter import limiter
 import asyncio
+import json
+import logging
+import httpx
 from sse_starlette.sse import EventSourceResponse
-from services.progress_service import create_task, update_progress,stream_progress
-import uuid
+from services.progress_service import stream_progress
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
@@ -33,91 +45,67 @@ async def upload(
     request: Request,
     file: UploadFile=File(...),
     current_user: User = Depends(get_current_user),
-    background_tasks: BackgroundTasks = None
+    db: AsyncSession = Depends(get_db)
     ):
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400,detail="Only PDF files are accepted")
 
-    file_bytes=await file.read()
+    try:
+        file_path, size = await spool_upload(file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
-    if not file_bytes:
+    if not size:
+        remove_spooled(file_path)
         raise HTTPException(status_code=400, detail="Uploaded file is empty")
-    
-    task_id = str(uuid.uuid4())
-    create_task(task_id)
-    
-    asyncio.create_task(
-        process_upload(file_bytes,file.filename, current_user.id, task_id)
-    )
-    return {"task_id":task_id,"message":"Upload started"}
 
-async def process_upload(file_bytes: bytes, filename: str, user_id: int, task_id: str):
-    await asyncio.sleep(10)
-    try:
-        update_progress(task_id, "Extracting text from PDF...")
-        pages = extract_content_by_page(file_bytes)
-        if not pages:
-            update_progress(task_id, "error:Could not extract content")
-            update_progress(task_id,"done")
-            return
-        
-        update_progress(task_id, "Chunking text...")
-        chunks = chunk_text(pages, settings.chunk_size, settings.chunk_overlap)
-
-        update_progress(task_id, f"Generating embeddings for {len(chunks)} chunks...")
-        texts = [chunk["text"]for chunk in chunks]
-        embeddings = await get_embeddings_batch(texts)
-
-        update_progress(task_id, f"Storing in vector database...")
-        stored = await asyncio.to_thread(store_chunks, chunks, embeddings, filename, user_id)
-
-        update_progress(task_id,f"Done! {stored} chunk stored")
-        update_progress(task_id, "done")
-
-    except Exception as e:
-        update_progress(task_id, f"error: {str(e)}")
-        update_progress(task_id, "done")
+    #only enqueue, the ingest worker (worker.py) does the processing
+    job = await enqueue_job(db, current_user.id, file.filename, file_path)
+    return {"task_id":job.id,"message":"Upload queued"}
+
 
 @router.get("/upload-progress/{task_id}")
 async def upload_progress(
     task_id:str,
     request: Request,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
+    if not await get_job(db, task_id, current_user.id):
+        raise HTTPException(status_code=404, detail="Upload not found")
     return EventSourceResponse(stream_progress(task_id))
 
 
 
 
-@router.post("/ask",response_model=AskResponse)
-@limiter.limit("20/minute")
-async def ask_question(
-    request: Request,
-    request_body: AskRequest,
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
-    ):
-    if not request_body.question.strip():
+async def _load_ask_context(db: AsyncSession, user_id: int, question: str) -> tuple[int, str, list, str]:
+    #shared by /ask and /ask/stream: (corpus chunks, corpus version, history, memory context)
+    if not question.strip():
         raise HTTPException(status_code=400, detail = "Question cannot be empty")
-    if not await asyncio.to_thread(has_documents,current_user.id):
+    corpus_chunks, corpus_version = await catalog_service.corpus_state(db, user_id)
+    if not corpus_chunks:
         raise HTTPException(status_code=404, detail="No document uploaded yet")
 
-    result = await db.execute(
-        select(Conversation)
-        .where(Conversation.user_id==current_user.id)
-        .order_by(Conversation.created_at.desc())
-        .limit(10)
-    )
-    past = result.scalars().all()
+    if settings.conversation_summary:
+        #a rolling summary plus the turns not folded into it yet
+        history = await load_history(db, user_id)
+    else:
+        result = await db.execute(
+            select(Conversation)
+            .where(Conversation.user_id==user_id)
+            .order_by(Conversation.created_at.desc())
+            .limit(10)
+        )
+        past = result.scalars().all()
 
-    history = []
-    for conv in reversed(past):
-        history.append({"role":"user","content":conv.question})
-        history.append({"role":"assistant","content":conv.answer})
+        history = []
+        for conv in reversed(past):
+            history.append({"role":"user","content":conv.question})
+            history.append({"role":"assistant","content":conv.answer})
 
     mm_result = await db.execute(
         select(UserMemory)
-        .where(UserMemory.user_id==current_user.id)
+        .where(UserMemory.user_id==user_id)
         .order_by(UserMemory.created_at.desc())
         .limit(20)
         )
@@ -126,11 +114,55 @@ async def ask_question(
     if memories:
         facts = "\n".join(f"- {m.fact}" for m in memories)
         memory_context = f"\n\nPersonal facts about the user: \n{facts}"
+    return corpus_chunks, corpus_version, history, memory_context
+
+
+def _sources(chunks: list[dict]) -> list[dict]:
+    return [
+        {
+            "text":chunk["text"],
+            "page":chunk["page_number"],
+            "filename":chunk["filename"]
 
+        }for chunk in chunks
+
+    ]
+
+
+@router.post("/ask",response_model=AskResponse)
+@limiter.limit("20/minute")
+async def ask_question(
+    request: Request,
+    request_body: AskRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+    ):
+    corpus_chunks, corpus_version, history, memory_context = await _load_ask_context(
+        db, current_user.id, request_body.question
+    )
     question_embedding = await get_embedding(request_body.question)
-    chunks = await asyncio.to_thread(query,question_embedding, current_user.id, n_results=10) 
-    chunks = rerank(request_body.question, chunks, top_k=4)  # rerank down to 4
-    answer = await ask(request_body.question,chunks,history,memory_context)
+
+    async def generate():
+        #candidate depth and whether to rerank at all are decided per request
+        chunks = await retrieve(
+            request_body.question, question_embedding, current_user.id, corpus_chunks, top_k=settings.top_k_results
+        )
+        #the prompt may get a compressed copy, sources keep the full chunks
+        prompt_chunks = await compress_context(question_embedding, chunks, settings.context_compression_tokens)
+        answer = await ask(request_body.question,prompt_chunks,history,memory_context)
+        return answer, chunks
+
+    #the same question against an unchanged corpus reuses the answer, concurrent ones share
+    #a generation. only the stable personal facts are part of the key: history and the
+    #rolling summary change after every answer and would make every repeat a miss
+    answer, chunks = await get_answer_cache().get_or_compute(
+        current_user.id,
+        corpus_version,
+        context_key(memory_context),
+        request_body.question,
+        question_embedding,
+        generate
+    )
 
     db.add(Conversation(
         user_id=current_user.id,
@@ -143,55 +175,113 @@ async def ask_question(
     #     db.add(UserMemory(user_id=current_user.id,fact=fact))
 
     await db.commit()
+    schedule_summary_update(current_user.id)
 
-    sources=[
-        {
-            "text":chunk["text"],
-            "page":chunk["page_number"],
-            "filename":chunk["filename"]
+    return AskResponse(answer=answer,sources=_sources(chunks))
 
-        }for chunk in chunks
 
-    ]
-    return AskResponse(answer=answer,sources=sources)
+@router.post("/ask/stream")
+@limiter.limit("20/minute")
+async def ask_question_stream(
+    request: Request,
+    request_body: AskRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+    ):
+    #validation errors are raised here, before the event stream starts
+    corpus_chunks, corpus_version, history, memory_context = await _load_ask_context(
+        db, current_user.id, request_body.question
+    )
+    question_embedding = await get_embedding(request_body.question)
+    user_id = current_user.id
+    question = request_body.question
+    cache_key = (user_id, corpus_version, context_key(memory_context), question, question_embedding)
+
+    async def events():
+        cached = get_answer_cache().lookup(*cache_key)
+        if cached is not None:
+            answer, chunks = cached
+            yield {"event":"sources", "data":json.dumps(_sources(chunks))}
+            yield {"event":"token", "data":answer}
+        else:
+            chunks = await retrieve(question, question_embedding, user_id, corpus_chunks, top_k=settings.top_k_results)
+            #sources go out before generation starts
+            yield {"event":"sources", "data":json.dumps(_sources(chunks))}
+            prompt_chunks = await compress_context(question_embedding, chunks, settings.context_compression_tokens)
+            tokens = []
+            try:
+                async for token in ask_stream(question, prompt_chunks, history, memory_context):
+                    tokens.append(token)
+                    yield {"event":"token", "data":token}
+            except SchedulerBusy as e:
+                #headers are already sent, the 503 of /ask becomes an error event
+                yield {"event":"error", "data":f"The model is busy, please retry in {e.retry_after}s"}
+                return
+            except httpx.HTTPError:
+                logger.exception("streaming answer failed for user %s", user_id)
+                yield {"event":"error", "data":"The model did not finish answering, please retry"}
+                return
+            answer = "".join(tokens) or "I could not generate an answer."
+            get_answer_cache().store(*cache_key, (answer, chunks))
+
+        #the request's session is already closed once streaming starts
+        async with AsyncSessionLocal() as session:
+            session.add(Conversation(user_id=user_id, question=question, answer=answer))
+            await session.commit()
+        schedule_summary_update(user_id)
+        yield {"event":"done", "data":""}
+
+    return EventSourceResponse(events())
 
 
 @router.get("/documents")
 @limiter.limit("5/hour")
-async def list_documents(request:Request,current_user: User = Depends(get_current_user)):
-    results = await asyncio.to_thread(collection.get,where={"user_id":current_user.id})
-    if not results["ids"]:
-        return {"documents":[]}
-
-    filenames = list(set(m["filename"] for m in results["metadatas"]))
-    return {"documents":filenames}
+async def list_documents(
+    request:Request,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    documents = await catalog_service.list_documents(db, current_user.id)
+    return {"documents":[document.filename for document in documents]}
 
 
 @router.delete("/documents/{filename}")
 async def delete_document(
     filename:str,
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    results = await asyncio.to_thread(collection.get,where={
-        "$and":[
-            {"user_id":current_user.id},
-            {"filename":filename}
-        ]
-    }
-    )
-    if not results["ids"]:
+    deleted = await asyncio.to_thread(delete_stored_document,current_user.id,filename)
+    await catalog_service.remove_document(db, current_user.id, filename)
+    if not deleted:
         raise HTTPException(status_code=404,detail="Document not found")
-    
-    await asyncio.to_thread(collection.delete,ids=results["ids"])
+
     return {"message": f"{filename} deleted successfully"}
 
 @router.delete("/clear")
-async def clear_documents(current_user: User =  Depends(get_current_user)):
+async def clear_documents(current_user: User =  Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     await asyncio.to_thread(clear,current_user.id)
+    await catalog_service.clear_documents(db, current_user.id)
     return {"message":"Vector store cleared successfully"}
 
 
 
 @router.get("/health")
 async def health():
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
+
+
+@router.get("/metrics")
+async def metrics():
+    return {
+        "embedding_cache":await asyncio.to_thread(get_embedding_cache().stats),
+        "query_embedding_batches":query_batcher_stats(),
+        "bulk_embedding":bulk_embedding_stats(),
+        "rerank_batches":rerank_batcher_stats(),
+        "rerank_policy":retrieval_policy_stats(),
+        "answer_cache":get_answer_cache().stats(),
+        "llm_scheduler":llm_scheduler_stats(),
+        "ollama":ollama_client_stats(),
+        "context_packing":context_packing_stats(),
+        "context_compression":context_compression_stats()
+    }
\ No newline at end of file
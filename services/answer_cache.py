@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+import numpy as np
+from core.config import settings
+
+
+#terms with a digit in them: part numbers, clause ids, values with units
+_IDENTIFIER = re.compile(r"[\w.\-/]*\d[\w.\-/]*")
+
+_answer_cache = None
+
+
+#caches finished answers. an answer is only ever reused within the same scope: the user,
+#the corpus version and a context key (the user's personal facts, not the conversation).
+#inside a scope a question hits on its normalized text, or, when ANSWER_CACHE_SIMILARITY
+#is set, on a near-duplicate embedding that also names exactly the same identifiers.
+#concurrent misses for the same question share one generation instead of each calling ollama
+class AnswerCache:
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        #(scope, question) -> (expires_at, embedding, identifiers, value), in lru order
+        self._entries: OrderedDict[tuple, tuple[float, np.ndarray, frozenset, Any]] = OrderedDict()
+        #scope -> its keys, so near-duplicate lookups never look at other users' entries
+        self._by_scope: dict[tuple, set[tuple]] = {}
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self._counts = {"hits":0, "near_hits":0, "misses":0, "coalesced":0}
+
+    async def get_or_compute(
+            self,
+            user_id: int,
+            corpus_version: str,
+            context_key: str,
+            question: str,
+            embedding: list[float],
+            compute: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        scope = (user_id, corpus_version, context_key)
+        key = (scope, normalize_question(question))
+        vector = _unit(embedding)
+        identifiers = question_identifiers(question)
+        cached = self._lookup(key, vector, identifiers)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self._counts["coalesced"] += 1
+        else:
+            self._counts["misses"] += 1
+            #a task, so the generation survives the first caller disconnecting
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, vector, identifiers, done))
+        return await asyncio.shield(task)
+
+    def lookup(self, user_id: int, corpus_version: str, context_key: str, question: str, embedding: list[float]) -> Any:
+        #for callers that produce the answer themselves (streaming), paired with store()
+        key = ((user_id, corpus_version, context_key), normalize_question(question))
+        cached = self._lookup(key, _unit(embedding), question_identifiers(question))
+        if cached is None:
+            self._counts["misses"] += 1
+        return cached
+
+    def store(self, user_id: int, corpus_version: str, context_key: str, question: str, embedding: list[float], value: Any):
+        key = ((user_id, corpus_version, context_key), normalize_question(question))
+        self._store(key, _unit(embedding), question_identifiers(question), value)
+
+    def stats(self) -> dict:
+        lookups = self._counts["hits"] + self._counts["near_hits"] + self._counts["misses"]
+        return {
+            **self._counts,
+            "hit_rate":(self._counts["hits"] + self._counts["near_hits"]) / lookups if lookups else 0.0,
+            "size":len(self._entries),
+            "inflight":len(self._inflight)
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self._by_scope.clear()
+
+    def _lookup(self, key: tuple, vector: np.ndarray, identifiers: frozenset) -> Any:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            self._entries.move_to_end(key)
+            self._counts["hits"] += 1
+            return entry[3]
+
+        if self.similarity <= 0:
+            return None
+        best_key, best_score = None, self.similarity
+        for other_key in self._by_scope.get(key[0], ()):
+            expires_at, other_vector, other_identifiers, _ = self._entries[other_key]
+            #"PV-204" and "PV-205" embed almost the same, they are still different questions
+            if expires_at <= now or other_identifiers != identifiers:
+                continue
+            score = float(other_vector @ vector)
+            if score >= best_score:
+                best_key, best_score = other_key, score
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        self._counts["near_hits"] += 1
+        return self._entries[best_key][3]
+
+    def _finish(self, key: tuple, vector: np.ndarray, identifiers: frozenset, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        #failures aren't cached, the next ask retries
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._store(key, vector, identifiers, task.result())
+
+    def _store(self, key: tuple, vector: np.ndarray, identifiers: frozenset, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, vector, identifiers, value)
+        self._entries.move_to_end(key)
+        self._by_scope.setdefault(key[0], set()).add(key)
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self._entries.items() if entry[0] <= now]:
+            self._drop(key)
+        while len(self._entries) > self.max_entries:
+            #least recently used first
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: tuple):
+        del self._entries[key]
+        keys = self._by_scope.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_scope[key[0]]
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
+def question_identifiers(question: str) -> frozenset:
+    return frozenset(term.rstrip(".").lower() for term in _IDENTIFIER.findall(question))
+
+
+def context_key(*parts: Any) -> str:
+    #digest of the stable prompt inputs besides the question and the documents
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+
+def _unit(embedding: list[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def get_answer_cache() -> AnswerCache:
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = AnswerCache(
+            settings.answer_cache_entries,
+            settings.answer_cache_ttl_seconds,
+            settings.answer_cache_similarity
+        )
+    return _answer_cache
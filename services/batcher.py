@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Any, Callable
+
+
+#coalesces concurrent single-item requests into one call of a batch handler.
+#a batch is flushed when it reaches max_batch_size or max_wait_ms after its first item,
+#and the (blocking) handler runs in an executor so the event loop stays free
+class MicroBatcher:
+    def __init__(
+            self,
+            handler: Callable[[list], list],
+            max_batch_size: int,
+            max_wait_ms: float,
+            executor: Executor | None = None
+    ):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self._loop = None
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._timer = None
+        self._running: set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            #futures are bound to a loop, start fresh if we're called from a new one
+            self._loop = loop
+            self._pending = []
+            self._timer = None
+
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "batches":self.batches,
+            "items":self.items,
+            "avg_batch_size":self.items / self.batches if self.batches else 0.0
+        }
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = self._loop.create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]):
+        self.batches += 1
+        self.items += len(batch)
+        items = [item for item, _ in batch]
+        try:
+            results = await self._loop.run_in_executor(self.executor, self.handler, items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            #a caller that was cancelled while waiting just doesn't get its result
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import logging
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from core.database import AsyncSessionLocal
+from models.document import UserDocument
+from services.chroma_service import scan_document_stats
+
+logger = logging.getLogger(__name__)
+
+
+#per-user document list kept in postgres, so existence checks and listings
+#are one indexed query instead of pulling every chunk id out of chroma
+
+
+async def list_documents(db: AsyncSession, user_id: int) -> list[UserDocument]:
+    result = await db.execute(
+        select(UserDocument)
+        .where(UserDocument.user_id==user_id)
+        .order_by(UserDocument.filename)
+    )
+    return result.scalars().all()
+
+
+async def corpus_state(db: AsyncSession, user_id: int) -> tuple[int, str]:
+    #(chunk count, version). the version changes whenever a document is added,
+    #re-ingested or removed, so anything cached against it goes stale with the corpus
+    documents = await list_documents(db, user_id)
+    signature = "\n".join(
+        f"{d.filename}\0{d.file_hash}\0{d.chunk_count}\0{d.ingested_at}" for d in documents
+    )
+    version = hashlib.sha256(signature.encode()).hexdigest()[:16]
+    return sum(d.chunk_count for d in documents), version
+
+
+async def record_document(
+        user_id: int,
+        filename: str,
+        chunk_count: int,
+        page_count: int,
+        size_bytes: int,
+        file_hash: str | None
+):
+    #called from the ingest worker, which has no request session
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(UserDocument).where(UserDocument.user_id==user_id, UserDocument.filename==filename)
+        )
+        document = result.scalar_one_or_none()
+        if document is None:
+            document = UserDocument(user_id=user_id, filename=filename)
+            db.add(document)
+        document.chunk_count = chunk_count
+        document.page_count = page_count
+        document.size_bytes = size_bytes
+        document.file_hash = file_hash
+        await db.commit()
+
+
+async def is_recorded(user_id: int, filename: str, file_hash: str) -> bool:
+    #the worker records a document only once every chunk is stored, so a row with
+    #this hash means an earlier ingest of the same bytes ran to completion
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(UserDocument.id).where(
+                UserDocument.user_id==user_id,
+                UserDocument.filename==filename,
+                UserDocument.file_hash==file_hash
+            )
+        )
+        return result.scalar_one_or_none() is not None
+
+
+async def remove_document(db: AsyncSession, user_id: int, filename: str):
+    await db.execute(
+        delete(UserDocument).where(UserDocument.user_id==user_id, UserDocument.filename==filename)
+    )
+    await db.commit()
+
+
+async def clear_documents(db: AsyncSession, user_id: int):
+    await db.execute(delete(UserDocument).where(UserDocument.user_id==user_id))
+    await db.commit()
+
+
+async def backfill_catalog() -> int:
+    #one-off for stores ingested before the catalog existed: only runs while it is empty
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(UserDocument.id).limit(1))
+        if result.scalars().first() is not None:
+            return 0
+
+        documents = await asyncio.to_thread(scan_document_stats)
+        for (user_id, filename), stats in documents.items():
+            db.add(UserDocument(
+                user_id=user_id,
+                filename=filename,
+                chunk_count=stats["chunks"],
+                page_count=len(stats["pages"]),
+                size_bytes=0, # not recorded in chroma
+                file_hash=stats["file_hash"]
+            ))
+        await db.commit()
+
+    if documents:
+        logger.info("catalog backfilled with %s documents from chroma", len(documents))
+    return len(documents)
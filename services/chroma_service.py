@@ -1,53 +1,453 @@
+import threading
 import chromadb
+import numpy as np
 from core.config import settings
+from services import compact_index
+from services.lexical_service import (
+    get_lexical_index,
+    reciprocal_rank_fusion,
+    mark_lexical_index_built,
+    remove_legacy_index
+)
 
 client = chromadb.PersistentClient(path=settings.chroma_path)
-collection = client.get_or_create_collection(name="documents")
+
+#the original single collection; CHROMA_SHARD_MODE=none keeps using it for everyone
+LEGACY_COLLECTION = "documents"
+
+_collections = {}
+_collections_lock = threading.Lock()
+
+
+def shard_name(user_id: int) -> str:
+    #"user": one collection per user, "bucket": users hashed into CHROMA_SHARD_BUCKETS collections
+    mode = settings.chroma_shard_mode
+    if mode == "none":
+        return LEGACY_COLLECTION
+    if mode == "user":
+        return f"{LEGACY_COLLECTION}_u{user_id}"
+    if mode == "bucket":
+        return f"{LEGACY_COLLECTION}_b{user_id % settings.chroma_shard_buckets}"
+    raise ValueError(f"Unknown chroma shard mode: {mode}")
+
+
+def get_collection(user_id: int):
+    #created on first use, so a user who never uploads never gets a collection
+    name = shard_name(user_id)
+    with _collections_lock:
+        if name not in _collections:
+            _collections[name] = client.get_or_create_collection(name=name)
+        return _collections[name]
+
+
+def _lexical_index(user_id: int):
+    #keyword index of the same shard as the user's chunks
+    return get_lexical_index(shard_name(user_id))
+
+
+def _user_filter(user_id: int) -> dict | None:
+    #a per-user shard holds nobody else's chunks, its searches need no filter
+    return None if settings.chroma_shard_mode == "user" else {"user_id":user_id}
 
 def store_chunks(chunks:list[dict],embeddings: list[list[float]], filename:str, user_id: int)->int:
     ids = [f"{user_id}_{filename}_{chunk['chunk_index']}_page{chunk['page_number']}"for chunk in chunks]
     documents = [chunk["text"] for chunk in chunks]
-    metadatas = [
-        {
-            "filename":filename,
-            "page_number":chunk["page_number"],
-            "chunk_index":chunk["chunk_index"],
-            "user_id":user_id
-        }
-        for chunk in chunks
+    metadatas = [_chunk_metadata(chunk, filename, user_id) for chunk in chunks]
+    #reused embeddings come back from chroma as arrays, fresh ones are lists; chroma rejects a mix
+    embeddings = [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+    _add_in_slices(get_collection(user_id), ids, documents, metadatas, embeddings)
+    if compact_index.compact_enabled():
+        compact_index.get_index(user_id).add(ids, embeddings)
+    if settings.lexical_search:
+        _lexical_index(user_id).add(user_id, filename, ids, chunks)
+    return len(chunks)
+
+
+def _chunk_metadata(chunk: dict, filename: str, user_id: int) -> dict:
+    metadata = {
+        "filename":filename,
+        "page_number":chunk["page_number"],
+        "chunk_index":chunk["chunk_index"],
+        "user_id":user_id
+    }
+    #content hashes are optional, chroma doesn't accept None values
+    for key in ("file_hash", "page_hash"):
+        if chunk.get(key):
+            metadata[key] = chunk[key]
+    return metadata
+
+
+def _add_in_slices(collection, ids: list[str], documents: list[str], metadatas: list[dict], embeddings: list) -> None:
+    #a single add over chroma's max batch size is rejected, so write in slices
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        collection.add(
+            ids=ids[start:end],
+            documents=documents[start:end],
+            metadatas=metadatas[start:end],
+            embeddings=embeddings[start:end]
+        )
+
+
+def find_document_by_hash(user_id: int, file_hash: str) -> str | None:
+    results = get_collection(user_id).get(
+        where={"$and":[{"user_id":user_id},{"file_hash":file_hash}]},
+        limit=1,
+        include=["metadatas"]
+    )
+    if not results["ids"]:
+        return None
+    return results["metadatas"][0]["filename"]
+
+
+def copy_document(user_id: int, source_filename: str, filename: str, file_hash: str) -> int:
+    #reuses stored text and embeddings, paged so a big document isn't loaded at once
+    copied = 0
+    page_size = client.get_max_batch_size()
+    while True:
+        results = get_collection(user_id).get(
+            where={"$and":[{"user_id":user_id},{"filename":source_filename}]},
+            include=["documents","metadatas","embeddings"],
+            limit=page_size,
+            offset=copied
+        )
+        if not results["ids"]:
+            return copied
+
+        chunks = [
+            {**metadata, "text":document, "file_hash":file_hash}
+            for document, metadata in zip(results["documents"], results["metadatas"])
+        ]
+        copied += store_chunks(chunks, list(results["embeddings"]), filename, user_id)
+
+
+def set_file_hash(user_id: int, filename: str, file_hash: str) -> int:
+    #chunks of pages a re-upload left unchanged still carry the previous revision's hash,
+    #which would make copy_document and delete_file_chunks pick them up for the wrong bytes
+    collection = get_collection(user_id)
+    results = collection.get(
+        where={"$and":[{"user_id":user_id},{"filename":filename}]},
+        include=["metadatas"]
+    )
+    stale = [
+        (chunk_id, {**metadata, "file_hash":file_hash})
+        for chunk_id, metadata in zip(results["ids"], results["metadatas"])
+        if metadata.get("file_hash") != file_hash
     ]
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(stale), batch_size):
+        batch = stale[start:start + batch_size]
+        collection.update(ids=[chunk_id for chunk_id, _ in batch], metadatas=[metadata for _, metadata in batch])
+    return len(stale)
 
-    collection.add(
-        ids=ids,
-        documents=documents,
-        metadatas=metadatas,
-        embeddings=embeddings
+
+def get_page_embeddings(user_id: int, page_hashes: list[str]) -> dict[tuple[str, int], list[float]]:
+    #stored embeddings keyed by (page_hash, chunk_index) for pages we've already embedded
+    if not page_hashes:
+        return {}
+    results = get_collection(user_id).get(
+        where={"$and":[{"user_id":user_id},{"page_hash":{"$in":list(set(page_hashes))}}]},
+        include=["metadatas","embeddings"]
     )
+    found = {}
+    for metadata, embedding in zip(results["metadatas"], results["embeddings"]):
+        found.setdefault((metadata["page_hash"], metadata["chunk_index"]), embedding)
+    return found
 
-    return len(chunks)
+def get_stored_pages(user_id: int, filename: str) -> dict[int, str]:
+    #page_number -> page_hash of the stored revision ("" for chunks stored before hashing)
+    results = get_collection(user_id).get(
+        where={"$and":[{"user_id":user_id},{"filename":filename}]},
+        include=["metadatas"]
+    )
+    return {m["page_number"]: m.get("page_hash", "") for m in results["metadatas"]}
+
+
+def delete_pages(user_id: int, filename: str, page_numbers: set[int]) -> dict[tuple[str, int], list[float]]:
+    return _delete_returning_embeddings(user_id, [
+        {"user_id":user_id},
+        {"filename":filename},
+        {"page_number":{"$in":list(page_numbers)}}
+    ])
+
+
+def delete_file_chunks(user_id: int, filename: str, file_hash: str) -> dict[tuple[str, int], list[float]]:
+    #the chunks one upload of these bytes stored under this name
+    return _delete_returning_embeddings(user_id, [
+        {"user_id":user_id},
+        {"filename":filename},
+        {"file_hash":file_hash}
+    ])
+
+
+def _delete_returning_embeddings(user_id: int, conditions: list[dict]) -> dict[tuple[str, int], list[float]]:
+    #returns the deleted chunks' embeddings so the caller can still reuse them
+    results = get_collection(user_id).get(
+        where={"$and":conditions},
+        include=["metadatas","embeddings"]
+    )
+    _delete_ids(user_id, results["ids"])
+    return {
+        (metadata["page_hash"], metadata["chunk_index"]): embedding
+        for metadata, embedding in zip(results["metadatas"], results["embeddings"])
+        if metadata.get("page_hash")
+    }
+
+
+def query(embedding: list[float],user_id: int, n_results: int = 4, question: str | None = None) -> list[dict]:
+    chunks = _query_vectors(embedding, user_id, n_results)
+    if not (settings.lexical_search and question):
+        return chunks
+    return _fuse_lexical(chunks, question, embedding, user_id, n_results)
+
+
+def _query_vectors(embedding: list[float], user_id: int, n_results: int) -> list[dict]:
+    if compact_index.compact_enabled():
+        chunks = _query_compact(embedding, user_id, n_results)
+        #an empty index before the worker's backfill ran still gets answers from chroma
+        if chunks:
+            return chunks
 
-def query(embedding: list[float],user_id: int, n_results: int = 4) -> list[dict]:    
-    results = collection.query(
+    results = get_collection(user_id).query(
         query_embeddings=[embedding],
         n_results=n_results,
-        where={"user_id":user_id} # filter by user id
+        where=_user_filter(user_id) # filter by user id on shared collections
     )
     chunks = []
 
     for i,doc in enumerate(results["documents"][0]):
         chunks.append({
+            "id":results["ids"][0][i],
             "text":doc,
             "page_number":results["metadatas"][0][i]["page_number"],
+            "chunk_index":results["metadatas"][0][i].get("chunk_index"),
             "filename":results["metadatas"][0][i]["filename"],
+            "distance":results["distances"][0][i],
         })
 
     return chunks
 
+
+def _query_compact(embedding: list[float], user_id: int, n_results: int) -> list[dict]:
+    #candidates from the compact codes, rescored on full vectors; chroma only serves the text
+    ranked = compact_index.get_index(user_id).search(embedding, n_results, settings.vector_rescore_factor)
+    if not ranked:
+        return []
+    results = get_collection(user_id).get(ids=[chunk_id for chunk_id, _ in ranked], include=["documents","metadatas"])
+    stored = dict(zip(results["ids"], zip(results["documents"], results["metadatas"])))
+
+    chunks = []
+    for chunk_id, score in ranked:
+        if chunk_id not in stored:
+            continue
+        doc, metadata = stored[chunk_id]
+        chunks.append({
+            "id":chunk_id,
+            "text":doc,
+            "page_number":metadata["page_number"],
+            "chunk_index":metadata.get("chunk_index"),
+            "filename":metadata["filename"],
+            #squared l2 on unit vectors, the same scale chroma's default space reports
+            "distance":2 - 2 * score,
+        })
+    return chunks
+
+
+def _fuse_lexical(chunks: list[dict], question: str, embedding: list[float], user_id: int, n_results: int) -> list[dict]:
+    #part numbers and clause ids the embedding misses still surface through bm25
+    lexical_ids = _lexical_index(user_id).search(question, user_id, settings.lexical_results)
+    if not lexical_ids:
+        return chunks
+    fused_ids = reciprocal_rank_fusion([[chunk["id"] for chunk in chunks], lexical_ids], settings.rrf_k)[:n_results]
+
+    by_id = {chunk["id"]: chunk for chunk in chunks}
+    missing = [chunk_id for chunk_id in fused_ids if chunk_id not in by_id]
+    if missing:
+        #keyword-only hits get their real distance, so the rerank policy can still compare them
+        results = get_collection(user_id).get(ids=missing, include=["documents","metadatas","embeddings"])
+        query_vector = np.asarray(embedding, dtype=np.float32)
+        for chunk_id, doc, metadata, stored in zip(
+            results["ids"], results["documents"], results["metadatas"], results["embeddings"]
+        ):
+            by_id[chunk_id] = {
+                "id":chunk_id,
+                "text":doc,
+                "page_number":metadata["page_number"],
+                "chunk_index":metadata.get("chunk_index"),
+                "filename":metadata["filename"],
+                "distance":float(np.sum((np.asarray(stored, dtype=np.float32) - query_vector) ** 2)),
+            }
+
+    lexical = set(lexical_ids)
+    return [{**by_id[chunk_id], "lexical":chunk_id in lexical} for chunk_id in fused_ids if chunk_id in by_id]
+
+
+def delete_document(user_id: int, filename: str) -> int:
+    results = get_collection(user_id).get(
+        where={"$and":[{"user_id":user_id},{"filename":filename}]},
+        include=[]
+    )
+    _delete_ids(user_id, results["ids"])
+    return len(results["ids"])
+
+
+def _delete_ids(user_id: int, ids: list[str]) -> None:
+    if not ids:
+        return
+    get_collection(user_id).delete(ids=ids)
+    if compact_index.compact_enabled():
+        compact_index.get_index(user_id).remove(ids)
+    if settings.lexical_search:
+        _lexical_index(user_id).delete(ids)
+
+
 def clear(user_id:int) -> None:
-    results = collection.get(where={"user_id":user_id})
+    collection = get_collection(user_id)
+    results = collection.get(where={"user_id":user_id}, include=[])
     if results["ids"]:
         collection.delete(ids=results["ids"])
+    compact_index.drop_index(user_id)
+    if settings.lexical_search:
+        _lexical_index(user_id).delete_user(user_id)
+
+def count_document_chunks(user_id: int, filename: str) -> tuple[int, int]:
+    #(chunks, pages) stored for one document, recorded in the catalog after ingest
+    results = get_collection(user_id).get(
+        where={"$and":[{"user_id":user_id},{"filename":filename}]},
+        include=["metadatas"]
+    )
+    return len(results["ids"]), len({m["page_number"] for m in results["metadatas"]})
+
+
+def scan_document_stats() -> dict[tuple[int, str], dict]:
+    #walks every collection in pages; only used to backfill the document catalog
+    documents = {}
+    page_size = client.get_max_batch_size()
+    for collection in _document_collections():
+        offset = 0
+        while True:
+            results = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            if not results["ids"]:
+                break
+            offset += len(results["ids"])
+            _count_documents(documents, results["metadatas"])
+    return documents
+
+
+def _count_documents(documents: dict, metadatas: list[dict]):
+    for metadata in metadatas:
+        stats = documents.setdefault(
+            (metadata["user_id"], metadata["filename"]),
+            {"chunks":0, "pages":set(), "file_hash":None}
+        )
+        stats["chunks"] += 1
+        stats["pages"].add(metadata["page_number"])
+        stats["file_hash"] = stats["file_hash"] or metadata.get("file_hash")
+
 
 def has_documents(user_id:int) -> bool:
-    results = collection.get(where={"user_id":user_id})
-    return len(results["ids"]) > 0
\ No newline at end of file
+    results = get_collection(user_id).get(where={"user_id":user_id}, limit=1, include=[])
+    return len(results["ids"]) > 0
+
+
+def _document_collections() -> list:
+    names = [collection.name for collection in client.list_collections()]
+    return [
+        client.get_collection(name) for name in names
+        if name == LEGACY_COLLECTION or name.startswith(f"{LEGACY_COLLECTION}_")
+    ]
+
+
+def migrate_to_shards() -> int:
+    #moves chunks out of any collection that isn't their user's current shard,
+    #e.g. the legacy "documents" collection after turning sharding on. safe to rerun
+    moved = 0
+    page_size = client.get_max_batch_size()
+    for collection in _document_collections():
+        offset = 0
+        while True:
+            results = collection.get(include=["documents","metadatas","embeddings"], limit=page_size, offset=offset)
+            if not results["ids"]:
+                break
+            targets = {}
+            for i, metadata in enumerate(results["metadatas"]):
+                if shard_name(metadata["user_id"]) != collection.name:
+                    targets.setdefault(metadata["user_id"], []).append(i)
+
+            for user_id, rows in targets.items():
+                #upsert, so a migration interrupted before the delete can simply run again
+                get_collection(user_id).upsert(
+                    ids=[results["ids"][i] for i in rows],
+                    documents=[results["documents"][i] for i in rows],
+                    metadatas=[results["metadatas"][i] for i in rows],
+                    embeddings=[results["embeddings"][i] for i in rows]
+                )
+                collection.delete(ids=[results["ids"][i] for i in rows])
+                if settings.lexical_search:
+                    _move_lexical_rows(collection.name, user_id, results, rows)
+                moved += len(rows)
+            #moved rows are gone, the ones that stayed keep their place
+            offset += len(results["ids"]) - sum(len(rows) for rows in targets.values())
+    return moved
+
+
+
+def _move_lexical_rows(source_shard: str, user_id: int, results: dict, rows: list[int]):
+    #keyword rows follow their chunks into the new shard's index
+    get_lexical_index(source_shard).delete([results["ids"][i] for i in rows])
+    documents = {}
+    for i in rows:
+        ids, chunks = documents.setdefault(results["metadatas"][i]["filename"], ([], []))
+        ids.append(results["ids"][i])
+        chunks.append({**results["metadatas"][i], "text":results["documents"][i]})
+    for filename, (ids, chunks) in documents.items():
+        _lexical_index(user_id).add(user_id, filename, ids, chunks)
+
+
+def rebuild_lexical_index() -> int:
+    #fills the per-shard keyword indexes from chroma, for stores ingested before they existed
+    remove_legacy_index()
+    indexed = 0
+    page_size = client.get_max_batch_size()
+    for collection in _document_collections():
+        offset = 0
+        while True:
+            results = collection.get(include=["documents","metadatas"], limit=page_size, offset=offset)
+            if not results["ids"]:
+                break
+            offset += len(results["ids"])
+            documents = {}
+            for chunk_id, doc, metadata in zip(results["ids"], results["documents"], results["metadatas"]):
+                ids, chunks = documents.setdefault((metadata["user_id"], metadata["filename"]), ([], []))
+                ids.append(chunk_id)
+                chunks.append({**metadata, "text":doc})
+            for (user_id, filename), (ids, chunks) in documents.items():
+                _lexical_index(user_id).add(user_id, filename, ids, chunks)
+            indexed += len(results["ids"])
+    mark_lexical_index_built()
+    return indexed
+
+
+def rebuild_compact_index() -> int:
+    #fills the compact indexes from chroma, for chunks stored while VECTOR_COMPRESSION was off
+    compact_index.drop_all_indexes()
+    indexed = 0
+    page_size = client.get_max_batch_size()
+    for collection in _document_collections():
+        offset = 0
+        while True:
+            results = collection.get(include=["metadatas","embeddings"], limit=page_size, offset=offset)
+            if not results["ids"]:
+                break
+            offset += len(results["ids"])
+            users = {}
+            for chunk_id, metadata, embedding in zip(results["ids"], results["metadatas"], results["embeddings"]):
+                ids, embeddings = users.setdefault(metadata["user_id"], ([], []))
+                ids.append(chunk_id)
+                embeddings.append(embedding)
+            for user_id, (ids, embeddings) in users.items():
+                compact_index.get_index(user_id).add(ids, embeddings)
+            indexed += len(results["ids"])
+    compact_index.mark_compact_index_built()
+    return indexed
@@ -0,0 +1,351 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+from core.config import settings
+
+
+#bits set per byte value, for hamming distance over packed binary codes
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+#marks the in-memory state as stale, distinct from "no files yet" (None)
+_NOT_LOADED = object()
+
+#tombstoned share of rows that triggers rewriting the files
+_COMPACT_FRACTION = 0.25
+
+#rows scored per step, so int8 -> float conversion never materializes the whole index
+_SCORE_BLOCK = 65536
+
+
+#per-user compact vector index. candidate search runs over int8 or binary codes
+#(optionally truncated to fewer dimensions) kept in memory; the full float32 vectors
+#stay in a file on disk and are only read back for the candidates being rescored.
+#
+#files: ids.txt (one chunk id per row, written last so it marks complete rows),
+#full.f32 (n x dims float32), codes.bin (n x code width), scales.f32 (int8 only),
+#deleted.u32 (tombstoned row numbers, dropped when the files are compacted)
+class CompactIndex:
+    def __init__(self, directory: str | Path, compression: str, truncate_dims: int = 0):
+        if compression not in ("int8", "binary"):
+            raise ValueError(f"Unknown vector compression: {compression}")
+        self.directory = Path(directory)
+        self.compression = compression
+        self.truncate_dims = truncate_dims
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._exclusive = False
+        self._loaded_version = _NOT_LOADED
+        self._ids: list[str] = []
+        self._deleted = np.zeros(0, dtype=bool)
+        self._codes = None
+        self._scales = None
+        self._full_dims = 0
+
+    def add(self, ids: list[str], embeddings: list[list[float]]):
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._locked(exclusive=True):
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._check_meta(vectors.shape[1])
+            self._append(ids, vectors)
+
+    def remove(self, ids: list[str]):
+        with self._locked(exclusive=True):
+            self._reload()
+            drop = set(ids)
+            rows = [
+                row for row, chunk_id in enumerate(self._ids)
+                if chunk_id in drop and not self._deleted[row]
+            ]
+            if not rows:
+                return
+            #tombstone the rows instead of rewriting every file on each delete
+            with open(self.directory / "deleted.u32", "ab") as fh:
+                fh.write(np.asarray(rows, dtype=np.uint32).tobytes())
+            self._deleted[rows] = True
+            if self._deleted.sum() > len(self._ids) * _COMPACT_FRACTION:
+                self._compact()
+
+    def search(self, embedding: list[float], n_results: int, rescore_factor: int) -> list[tuple[str, float]]:
+        with self._locked(exclusive=False):
+            self._reload()
+            live = len(self._ids) - int(self._deleted.sum())
+            if not live:
+                return []
+            query = np.asarray(embedding, dtype=np.float32)
+            scores = self._compact_scores(query)
+            scores[self._deleted] = -np.inf
+
+            #candidates from the compact codes, then exact scores from the on-disk vectors
+            depth = min(live, max(n_results, n_results * rescore_factor))
+            candidates = np.argpartition(-scores, depth - 1)[:depth] if depth < len(scores) else np.arange(len(scores))
+            candidates = np.sort(candidates[~self._deleted[candidates]])
+            exact = self._full_vectors()[candidates] @ query
+            order = np.argsort(-exact)[:n_results]
+            return [(self._ids[candidates[i]], float(exact[i])) for i in order]
+
+    def memory_bytes(self) -> int:
+        with self._locked(exclusive=False):
+            self._reload()
+            size = self._codes.nbytes if self._codes is not None else 0
+            if self._scales is not None:
+                size += self._scales.nbytes
+            return size
+
+    def __len__(self) -> int:
+        with self._locked(exclusive=False):
+            self._reload()
+            return len(self._ids) - int(self._deleted.sum())
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        #threads share the instance lock, other processes are kept out by the flock
+        with self._lock, _file_lock(self.directory, exclusive) as fh:
+            self._lock_file, self._exclusive = fh, exclusive
+            try:
+                yield
+            finally:
+                self._lock_file, self._exclusive = None, False
+
+    def _upgrade_lock(self):
+        #a reader that finds codes to rewrite needs the writer's lock
+        if self._lock_file is not None and not self._exclusive:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._exclusive = True
+
+    def _append(self, ids: list[str], vectors: np.ndarray):
+        codes, scales = self._encode(vectors)
+        self._drop_torn_rows(vectors.shape[1], codes.shape[1] * codes.itemsize)
+        with open(self.directory / "full.f32", "ab") as fh:
+            fh.write(vectors.tobytes())
+        with open(self.directory / "codes.bin", "ab") as fh:
+            fh.write(codes.tobytes())
+        if scales is not None:
+            with open(self.directory / "scales.f32", "ab") as fh:
+                fh.write(scales.tobytes())
+        with open(self.directory / "ids.txt", "a") as fh:
+            fh.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+
+    def _drop_torn_rows(self, full_dims: int, code_bytes: int):
+        #a crash between writing the data files and ids.txt leaves rows without an id (or a
+        #half-written id). cut every file back to the complete rows, otherwise the next
+        #append would pair its ids with the orphaned vectors
+        ids_path = self.directory / "ids.txt"
+        text = ids_path.read_bytes() if ids_path.exists() else b""
+        complete = text.rfind(b"\n") + 1
+        if complete < len(text):
+            os.truncate(ids_path, complete)
+        rows = text.count(b"\n")
+        for name, row_bytes in (("full.f32", full_dims * 4), ("codes.bin", code_bytes), ("scales.f32", 4)):
+            path = self.directory / name
+            if path.exists() and path.stat().st_size > rows * row_bytes:
+                os.truncate(path, rows * row_bytes)
+
+    def _compact(self):
+        #enough tombstones piled up: rewrite the files with only the live rows
+        keep = np.flatnonzero(~self._deleted)
+        full = np.asarray(self._full_vectors()[keep])
+        kept_ids = [self._ids[row] for row in keep]
+        for name in ("ids.txt", "full.f32", "codes.bin", "scales.f32", "deleted.u32"):
+            (self.directory / name).unlink(missing_ok=True)
+        self._loaded_version = _NOT_LOADED
+        if kept_ids:
+            self._append(kept_ids, full)
+
+    def _encode(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+        vectors = self._truncate(vectors)
+        if self.compression == "binary":
+            return np.packbits(vectors > 0, axis=1), None
+
+        #symmetric per-row scale: the largest component maps to +-127
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.round(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def _truncate(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.atleast_2d(vectors)
+        if not self.truncate_dims or self.truncate_dims >= vectors.shape[1]:
+            return vectors
+        vectors = vectors[:, :self.truncate_dims]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _compact_scores(self, query: np.ndarray) -> np.ndarray:
+        query = self._truncate(query)[0]
+        if self.compression == "binary":
+            query_bits = np.packbits(query > 0)
+            scores = np.empty(len(self._ids), dtype=np.float32)
+            for start in range(0, len(self._ids), _SCORE_BLOCK):
+                block = np.bitwise_xor(self._codes[start:start + _SCORE_BLOCK], query_bits)
+                scores[start:start + _SCORE_BLOCK] = -_POPCOUNT[block].sum(axis=1, dtype=np.int32)
+            return scores
+
+        scores = np.empty(len(self._ids), dtype=np.float32)
+        for start in range(0, len(self._ids), _SCORE_BLOCK):
+            block = self._codes[start:start + _SCORE_BLOCK].astype(np.float32)
+            scores[start:start + _SCORE_BLOCK] = (block @ query) * self._scales[start:start + _SCORE_BLOCK]
+        return scores
+
+    def _full_vectors(self) -> np.ndarray:
+        rows = len(self._ids)
+        if not rows:
+            return np.empty((0, self._full_dims), dtype=np.float32)
+        return np.memmap(self.directory / "full.f32", dtype=np.float32, mode="r", shape=(rows, self._full_dims))
+
+    def _check_meta(self, full_dims: int):
+        meta_path = self.directory / "meta.json"
+        meta = {"compression":self.compression, "truncate_dims":self.truncate_dims, "full_dims":full_dims}
+        if meta_path.exists():
+            stored = json.loads(meta_path.read_text())
+            if stored["full_dims"] != full_dims:
+                raise ValueError(f"Index holds {stored['full_dims']}-d vectors, got {full_dims}-d")
+            if stored != meta:
+                self._reencode(meta)
+        meta_path.write_text(json.dumps(meta))
+        self._full_dims = full_dims
+
+    def _reencode(self, meta: dict):
+        #compression settings changed: rebuild the codes from the full vectors
+        self._full_dims = meta["full_dims"]
+        self._loaded_version = _NOT_LOADED
+        self._reload(check_meta=False)
+        codes, scales = self._encode(np.asarray(self._full_vectors()))
+        (self.directory / "codes.bin").write_bytes(codes.tobytes())
+        (self.directory / "scales.f32").unlink(missing_ok=True)
+        if scales is not None:
+            (self.directory / "scales.f32").write_bytes(scales.tobytes())
+        self._loaded_version = _NOT_LOADED
+
+    def _files_version(self) -> tuple | None:
+        #the ingest worker writes from another process; reload when any of these change
+        versions = []
+        for name in ("ids.txt", "deleted.u32", "meta.json"):
+            try:
+                stat = (self.directory / name).stat()
+                versions.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                if name == "ids.txt":
+                    return None
+                versions.append(None)
+        return tuple(versions)
+
+    def _reload(self, check_meta: bool = True):
+        version = self._files_version()
+        if version == self._loaded_version:
+            return
+
+        self._loaded_version = version
+        if version is None:
+            self._ids, self._codes, self._scales = [], None, None
+            self._deleted = np.zeros(0, dtype=bool)
+            return
+
+        ids_path = self.directory / "ids.txt"
+        if check_meta:
+            meta = json.loads((self.directory / "meta.json").read_text())
+            self._full_dims = meta["full_dims"]
+            if meta["compression"] != self.compression or meta["truncate_dims"] != self.truncate_dims:
+                self._upgrade_lock()
+                meta.update(compression=self.compression, truncate_dims=self.truncate_dims)
+                self._reencode(meta)
+                (self.directory / "meta.json").write_text(json.dumps(meta))
+                return self._reload(check_meta=False)
+
+        text = ids_path.read_text()
+        #a torn last line isn't a row yet, see _drop_torn_rows
+        self._ids = text[:text.rfind("\n") + 1].splitlines()
+        rows = len(self._ids)
+        self._deleted = np.zeros(rows, dtype=bool)
+        deleted_path = self.directory / "deleted.u32"
+        if deleted_path.exists():
+            self._deleted[np.fromfile(deleted_path, dtype=np.uint32)] = True
+        dims = self.truncate_dims if 0 < self.truncate_dims < self._full_dims else self._full_dims
+        if self.compression == "binary":
+            width, dtype = -(-dims // 8), np.uint8
+        else:
+            width, dtype = dims, np.int8
+        self._codes = np.fromfile(self.directory / "codes.bin", dtype=dtype, count=rows * width).reshape(rows, width)
+        self._scales = None
+        if self.compression == "int8":
+            self._scales = np.fromfile(self.directory / "scales.f32", dtype=np.float32, count=rows)
+
+
+@contextmanager
+def _file_lock(directory: Path, exclusive: bool):
+    #the api and the ingest worker are separate processes over the same files: writers
+    #hold an exclusive flock, readers a shared one. the lock file sits next to the
+    #directory so drop_index can remove the directory while holding it
+    lock_path = directory.parent / f"{directory.name}.lock"
+    if not exclusive and not lock_path.parent.exists():
+        yield None
+        return
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    #closing the file releases the flock
+    with open(lock_path, "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield fh
+
+
+_indexes: dict[int, CompactIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def compact_enabled() -> bool:
+    return settings.vector_compression != "none"
+
+
+def compact_dir() -> Path:
+    return Path(settings.chroma_path) / "compact"
+
+
+def compact_index_built() -> bool:
+    #set once the indexes were filled from chroma, see chroma_service.rebuild_compact_index
+    return (compact_dir() / ".built").exists()
+
+
+def mark_compact_index_built(built: bool = True):
+    #cleared while VECTOR_COMPRESSION is off: chunks stored then aren't in the indexes,
+    #so turning it back on has to rebuild them
+    marker = compact_dir() / ".built"
+    if built:
+        compact_dir().mkdir(parents=True, exist_ok=True)
+        marker.touch()
+    else:
+        marker.unlink(missing_ok=True)
+
+
+def get_index(user_id: int) -> CompactIndex:
+    with _indexes_lock:
+        if user_id not in _indexes:
+            _indexes[user_id] = CompactIndex(
+                compact_dir() / str(user_id),
+                settings.vector_compression,
+                settings.vector_truncate_dims
+            )
+        return _indexes[user_id]
+
+
+def drop_index(user_id: int):
+    with _indexes_lock:
+        _indexes.pop(user_id, None)
+    directory = compact_dir() / str(user_id)
+    if not directory.exists():
+        return
+    with _file_lock(directory, exclusive=True):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def drop_all_indexes():
+    if not compact_dir().exists():
+        return
+    for directory in compact_dir().iterdir():
+        if directory.is_dir() and directory.name.isdigit():
+            drop_index(int(directory.name))
@@ -0,0 +1,136 @@
+import logging
+import re
+import threading
+import numpy as np
+from services.context_packer import estimate_tokens
+from services.ollama_service import get_sentence_embeddings
+
+logger = logging.getLogger(__name__)
+
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+#markdown separator under a table header, see pdf_service._table_to_markdown
+_TABLE_SEPARATOR = re.compile(r"^\|[\s|-]*\|$")
+
+_stats = {"requests":0, "compressed":0, "units":0, "kept":0, "tokens_in":0, "tokens_out":0}
+_stats_lock = threading.Lock()
+
+
+def split_units(text: str) -> list[dict]:
+    #sentences of prose and single table rows, in page order. a row points at its table's
+    #header so the header can come along whenever one of its rows is kept
+    units = []
+    header = None
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            header = None
+            continue
+        if line.startswith("|"):
+            if header is None:
+                header = len(units)
+                units.append({"text":line, "row":True, "header":None})
+            elif _TABLE_SEPARATOR.match(line) and header == len(units) - 1:
+                units[header]["text"] += "\n" + line
+            else:
+                units.append({"text":line, "row":True, "header":header})
+            continue
+        header = None
+        for sentence in _SENTENCE_END.split(line):
+            if sentence:
+                units.append({"text":sentence, "row":False, "header":None})
+    return units
+
+
+async def compress_context(question_embedding: list[float], chunks: list[dict], token_budget: int) -> list[dict]:
+    #keeps the sentences and table rows closest to the question until token_budget is used.
+    #every chunk keeps at least its best unit, so each cited page stays in the prompt.
+    #returns copies of the chunks with shortened text; chunks that already fit are unchanged
+    tokens_in = sum(estimate_tokens(chunk["text"]) for chunk in chunks)
+    if not token_budget or tokens_in <= token_budget:
+        _record(False, 0, 0, tokens_in, tokens_in)
+        return chunks
+
+    units = []
+    seen = set()
+    for position, chunk in enumerate(chunks):
+        for index, unit in enumerate(split_units(chunk["text"])):
+            #neighbouring chunks repeat their overlap, a sentence is only scored and sent once
+            key = (chunk["filename"], chunk["page_number"], unit["text"])
+            if key in seen:
+                continue
+            seen.add(key)
+            units.append({**unit, "chunk":position, "index":index})
+    if not units:
+        return chunks
+
+    embeddings = np.asarray(await get_sentence_embeddings([unit["text"] for unit in units]), dtype=np.float32)
+    scores = embeddings @ np.asarray(question_embedding, dtype=np.float32)
+    ranked = sorted(range(len(units)), key=lambda i: -scores[i])
+
+    by_position = {(unit["chunk"], unit["index"]): i for i, unit in enumerate(units)}
+    kept = set()
+    spent = 0
+
+    def keep(i: int):
+        nonlocal spent
+        #a row comes with its table header, when that header wasn't a duplicate
+        header = by_position.get((units[i]["chunk"], units[i]["header"]))
+        for j in (header, i):
+            if j is not None and j not in kept:
+                kept.add(j)
+                spent += estimate_tokens(units[j]["text"])
+
+    best_per_chunk = {}
+    for i in ranked:
+        best_per_chunk.setdefault(units[i]["chunk"], i)
+    for i in best_per_chunk.values():
+        keep(i)
+    for i in ranked:
+        if spent >= token_budget:
+            break
+        if i not in kept and spent + estimate_tokens(units[i]["text"]) <= token_budget:
+            keep(i)
+
+    compressed = []
+    for position, chunk in enumerate(chunks):
+        parts = [units[i] for i in sorted(kept) if units[i]["chunk"] == position]
+        if parts:
+            compressed.append({**chunk, "text":_join_units(parts)})
+
+    tokens_out = sum(estimate_tokens(chunk["text"]) for chunk in compressed)
+    _record(True, len(units), len(kept), tokens_in, tokens_out)
+    logger.info(
+        "context compression: units=%s kept=%s tokens~%s->%s",
+        len(units), len(kept), tokens_in, tokens_out
+    )
+    return compressed
+
+
+def context_compression_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["saved_tokens"] = stats["tokens_in"] - stats["tokens_out"]
+    return stats
+
+
+def _join_units(parts: list[dict]) -> str:
+    #skipped text is marked so the model doesn't read two distant sentences as one passage
+    text = parts[0]["text"]
+    for previous, unit in zip(parts, parts[1:]):
+        separator = "\n" if previous["row"] or unit["row"] else " "
+        if unit["index"] != previous["index"] + 1:
+            separator = f"{separator}...{separator}"
+        text += separator + unit["text"]
+    return text
+
+
+def _record(compressed: bool, units: int, kept: int, tokens_in: int, tokens_out: int):
+    with _stats_lock:
+        _stats["requests"] += 1
+        _stats["compressed"] += compressed
+        _stats["units"] += units
+        _stats["kept"] += kept
+        _stats["tokens_in"] += tokens_in
+        _stats["tokens_out"] += tokens_out
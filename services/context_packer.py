@@ -0,0 +1,136 @@
+import logging
+import threading
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+#blank line between blocks in the prompt, see build_context
+_SEPARATOR = "\n\n"
+
+#shortest repeated text accepted as overlap when it isn't the configured CHUNK_OVERLAP
+_MIN_OVERLAP = 20
+
+_stats = {"requests":0, "chunks":0, "blocks":0, "merged":0, "dropped":0, "raw_tokens":0, "packed_tokens":0}
+_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    #~4 characters per token for english text, close enough for budgeting
+    return (len(text) + 3) // 4
+
+
+def source_header(chunk: dict) -> str:
+    return f"Source: {chunk['filename']} | Page: {chunk['page_number']}"
+
+
+def pack_context(chunks: list[dict], token_budget: int) -> list[dict]:
+    #chunks arrive in relevance order. neighbours from the same page are merged into one
+    #block without the text chunk_text repeats between them, then chunks are taken in
+    #relevance order for as long as the packed blocks fit token_budget (0 = no limit).
+    #the most relevant chunk is always kept
+    selected = []
+    blocks = []
+    for chunk in chunks:
+        candidate = _merge_blocks(selected + [chunk])
+        if selected and token_budget and _tokens(candidate) > token_budget:
+            continue
+        selected.append(chunk)
+        blocks = candidate
+
+    raw_tokens = _tokens(chunks)
+    packed_tokens = _tokens(blocks)
+    _record(len(chunks), len(blocks), len(selected) - len(blocks), len(chunks) - len(selected), raw_tokens, packed_tokens)
+    logger.info(
+        "context packing: chunks=%s blocks=%s dropped=%s tokens~%s->%s saved~%s",
+        len(chunks), len(blocks), len(chunks) - len(selected), raw_tokens, packed_tokens, raw_tokens - packed_tokens
+    )
+    return blocks
+
+
+def context_packing_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["saved_tokens"] = stats["raw_tokens"] - stats["packed_tokens"]
+    return stats
+
+
+def _merge_blocks(chunks: list[dict]) -> list[dict]:
+    #blocks keep the relevance order of their best chunk, text inside a block reads in page order
+    groups = {}
+    for rank, chunk in enumerate(chunks):
+        groups.setdefault((chunk["filename"], chunk["page_number"]), []).append((rank, chunk))
+
+    blocks = []
+    for members in groups.values():
+        members.sort(key=lambda member: (member[1].get("chunk_index") is None, member[1].get("chunk_index") or 0))
+        run = [members[0]]
+        for member in members[1:]:
+            if _adjacent(run[-1][1], member[1]):
+                run.append(member)
+            else:
+                blocks.append(_block(run))
+                run = [member]
+        blocks.append(_block(run))
+
+    blocks.sort(key=lambda block: block["rank"])
+    return [{key: value for key, value in block.items() if key != "rank"} for block in blocks]
+
+
+def _adjacent(left: dict, right: dict) -> bool:
+    if left.get("chunk_index") is None or right.get("chunk_index") is None:
+        return False
+    return right["chunk_index"] - left["chunk_index"] <= 1
+
+
+def _block(run: list[tuple[int, dict]]) -> dict:
+    first = run[0][1]
+    text = first["text"]
+    for (_, previous), (_, chunk) in zip(run, run[1:]):
+        if chunk["chunk_index"] == previous["chunk_index"]:
+            continue # the same chunk twice, e.g. from vector and keyword search
+        text = _join(text, chunk["text"])
+    return {
+        "filename":first["filename"],
+        "page_number":first["page_number"],
+        "chunk_index":first.get("chunk_index"),
+        "text":text,
+        "rank":min(rank for rank, _ in run),
+        "chunks":len(run)
+    }
+
+
+def _join(left: str, right: str) -> str:
+    size = _overlap(left, right)
+    #no shared text, e.g. after context compression shortened both sides
+    return left + right[size:] if size else f"{left}\n{right}"
+
+
+def _overlap(left: str, right: str) -> int:
+    #chunk_text starts each chunk with the last CHUNK_OVERLAP characters of the previous one.
+    #the configured size is tried first; skipped blank windows can shift it, so fall back
+    #to the longest repeat of a meaningful length
+    longest = min(len(left), len(right))
+    if 0 < settings.chunk_overlap <= longest and left.endswith(right[:settings.chunk_overlap]):
+        return settings.chunk_overlap
+    for size in range(longest, _MIN_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _tokens(blocks: list[dict]) -> int:
+    #what build_context will send: a header line per block plus its text
+    parts = [f"{source_header(block)}\n{block['text']}" for block in blocks]
+    return estimate_tokens(_SEPARATOR.join(parts))
+
+
+def _record(chunks: int, blocks: int, merged: int, dropped: int, raw_tokens: int, packed_tokens: int):
+    with _stats_lock:
+        _stats["requests"] += 1
+        _stats["chunks"] += chunks
+        _stats["blocks"] += blocks
+        _stats["merged"] += merged
+        _stats["dropped"] += dropped
+        _stats["raw_tokens"] += raw_tokens
+        _stats["packed_tokens"] += packed_tokens
@@ -0,0 +1,147 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+
+#disk hits whose last_used is written in one go, instead of a write per lookup
+_TOUCH_BATCH = 256
+
+
+#two tier cache for embeddings: in-memory LRU in front of a sqlite file.
+#keys are sha256(model name + normalized text), and the file remembers which model
+#filled it, so changing the embedding model empties it instead of serving stale vectors
+class EmbeddingCache:
+    def __init__(self, path: str, model_name: str, memory_entries: int, disk_entries: int):
+        self.model_name = model_name
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {"memory_hits":0, "disk_hits":0, "misses":0}
+        self._touched: dict[str, float] = {}
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        #used from executor threads, every access goes through the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        #the api and the ingest worker share the file from separate processes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, last_used REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row is None or row[0] != model_name:
+            self._db.execute("DELETE FROM embeddings")
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('model', ?)", (model_name,))
+        self._db.commit()
+        #kept up to date by put_many, so inserts don't count the table. the other process's
+        #inserts aren't seen, it is recounted before evicting
+        self._disk_count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def key(self, text: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{self.model_name}\0{normalized}".encode()).hexdigest()
+
+    def get_many(self, texts: list[str]) -> list[list[float] | None]:
+        keys = [self.key(text) for text in texts]
+        found: dict[str, np.ndarray] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            self._counts["memory_hits"] += len(found)
+
+            on_disk = self._load([key for key in set(keys) if key not in found])
+            self._counts["disk_hits"] += len(on_disk)
+            for key, vector in on_disk.items():
+                self._remember(key, vector)
+            found.update(on_disk)
+            self._counts["misses"] += sum(1 for key in keys if key not in found)
+
+        return [found[key].tolist() if key in found else None for key in keys]
+
+    def put_many(self, texts: list[str], vectors: list[list[float]]):
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                array = np.asarray(vector, dtype=np.float32)
+                self._remember(key, array)
+                rows.append((key, array.tobytes(), now))
+            #a key already stored holds the same vector, same model and text
+            inserted = self._db.executemany("INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            self._disk_count += max(0, inserted.rowcount)
+            self._flush_touched()
+            self._evict_disk()
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+            disk_size = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = sum(counts.values())
+        hits = counts["memory_hits"] + counts["disk_hits"]
+        return {
+            **counts,
+            "hit_rate":hits / lookups if lookups else 0.0,
+            "memory_size":len(self._memory),
+            "disk_size":disk_size,
+            "model":self.model_name
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+            self._db.execute("DELETE FROM embeddings")
+            self._db.commit()
+            self._disk_count = 0
+
+    def _load(self, keys: list[str]) -> dict[str, np.ndarray]:
+        found = {}
+        #stay well under sqlite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            part = keys[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = self._db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+            ).fetchall()
+            found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+
+        if found:
+            #last_used only orders eviction, it can wait for the next batch or insert
+            now = time.time()
+            self._touched.update((key, now) for key in found)
+            if len(self._touched) >= _TOUCH_BATCH:
+                self._flush_touched()
+                self._db.commit()
+        return found
+
+    def _flush_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        if self._disk_count <= self.disk_entries:
+            return
+        self._disk_count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if self._disk_count <= self.disk_entries:
+            return
+        #drop a little extra so we don't evict on every insert once full
+        excess = self._disk_count - self.disk_entries + self.disk_entries // 10
+        deleted = self._db.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+        self._disk_count -= deleted.rowcount
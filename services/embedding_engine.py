@@ -0,0 +1,68 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+#embeddings get their own pools instead of the loop's default executor, which every
+#asyncio.to_thread chroma call shares. queries and bulk ingestion are split as well,
+#so a large upload never queues ahead of an interactive question
+
+_query_executor = None
+_bulk_executor = None
+
+
+def get_query_executor() -> ThreadPoolExecutor:
+    global _query_executor
+    if _query_executor is None:
+        #queries are already coalesced by the micro-batcher, one thread runs them
+        _query_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-query")
+    return _query_executor
+
+
+def get_bulk_executor() -> ThreadPoolExecutor:
+    global _bulk_executor
+    if _bulk_executor is None:
+        _bulk_executor = ThreadPoolExecutor(
+            max_workers=settings.embed_bulk_workers,
+            thread_name_prefix="embed-bulk"
+        )
+    return _bulk_executor
+
+
+def embed_options() -> dict:
+    #fastembed's own batching; parallel > 1 spreads a call over that many processes (0 = all cores)
+    options = {"batch_size":settings.embed_batch_size}
+    if settings.embed_parallel is not None:
+        options["parallel"] = settings.embed_parallel
+    return options
+
+
+class ThroughputMeter:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.texts = 0
+        self.seconds = 0.0
+        self.last_rate = 0.0
+
+    def record(self, texts: int, seconds: float):
+        rate = texts / seconds if seconds else 0.0
+        with self._lock:
+            self.texts += texts
+            self.seconds += seconds
+            self.last_rate = rate
+        logger.info("%s embedded %s chunks in %.2fs (%.1f chunks/sec)", self.name, texts, seconds, rate)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chunks":self.texts,
+                "seconds":round(self.seconds, 3),
+                "chunks_per_sec":self.texts / self.seconds if self.seconds else 0.0,
+                "last_chunks_per_sec":self.last_rate
+            }
+
+
+bulk_meter = ThroughputMeter("bulk")
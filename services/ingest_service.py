@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import os
+from core.config import settings
+from services.pdf_service import iter_page_batches, chunk_text, describe_table_stats
+from services.ollama_service import get_embeddings_batch
+from services.chroma_service import (
+    store_chunks,
+    find_document_by_hash,
+    copy_document,
+    get_page_embeddings,
+    get_stored_pages,
+    delete_pages,
+    delete_file_chunks,
+    set_file_hash,
+    count_document_chunks
+)
+from services.catalog_service import record_document, is_recorded
+from services.progress_service import update_progress
+
+
+#sentinel that tells the consumer the producer has finished
+_END = None
+
+
+#raised for documents that will never ingest, so the job isn't retried
+class UnprocessableDocument(Exception):
+    pass
+
+
+async def process_upload(source: str | bytes, filename: str, user_id: int, task_id: str):
+    file_hash = await asyncio.to_thread(file_sha256, source)
+    if await is_recorded(user_id, filename, file_hash):
+        await update_progress(task_id, f"{filename} is already uploaded, nothing to do")
+        return
+    #chunks of these bytes without a catalog row are left over from an attempt that died
+    #part way, possibly mid-page: drop them and redo the work, keeping their embeddings
+    retired = await asyncio.to_thread(delete_file_chunks, user_id, filename, file_hash)
+    if retired:
+        await update_progress(task_id, f"Resuming an interrupted upload of {filename}...")
+    existing = await asyncio.to_thread(find_document_by_hash, user_id, file_hash)
+    stored_pages = await asyncio.to_thread(get_stored_pages, user_id, filename)
+    if existing and not stored_pages:
+        #same bytes under another name: copy its chunks, skip extraction and embedding
+        copied = await asyncio.to_thread(copy_document, user_id, existing, filename, file_hash)
+        await _record_in_catalog(source, filename, user_id, file_hash)
+        await update_progress(task_id, f"Identical to {existing}, reused {copied} stored chunks")
+        await update_progress(task_id,f"Done! {copied} chunk stored")
+        return
+
+    #a previous revision of this filename: only changed pages are re-embedded
+    revision = new_revision(stored_pages)
+    revision["retired"].update(retired)
+    if stored_pages:
+        await update_progress(task_id, f"Comparing against {len(stored_pages)} stored pages of {filename}...")
+
+    await update_progress(task_id, "Extracting text from PDF...")
+    #bounded queue = backpressure: extraction waits while embedding/storing catches up
+    queue: asyncio.Queue = asyncio.Queue(maxsize=settings.ingest_queue_batches)
+    extract_stats = {}
+    producer = asyncio.create_task(
+        _produce_chunk_batches(source, queue, extract_stats, file_hash, revision)
+    )
+
+    try:
+        stored, pages_reused = await _consume_chunk_batches(queue, filename, user_id, task_id, revision)
+    finally:
+        if not producer.done():
+            producer.cancel()
+    pages = await producer
+
+    if not pages:
+        raise UnprocessableDocument("Could not extract content")
+
+    #pages the new revision no longer has (or that are now empty)
+    removed = set(stored_pages) - revision["seen"]
+    if removed:
+        await asyncio.to_thread(delete_pages, user_id, filename, removed)
+    if stored_pages:
+        #the whole document now belongs to these bytes, unchanged pages included
+        await asyncio.to_thread(set_file_hash, user_id, filename, file_hash)
+        await update_progress(
+            task_id,
+            f"{revision['unchanged']} pages unchanged, {len(revision['replaced'])} changed, "
+            f"{len(removed)} removed"
+        )
+
+    await _record_in_catalog(source, filename, user_id, file_hash)
+    await update_progress(task_id, describe_table_stats(extract_stats))
+    await update_progress(task_id, f"Reused embeddings for {pages_reused}/{pages} pages")
+    await update_progress(task_id,f"Done! {stored} chunk stored")
+
+
+async def _record_in_catalog(source: str | bytes, filename: str, user_id: int, file_hash: str):
+    #counted from chroma: unchanged pages of a re-upload aren't in this run's totals
+    chunk_count, page_count = await asyncio.to_thread(count_document_chunks, user_id, filename)
+    size = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+    await record_document(user_id, filename, chunk_count, page_count, size, file_hash)
+
+
+def file_sha256(source: str | bytes) -> str:
+    if isinstance(source, (bytes, bytearray)):
+        return hashlib.sha256(source).hexdigest()
+    #hash the spooled file in blocks instead of loading it
+    with open(source, "rb") as fh:
+        return hashlib.file_digest(fh, "sha256").hexdigest()
+
+
+def page_hash(text: str) -> str:
+    #chunking settings are part of the key: stored chunk_index values only line up
+    #with a new upload if the page was split the same way
+    key = f"{settings.chunk_size}:{settings.chunk_overlap}\n{text}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def new_revision(stored_pages: dict[int, str] | None = None) -> dict:
+    return {
+        "stored":stored_pages or {}, # page_number -> page_hash of the stored revision
+        "seen":set(), # page numbers present in the new revision
+        "replaced":set(), # stored pages whose old chunks were already deleted
+        "retired":{}, # embeddings of deleted chunks, so shifted pages can still reuse them
+        "unchanged":0
+    }
+
+
+async def _produce_chunk_batches(
+        source: str | bytes,
+        queue: asyncio.Queue,
+        stats: dict,
+        file_hash: str = "",
+        revision: dict | None = None
+) -> int:
+    revision = revision if revision is not None else new_revision()
+    pages = 0
+    buffer = []
+    try:
+        async for page_batch in iter_page_batches(source, stats=stats):
+            pages += len(page_batch)
+            for page in page_batch:
+                hashes = {"page_hash":page_hash(page["text"]), "file_hash":file_hash}
+                revision["seen"].add(page["page_number"])
+                if revision["stored"].get(page["page_number"]) == hashes["page_hash"]:
+                    revision["unchanged"] += 1
+                    continue
+                buffer.extend(
+                    {**chunk, **hashes}
+                    for chunk in chunk_text([page], settings.chunk_size, settings.chunk_overlap)
+                )
+            while len(buffer) >= settings.ingest_batch_size:
+                await queue.put(buffer[:settings.ingest_batch_size])
+                buffer = buffer[settings.ingest_batch_size:]
+
+        if buffer:
+            await queue.put(buffer)
+    except asyncio.CancelledError:
+        #the consumer is gone, nobody is waiting for the sentinel
+        raise
+    except Exception:
+        await queue.put(_END)
+        raise
+
+    await queue.put(_END)
+    return pages
+
+
+async def _consume_chunk_batches(
+        queue: asyncio.Queue,
+        filename: str,
+        user_id: int,
+        task_id: str,
+        revision: dict | None = None
+) -> tuple[int, int]:
+    revision = revision if revision is not None else new_revision()
+    stored = 0
+    pages_reused = 0
+    batch_number = 0
+    while True:
+        batch = await queue.get()
+        if batch is _END:
+            return stored, pages_reused
+
+        batch_number += 1
+        embeddings, reused = await _embed_with_reuse(batch, user_id, revision["retired"])
+        #count a page once, on its first chunk
+        pages_reused += sum(1 for i in reused if batch[i]["chunk_index"] == 0)
+
+        #changed pages: drop the old revision's chunks once, before the first new chunk lands
+        stale = {
+            chunk["page_number"] for chunk in batch
+            if chunk["page_number"] in revision["stored"] and chunk["page_number"] not in revision["replaced"]
+        }
+        if stale:
+            revision["retired"].update(await asyncio.to_thread(delete_pages, user_id, filename, stale))
+            revision["replaced"].update(stale)
+        stored += await asyncio.to_thread(store_chunks, batch, embeddings, filename, user_id)
+        await update_progress(
+            task_id,
+            f"Batch {batch_number}: {stored} chunks stored, {pages_reused} pages reused "
+            f"(up to page {batch[-1]['page_number']})"
+        )
+
+
+async def _embed_with_reuse(batch: list[dict], user_id: int, retired: dict | None = None) -> tuple[list, set[int]]:
+    #only embed chunks whose page we haven't stored for this user before
+    known = await asyncio.to_thread(
+        get_page_embeddings, user_id, [chunk["page_hash"] for chunk in batch if chunk.get("page_hash")]
+    )
+    known = {**(retired or {}), **known}
+    embeddings = [known.get((chunk.get("page_hash"), chunk["chunk_index"])) for chunk in batch]
+    reused = {i for i, embedding in enumerate(embeddings) if embedding is not None}
+
+    missing = [i for i in range(len(batch)) if i not in reused]
+    if missing:
+        fresh = await get_embeddings_batch([batch[i]["text"] for i in missing])
+        for i, embedding in zip(missing, fresh):
+            embeddings[i] = embedding
+    return embeddings, reused
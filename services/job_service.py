@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import UploadFile
+from core.config import settings
+from core.database import AsyncSessionLocal
+from models.document import IngestJob
+from services.ingest_service import process_upload, UnprocessableDocument
+from services.catalog_service import backfill_catalog
+from services.chroma_service import migrate_to_shards, rebuild_lexical_index, rebuild_compact_index
+from services.lexical_service import lexical_index_built
+from services import compact_index
+
+logger = logging.getLogger(__name__)
+
+
+_SPOOL_BLOCK_SIZE = 1024 * 1024
+
+#postgres down or restarting; connection failures can surface as plain OSError
+_DB_ERRORS = (SQLAlchemyError, OSError)
+
+#longest wait between attempts while the database keeps failing
+_MAX_DB_BACKOFF = 60
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+#copies the upload to UPLOAD_DIR in blocks, so the api never holds the whole pdf in memory
+async def spool_upload(file: UploadFile) -> tuple[Path, int]:
+    max_bytes = settings.max_upload_mb * 1024 * 1024
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLarge(f"File exceeds {settings.max_upload_mb} MB")
+
+    file_path = Path(settings.upload_dir) / f"{uuid.uuid4()}.pdf"
+    size = await asyncio.to_thread(_copy_to_spool, file.file, file_path, max_bytes)
+    return file_path, size
+
+
+def _copy_to_spool(source, file_path: Path, max_bytes: int) -> int:
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    try:
+        with open(file_path, "wb") as spool:
+            while block := source.read(_SPOOL_BLOCK_SIZE):
+                written += len(block)
+                if written > max_bytes:
+                    raise UploadTooLarge(f"File exceeds {settings.max_upload_mb} MB")
+                spool.write(block)
+    except BaseException:
+        file_path.unlink(missing_ok=True)
+        raise
+    return written
+
+
+#called by /upload: persist the job for the spooled file, a worker picks it up later
+async def enqueue_job(db: AsyncSession, user_id: int, filename: str, file_path: Path) -> IngestJob:
+    job_id = str(uuid.uuid4())
+    job = IngestJob(
+        id=job_id,
+        user_id=user_id,
+        filename=filename,
+        file_path=str(file_path),
+        status="queued",
+        progress="",
+        attempts=0,
+        max_attempts=settings.job_max_attempts
+    )
+    db.add(job)
+    await db.commit()
+    return job
+
+
+async def get_job(db: AsyncSession, job_id: str, user_id: int) -> IngestJob | None:
+    result = await db.execute(
+        select(IngestJob).where(IngestJob.id==job_id, IngestJob.user_id==user_id)
+    )
+    return result.scalar_one_or_none()
+
+
+async def claim_next_job() -> IngestJob | None:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(IngestJob.id)
+            .where(IngestJob.status=="queued", IngestJob.run_after <= func.now())
+            .order_by(IngestJob.created_at)
+            .limit(settings.worker_concurrency)
+        )
+        for job_id in result.scalars().all():
+            #conditional update: only one worker wins a job, on postgres and sqlite alike
+            claimed = await db.execute(
+                update(IngestJob)
+                .where(IngestJob.id==job_id, IngestJob.status=="queued")
+                .values(status="running", attempts=IngestJob.attempts + 1)
+            )
+            await db.commit()
+            if claimed.rowcount:
+                return await db.get(IngestJob, job_id)
+    return None
+
+
+async def run_job(job: IngestJob):
+    try:
+        #extraction reads the spooled file itself, it is never loaded whole
+        await process_upload(job.file_path, job.filename, job.user_id, job.id)
+    except asyncio.CancelledError:
+        #worker shutting down: hand the job back without spending an attempt
+        await _set_status(job.id, status="queued", attempts=IngestJob.attempts - 1)
+        raise
+    except UnprocessableDocument as e:
+        await _fail(job, str(e), retry=False)
+    except Exception as e:
+        logger.exception("ingest job %s failed (attempt %s)", job.id, job.attempts)
+        await _fail(job, str(e), retry=True)
+    else:
+        await _set_status(job.id, status="done", error=None)
+        remove_spooled(job.file_path)
+
+
+async def _fail(job: IngestJob, error: str, retry: bool):
+    if retry and job.attempts < job.max_attempts:
+        delay = settings.job_retry_backoff_seconds * 2 ** (job.attempts - 1)
+        await _set_status(
+            job.id,
+            status="queued",
+            error=error,
+            run_after=datetime.now(timezone.utc) + timedelta(seconds=delay),
+            progress=IngestJob.progress + f"Attempt {job.attempts} failed, retrying in {delay}s\n"
+        )
+        return
+
+    await _set_status(job.id, status="failed", error=error)
+    remove_spooled(job.file_path)
+
+
+async def _set_status(job_id: str, **values):
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(IngestJob).where(IngestJob.id==job_id).values(**values))
+        await db.commit()
+
+
+def remove_spooled(file_path: str | Path):
+    Path(file_path).unlink(missing_ok=True)
+
+
+async def requeue_stale_jobs() -> int:
+    #jobs left running by a worker that died; progress writes keep updated_at fresh
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=settings.job_stale_after_minutes)
+    stale = (IngestJob.status=="running", IngestJob.updated_at < cutoff)
+    async with AsyncSessionLocal() as db:
+        #a job that keeps killing its worker must not be requeued forever
+        exhausted = await db.execute(
+            select(IngestJob.id, IngestJob.file_path)
+            .where(*stale, IngestJob.attempts >= IngestJob.max_attempts)
+        )
+        exhausted = exhausted.all()
+        if exhausted:
+            await db.execute(
+                update(IngestJob)
+                .where(IngestJob.id.in_([job_id for job_id, _ in exhausted]))
+                .values(status="failed", error="Worker stopped responding on every attempt")
+            )
+        result = await db.execute(
+            update(IngestJob)
+            .where(*stale, IngestJob.attempts < IngestJob.max_attempts)
+            .values(status="queued")
+        )
+        await db.commit()
+
+    for _, file_path in exhausted:
+        remove_spooled(file_path)
+    if exhausted:
+        logger.warning("failed %s stale ingest jobs that ran out of attempts", len(exhausted))
+    return result.rowcount
+
+
+async def run_worker():
+    requeued = await requeue_stale_jobs()
+    if requeued:
+        logger.info("requeued %s stale ingest jobs", requeued)
+    #chunks left in the shared collection (or another shard layout) move to their user's shard
+    moved = await asyncio.to_thread(migrate_to_shards)
+    if moved:
+        logger.info("moved %s chunks into their chroma shards", moved)
+    await backfill_catalog()
+    if settings.lexical_search and not lexical_index_built():
+        indexed = await asyncio.to_thread(rebuild_lexical_index)
+        if indexed:
+            logger.info("keyword index built for %s existing chunks", indexed)
+    if not compact_index.compact_enabled():
+        compact_index.mark_compact_index_built(False)
+    elif not compact_index.compact_index_built():
+        indexed = await asyncio.to_thread(rebuild_compact_index)
+        logger.info("compact vector index built for %s existing chunks", indexed)
+
+    logger.info("ingest worker started with concurrency %s", settings.worker_concurrency)
+    await asyncio.gather(
+        _stale_job_loop(),
+        *(_worker_loop(i) for i in range(settings.worker_concurrency))
+    )
+
+
+async def _worker_loop(worker_id: int):
+    #a database error must not escape: it would end the gather in run_worker and every
+    #other loop with it. a job whose status write failed stays running and is requeued
+    #by _stale_job_loop
+    failures = 0
+    while True:
+        try:
+            job = await claim_next_job()
+            if job is not None:
+                logger.info("worker %s running job %s (%s)", worker_id, job.id, job.filename)
+                await run_job(job)
+        except _DB_ERRORS:
+            failures += 1
+            delay = _db_backoff(failures)
+            logger.exception("worker %s database error, retrying in %ss", worker_id, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        failures = 0
+        if job is None:
+            await asyncio.sleep(settings.job_poll_interval)
+
+
+async def _stale_job_loop():
+    while True:
+        await asyncio.sleep(settings.job_stale_after_minutes * 60)
+        try:
+            await requeue_stale_jobs()
+        except _DB_ERRORS:
+            logger.exception("requeueing stale ingest jobs failed")
+
+
+def _db_backoff(failures: int) -> float:
+    return min(_MAX_DB_BACKOFF, max(1, settings.job_poll_interval) * 2 ** (failures - 1))
@@ -0,0 +1,142 @@
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from core.config import settings
+
+
+#words too common to be worth matching on their own; bm25 discounts them anyway
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how",
+    "in", "is", "it", "of", "on", "or", "should", "that", "the", "this", "to", "was", "what",
+    "when", "where", "which", "who", "why", "with"
+}
+
+#keeps part numbers, clause ids and units ("PV-204", "4.2.1", "M8x1.25") as one term
+_TERM = re.compile(r"[\w][\w.\-/]*[\w]|[\w]")
+
+#shard indexes kept open at once; the least recently used is dropped past this
+_MAX_OPEN_INDEXES = 128
+
+_lexical_indexes: OrderedDict[Path, "LexicalIndex"] = OrderedDict()
+_lexical_indexes_lock = threading.Lock()
+
+
+#bm25 keyword index over the same chunks as chroma, in an sqlite fts5 table.
+#there is one index file per chroma shard, so a MATCH only walks the postings (and
+#bm25 only counts the documents) of that shard's users, never the whole install.
+#fts5's tokenizer splits "4.2.1" into 4, 2, 1 -- each query term is matched as a
+#phrase, so it only hits where those tokens appear together
+class LexicalIndex:
+    def __init__(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        #used from executor threads, every access goes through the lock
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        #the api reads while the ingest worker writes from another process
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+            "text, chunk_id UNINDEXED, user_id UNINDEXED, filename UNINDEXED, page_number UNINDEXED)"
+        )
+        self._db.commit()
+
+    def add(self, user_id: int, filename: str, ids: list[str], chunks: list[dict]):
+        with self._lock:
+            #re-stored chunks (re-upload, shard migration) replace their old row
+            self._delete(ids)
+            self._db.executemany(
+                "INSERT INTO chunks (text, chunk_id, user_id, filename, page_number) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (chunk["text"], chunk_id, user_id, filename, chunk["page_number"])
+                    for chunk_id, chunk in zip(ids, chunks)
+                ]
+            )
+            self._db.commit()
+
+    def delete(self, ids: list[str]):
+        with self._lock:
+            self._delete(ids)
+            self._db.commit()
+
+    def delete_user(self, user_id: int):
+        with self._lock:
+            self._db.execute("DELETE FROM chunks WHERE user_id = ?", (user_id,))
+            self._db.commit()
+
+    def search(self, question: str, user_id: int, n_results: int) -> list[str]:
+        match = build_match_query(question)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chunk_id FROM chunks WHERE chunks MATCH ? AND user_id = ? ORDER BY bm25(chunks) LIMIT ?",
+                (match, user_id, n_results)
+            ).fetchall()
+        return [chunk_id for (chunk_id,) in rows]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def _delete(self, ids: list[str]):
+        #stay well under sqlite's bound parameter limit
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            self._db.execute(f"DELETE FROM chunks WHERE chunk_id IN ({placeholders})", part)
+
+
+def build_match_query(question: str) -> str:
+    terms = []
+    for term in _TERM.findall(question.lower()):
+        if term in _STOPWORDS or term in terms:
+            continue
+        terms.append(term)
+    #quoted, so fts5 syntax characters in the question are just text
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def lexical_dir() -> Path:
+    return Path(settings.chroma_path) / "lexical"
+
+
+def get_lexical_index(shard: str) -> LexicalIndex:
+    #shard is the chroma collection name the chunks live in
+    path = lexical_dir() / f"{shard}.sqlite3"
+    with _lexical_indexes_lock:
+        index = _lexical_indexes.get(path)
+        if index is None:
+            index = LexicalIndex(path)
+            _lexical_indexes[path] = index
+        _lexical_indexes.move_to_end(path)
+        while len(_lexical_indexes) > _MAX_OPEN_INDEXES:
+            #not closed here, a thread may still be using it; closes once unreferenced
+            _lexical_indexes.popitem(last=False)
+        return index
+
+
+def lexical_index_built() -> bool:
+    #set once the indexes were filled from chroma; chunks stored since are indexed on write
+    return (lexical_dir() / ".built").exists()
+
+
+def mark_lexical_index_built():
+    lexical_dir().mkdir(parents=True, exist_ok=True)
+    (lexical_dir() / ".built").touch()
+
+
+def remove_legacy_index():
+    #the single index every user shared before it was split per shard
+    for suffix in ("", "-wal", "-shm"):
+        (Path(settings.chroma_path) / f"lexical.sqlite3{suffix}").unlink(missing_ok=True)
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    #each list contributes 1 / (k + rank); ids found by several retrievers rise to the top
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)
@@ -0,0 +1,121 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+#lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+#recent waits kept for the percentile in stats()
+_WAIT_SAMPLES = 1000
+
+
+#raised when a request waited its whole queue deadline without getting a slot
+class SchedulerBusy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+#a fixed number of generation slots in front of ollama. requests beyond that wait in a
+#priority queue (interactive before background, fifo within a priority) and give up
+#after queue_timeout seconds instead of piling onto ollama until everyone times out
+class LLMScheduler:
+    def __init__(self, slots: int, queue_timeout: float):
+        self.slots = slots
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._waiting: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._waits = deque(maxlen=_WAIT_SAMPLES)
+        self._service_seconds = None
+        self.granted = 0
+        self.shed = 0
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE):
+        await self._acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record_service(time.monotonic() - started)
+            self._release()
+
+    def retry_after(self) -> int:
+        #time for the queue ahead to drain through the slots, from the running average
+        per_request = self._service_seconds or self.queue_timeout
+        return max(1, math.ceil(per_request * (len(self._waiting) + 1) / self.slots))
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        queued = {}
+        for priority, _, _ in self._waiting:
+            queued[priority] = queued.get(priority, 0) + 1
+        return {
+            "slots":self.slots,
+            "active":self._active,
+            "queued":len(self._waiting),
+            "queued_by_priority":queued,
+            "granted":self.granted,
+            "shed":self.shed,
+            "wait_avg_ms":sum(waits) / len(waits) * 1000 if waits else 0.0,
+            "wait_p95_ms":waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000 if waits else 0.0,
+            "service_avg_ms":(self._service_seconds or 0.0) * 1000
+        }
+
+    async def _acquire(self, priority: int):
+        queued_at = time.monotonic()
+        if self._active < self.slots and not self._waiting:
+            self._active += 1
+            self._granted(0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._order), future))
+        try:
+            #shielded, so a timeout leaves the future alone and we can see whether the
+            #slot was handed over in the same instant
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._leave_queue(future)
+                self.shed += 1
+                raise SchedulerBusy(self.retry_after())
+        except asyncio.CancelledError:
+            #the caller went away: hand on a slot we were just given, or leave the queue
+            if future.done():
+                self._release()
+            else:
+                self._leave_queue(future)
+            raise
+        self._granted(time.monotonic() - queued_at)
+
+    def _leave_queue(self, future: asyncio.Future):
+        future.cancel()
+        self._waiting = [entry for entry in self._waiting if entry[2] is not future]
+        heapq.heapify(self._waiting)
+
+    def _release(self):
+        #the slot passes straight to the next waiter instead of being freed
+        if self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            future.set_result(None)
+            return
+        self._active -= 1
+
+    def _granted(self, waited: float):
+        self.granted += 1
+        self._waits.append(waited)
+
+    def _record_service(self, seconds: float):
+        #exponential moving average of how long a slot is held
+        if self._service_seconds is None:
+            self._service_seconds = seconds
+        else:
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * seconds
@@ -0,0 +1,417 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+from contextlib import AsyncExitStack
+from typing import AsyncGenerator
+import httpx
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+#statuses worth another try: ollama answers 503 while its own queue is full
+_RETRY_STATUSES = {429, 502, 503, 504}
+
+#failures before any bytes came back; a read timeout mid-generation is not retried
+_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+
+#latency samples kept per call type, and how many are needed before hedging kicks in
+_LATENCY_SAMPLES = 200
+_HEDGE_MIN_SAMPLES = 20
+
+#a load_duration above this means the model was (re)loaded for the request
+_MODEL_LOAD_SECONDS = 1.0
+
+_client = None
+_health_task = None
+
+
+#one ollama instance: its own pooled keep-alive connections plus what routing needs to know
+class Backend:
+    def __init__(self, url: str, max_connections: int, transport: httpx.AsyncBaseTransport | None = None):
+        self.url = url
+        self.http = httpx.AsyncClient(
+            base_url=url,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport
+        )
+        self.outstanding = 0
+        self.healthy = True
+        self.model_loaded = None # unknown until the first probe
+        self.requests = 0
+        self.failures = 0
+
+    def stats(self) -> dict:
+        return {
+            "url":self.url,
+            "healthy":self.healthy,
+            "model_loaded":self.model_loaded,
+            "outstanding":self.outstanding,
+            "requests":self.requests,
+            "failures":self.failures
+        }
+
+
+#long-lived client for every ollama call, opened and closed by the app lifespan.
+#a request goes to the healthy backend with the fewest requests in flight (preferring
+#one with the model already loaded) and fails over to another on transient errors.
+#with OLLAMA_HEDGE_PERCENTILE set, a request slower than that percentile is also sent
+#to a second backend; whichever answers first wins and the other is cancelled
+class OllamaClient:
+    def __init__(
+            self,
+            base_urls: list[str],
+            max_connections: int,
+            retries: int,
+            backoff_seconds: float,
+            hedge_percentile: float = 0.0,
+            transport: httpx.AsyncBaseTransport | None = None
+    ):
+        self.backends = [Backend(url, max_connections, transport) for url in base_urls]
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.hedge_percentile = hedge_percentile
+        self._latencies: dict[str, deque] = {}
+        self.failovers = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._generation = {
+            "requests":0, "model_loads":0, "load_ms":0.0,
+            "prompt_tokens":0, "prompt_tokens_evaluated":0, "prompt_eval_ms":0.0,
+            "eval_tokens":0, "eval_ms":0.0
+        }
+
+    async def chat(self, payload: dict, call_type: str) -> dict:
+        payload = _resident(payload)
+        started = time.perf_counter()
+        data, attempts = await self._with_failover(
+            lambda backend: self._post(backend, payload, call_type), call_type
+        )
+        elapsed = time.perf_counter() - started
+        self._record_latency(call_type, elapsed)
+        logger.info("ollama %s: attempts=%s %.0fms %s", call_type, attempts, elapsed * 1000, self._record_timings(payload, data))
+        return data
+
+    async def chat_stream(self, payload: dict, call_type: str) -> AsyncGenerator[dict, None]:
+        #yields ollama's json lines. failover and hedging only happen until the first
+        #line has arrived, after that tokens went to the caller and can't be replayed
+        payload = _resident(payload)
+        started = time.perf_counter()
+        (stack, first, lines), attempts = await self._with_failover(
+            lambda backend: self._open_stream(backend, payload, call_type),
+            f"{call_type}_stream",
+            discard=lambda opened: opened[0].aclose()
+        )
+        first_line = time.perf_counter() - started
+        self._record_latency(f"{call_type}_stream", first_line)
+        logger.info("ollama %s stream: attempts=%s first line after %.0fms", call_type, attempts, first_line * 1000)
+        async with stack:
+            yield first
+            if first.get("done"):
+                self._log_stream_end(call_type, payload, first)
+                return
+            async for data in lines:
+                yield data
+                if data.get("done"):
+                    self._log_stream_end(call_type, payload, data)
+                    return
+
+    async def probe(self, model: str):
+        await asyncio.gather(*(self._probe(backend, model) for backend in self.backends))
+
+    async def preload(self, model: str):
+        #loads the model with the same num_ctx and keep_alive as real requests, so the
+        #first question doesn't pay the load and the model isn't reloaded for it
+        cold = [backend for backend in self.backends if backend.healthy and backend.model_loaded is False]
+        await asyncio.gather(*(self._preload(backend, model) for backend in cold))
+
+    def stats(self) -> dict:
+        generation = dict(self._generation)
+        #ollama only counts prompt tokens it had to evaluate, the rest came from its cache
+        generation["prompt_reuse"] = (
+            1 - generation["prompt_tokens_evaluated"] / generation["prompt_tokens"]
+            if generation["prompt_tokens"] else 0.0
+        )
+        return {
+            "backends":[backend.stats() for backend in self.backends],
+            "failovers":self.failovers,
+            "hedged":self.hedged,
+            "hedge_wins":self.hedge_wins,
+            "generation":generation
+        }
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.http.aclose()
+
+    async def _with_failover(self, call, call_type: str, discard=None):
+        #returns (result, attempts). each attempt goes to a backend not tried yet in this
+        #round; the backoff only happens once every backend has failed
+        tried = []
+        for attempt in range(self.retries + 1):
+            backend = self._pick(exclude=tried)
+            try:
+                return await self._hedged(call, backend, call_type, discard), attempt + 1
+            except (httpx.HTTPStatusError, *_RETRY_ERRORS) as e:
+                if not _is_transient(e) or attempt >= self.retries:
+                    raise
+                reason = f"status {e.response.status_code}" if isinstance(e, httpx.HTTPStatusError) else type(e).__name__
+                self._mark_failed(backend, reason)
+                tried.append(backend)
+                if len(tried) >= len(self.backends):
+                    tried = []
+                    await self._backoff(call_type, attempt, reason)
+                else:
+                    self.failovers += 1
+                    logger.warning("ollama %s failed on %s (%s), failing over", call_type, backend.url, reason)
+
+    async def _hedged(self, call, backend: Backend, call_type: str, discard=None):
+        threshold = self._hedge_after(call_type)
+        if threshold is None:
+            return await call(backend)
+
+        tasks = [asyncio.ensure_future(call(backend))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=threshold)
+            if not done:
+                other = self._pick(exclude=[backend])
+                if other is not None:
+                    self.hedged += 1
+                    tasks.append(asyncio.ensure_future(call(other)))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not tasks[0]:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    #closing the connection makes ollama stop generating
+                    task.cancel()
+                elif task is not winner and discard and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    async def _post(self, backend: Backend, payload: dict, call_type: str) -> dict:
+        backend.outstanding += 1
+        backend.requests += 1
+        try:
+            response = await backend.http.post("/api/chat", json=payload, timeout=_timeout(call_type))
+            response.raise_for_status()
+            return response.json()
+        finally:
+            backend.outstanding -= 1
+
+    async def _open_stream(self, backend: Backend, payload: dict, call_type: str):
+        #(exit stack, first json line, remaining lines); whoever gets it closes the stack
+        stack = AsyncExitStack()
+        backend.outstanding += 1
+        backend.requests += 1
+        stack.callback(_finished, backend)
+        try:
+            response = await stack.enter_async_context(
+                backend.http.stream("POST", "/api/chat", json=payload, timeout=_timeout(call_type))
+            )
+            response.raise_for_status()
+            lines = _json_lines(response)
+            first = await anext(lines, {"done":True})
+        except BaseException:
+            await stack.aclose()
+            raise
+        return stack, first, lines
+
+    def _pick(self, exclude: list[Backend] = ()) -> Backend | None:
+        candidates = [backend for backend in self.backends if backend not in exclude]
+        if not candidates:
+            return None
+        #unhealthy backends are only tried when nothing healthy is left
+        healthy = [backend for backend in candidates if backend.healthy] or candidates
+        return min(healthy, key=_routing_key)
+
+    def _mark_failed(self, backend: Backend, reason: str):
+        #out of rotation until the next health probe passes
+        backend.failures += 1
+        if backend.healthy:
+            logger.warning("ollama backend %s marked unhealthy (%s)", backend.url, reason)
+        backend.healthy = False
+
+    async def _probe(self, backend: Backend, model: str):
+        #/api/ps lists the models loaded in memory, so one call answers both questions
+        try:
+            response = await backend.http.get("/api/ps", timeout=settings.ollama_connect_timeout)
+            response.raise_for_status()
+            loaded = {
+                name for entry in response.json().get("models", [])
+                for name in (entry.get("name"), entry.get("model"))
+                if name
+            }
+        except (httpx.HTTPError, ValueError) as e:
+            if backend.healthy:
+                logger.warning("ollama backend %s failed its health check (%s)", backend.url, type(e).__name__)
+            backend.healthy = False
+            return
+        if not backend.healthy:
+            logger.info("ollama backend %s is healthy again", backend.url)
+        backend.healthy = True
+        backend.model_loaded = model in loaded or f"{model}:latest" in loaded
+
+    async def _preload(self, backend: Backend, model: str):
+        #/api/generate without a prompt only loads the model
+        payload = _resident({"model":model})
+        try:
+            response = await backend.http.post("/api/generate", json=payload, timeout=_timeout("chat"))
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.warning("preloading %s on %s failed (%s)", model, backend.url, type(e).__name__)
+            return
+        backend.model_loaded = True
+        logger.info("preloaded %s on %s", model, backend.url)
+
+    def _log_stream_end(self, call_type: str, payload: dict, data: dict):
+        logger.info("ollama %s stream done: %s", call_type, self._record_timings(payload, data))
+
+    def _record_timings(self, payload: dict, data: dict) -> str:
+        #durations come back in nanoseconds on the final response
+        load = data.get("load_duration", 0) / 1e9
+        prompt_eval = data.get("prompt_eval_duration", 0) / 1e9
+        evaluated = data.get("prompt_eval_count", 0)
+        eval_seconds = data.get("eval_duration", 0) / 1e9
+        #chars/4 stands in for the full prompt size, ollama doesn't report it
+        prompt_tokens = max(evaluated, sum(len(message.get("content", "")) for message in payload.get("messages", [])) // 4)
+
+        generation = self._generation
+        generation["requests"] += 1
+        generation["model_loads"] += load >= _MODEL_LOAD_SECONDS
+        generation["load_ms"] += load * 1000
+        generation["prompt_tokens"] += prompt_tokens
+        generation["prompt_tokens_evaluated"] += evaluated
+        generation["prompt_eval_ms"] += prompt_eval * 1000
+        generation["eval_tokens"] += data.get("eval_count", 0)
+        generation["eval_ms"] += eval_seconds * 1000
+        return (
+            f"load={load * 1000:.0f}ms prompt_eval={evaluated}/~{prompt_tokens} tokens {prompt_eval * 1000:.0f}ms "
+            f"eval={data.get('eval_count', 0)} tokens {eval_seconds * 1000:.0f}ms"
+        )
+
+    def _hedge_after(self, call_type: str) -> float | None:
+        if not self.hedge_percentile or len(self.backends) < 2:
+            return None
+        samples = self._latencies.get(call_type)
+        if samples is None or len(samples) < _HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    def _record_latency(self, call_type: str, seconds: float):
+        self._latencies.setdefault(call_type, deque(maxlen=_LATENCY_SAMPLES)).append(seconds)
+
+    async def _backoff(self, call_type: str, attempt: int, reason: str):
+        #exponential with jitter, so retries from concurrent requests don't line up
+        delay = self.backoff_seconds * 2 ** attempt * (0.5 + random.random())
+        logger.warning("ollama %s failed (%s), retry %s in %.2fs", call_type, reason, attempt + 1, delay)
+        await asyncio.sleep(delay)
+
+
+def _keep_alive() -> str | int:
+    #ollama takes a duration ("30m") or seconds, negative keeps the model loaded for good
+    value = settings.ollama_keep_alive.strip()
+    return int(value) if value.lstrip("-").isdigit() else value
+
+
+def _resident(payload: dict) -> dict:
+    #every request carries the same keep_alive and num_ctx: a different num_ctx makes
+    #ollama reload the model, a missing keep_alive lets it unload after 5 minutes
+    payload = {**payload, "keep_alive":_keep_alive()}
+    if settings.ollama_num_ctx:
+        payload["options"] = {"num_ctx":settings.ollama_num_ctx, **payload.get("options", {})}
+    return payload
+
+
+def _routing_key(backend: Backend) -> tuple:
+    #a backend known not to have the model loaded would pay the load time first
+    return backend.model_loaded is False, backend.outstanding, random.random()
+
+
+def _finished(backend: Backend):
+    backend.outstanding -= 1
+
+
+def _is_transient(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in _RETRY_STATUSES
+    return isinstance(error, _RETRY_ERRORS)
+
+
+async def _json_lines(response: httpx.Response) -> AsyncGenerator[dict, None]:
+    async for line in response.aiter_lines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            continue
+
+
+def _timeout(call_type: str) -> httpx.Timeout:
+    #chat can take minutes on cpu hosts, fact extraction is short and optional
+    read = settings.ollama_facts_timeout if call_type == "facts" else settings.ollama_chat_timeout
+    return httpx.Timeout(read, connect=settings.ollama_connect_timeout)
+
+
+def ollama_urls() -> list[str]:
+    #OLLAMA_BASE_URLS (comma separated) for a pool, else the single OLLAMA_BASE_URL
+    urls = [url.strip() for url in settings.ollama_base_urls.split(",") if url.strip()]
+    return urls or [settings.ollama_base_url]
+
+
+def get_ollama_client() -> OllamaClient:
+    #created on first use for scripts and tests that don't run the app lifespan
+    global _client
+    if _client is None:
+        _client = OllamaClient(
+            ollama_urls(),
+            settings.ollama_max_connections,
+            settings.ollama_retries,
+            settings.ollama_retry_backoff_seconds,
+            settings.ollama_hedge_percentile
+        )
+    return _client
+
+
+def ollama_client_stats() -> dict:
+    return get_ollama_client().stats()
+
+
+async def _health_loop(client: OllamaClient):
+    while True:
+        await client.probe(settings.ollama_model)
+        if settings.ollama_preload:
+            await client.preload(settings.ollama_model)
+        await asyncio.sleep(settings.ollama_health_interval_seconds)
+
+
+async def open_ollama_client():
+    global _health_task
+    client = get_ollama_client()
+    if _health_task is None:
+        _health_task = asyncio.create_task(_health_loop(client))
+
+
+async def close_ollama_client():
+    global _client, _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        _health_task = None
+    if _client is not None:
+        await _client.close()
+        _client = None
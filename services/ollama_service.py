@@ -1,32 +1,94 @@
-import httpx
 from core.config import settings
 import json
+import time
 import asyncio
+from typing import AsyncGenerator
 from fastembed import TextEmbedding
+from services.batcher import MicroBatcher
+from services.embedding_cache import EmbeddingCache
+from services.embedding_engine import get_query_executor, get_bulk_executor, embed_options, bulk_meter
+from services.llm_scheduler import LLMScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from services.ollama_client import get_ollama_client, ollama_urls
+from services.context_packer import pack_context, source_header
+
+EMBED_MODEL_NAME = "BAAI/bge-small-en-v1.5"
 
 _embed_model = None
+_embedding_cache = None
+
+#every chat call to ollama goes through these slots, LLM_CONCURRENCY per backend
+_scheduler = LLMScheduler(settings.llm_concurrency * len(ollama_urls()), settings.llm_queue_timeout_seconds)
 
 def get_embed_model():
     global _embed_model
     if _embed_model is None:
-        _embed_model = TextEmbedding("BAAI/bge-small-en-v1.5")
+        _embed_model = TextEmbedding(EMBED_MODEL_NAME, threads=settings.embed_onnx_threads)
     return _embed_model
 
 
+def get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(
+            settings.embedding_cache_path,
+            EMBED_MODEL_NAME,
+            memory_entries=settings.embedding_cache_memory_entries,
+            disk_entries=settings.embedding_cache_disk_entries
+        )
+    return _embedding_cache
+
+
+def _embed_texts(texts: list[str], **options) -> list[list[float]]:
+    #only texts the cache hasn't seen go through the model
+    cache = get_embedding_cache()
+    embeddings = cache.get_many(texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        model = get_embed_model()
+        fresh = [e.tolist() for e in model.embed([texts[i] for i in missing], **options)]
+        for i, embedding in zip(missing, fresh):
+            embeddings[i] = embedding
+        cache.put_many([texts[i] for i in missing], fresh)
+    return embeddings
+
+
+#concurrent /ask requests share one fastembed call instead of each blocking the loop
+_query_batcher = MicroBatcher(
+    _embed_texts,
+    max_batch_size=settings.embed_max_batch,
+    max_wait_ms=settings.embed_batch_window_ms,
+    executor=get_query_executor()
+)
+
+
 async def get_embedding(text: str) -> list[float]:
-    model = get_embed_model()
-    embeddings = list(model.embed([text]))
-    return embeddings[0].tolist()
+    return await _query_batcher.submit(text)
+
+
+def query_batcher_stats() -> dict:
+    return _query_batcher.stats()
+
+def _embed_bulk(texts: list[str]) -> list[list[float]]:
+    started = time.perf_counter()
+    embeddings = _embed_texts(texts, **embed_options())
+    bulk_meter.record(len(texts), time.perf_counter() - started)
+    return embeddings
+
 
 async def get_embeddings_batch(texts:list[str]) -> list[list[float]]:
-    model = get_embed_model()
-    # # run it in thread pool so it doesn't block the event loop
+    # # run it in the bulk embedding pool so it doesn't block the event loop or queries
     loop = asyncio.get_event_loop()
-    embeddings = await loop.run_in_executor(
-        None, lambda: list(model.embed(texts))
-    )
+    return await loop.run_in_executor(get_bulk_executor(), _embed_bulk, texts)
+
 
-    return [e.tolist()for e in embeddings]
+async def get_sentence_embeddings(texts: list[str]) -> list[list[float]]:
+    #small batches scored while a user waits, they run on the query pool instead of behind ingest
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_query_executor(), _embed_texts, texts)
+
+
+def bulk_embedding_stats() -> dict:
+    return bulk_meter.stats()
 
 # async def get_embedding(text:str) -> list[float]:
 #     async with httpx.AsyncClient() as client:
@@ -53,8 +115,7 @@ async def get_embeddings_batch(texts:list[str]) -> list[list[float]]:
 def build_context(chunks: list[dict]) -> str:
     parts = []
     for chunk in chunks:
-        header = f"Source: {chunk['filename']} | Page: {chunk['page_number']}"
-        parts.append(f"{header}\n{chunk['text']}")
+        parts.append(f"{source_header(chunk)}\n{chunk['text']}")
     return "\n\n".join(parts)
 
 
@@ -64,12 +125,38 @@ def trim_history(history: list=None) -> list:
     return history[-settings.max_history:]
 
 
-async def ask(question:str, context_chunks: list[dict], history: list= None, memory_context: str = "" )-> str:
-    if history is None:
-        history = []
+#long answers are cut when summarizing, the summary only needs their gist
+_SUMMARY_ANSWER_CHARS = 1500
+
+_ASK_OPTIONS = {
+    "num_predict": 1024,
+    "temperature":0.7,
+    "think":False
+}
+
+
+_STABLE_SYSTEM_PROMPT = """You are an engineering document assistant.
+Answer using ONLY the document context given with each question.
+If the answer is not present in the context, say:
+'I could not find this information in the uploaded document.'
+Do not use any knowledge outside of the provided context.
+Always reference the page number when possible (e.g. 'According to page 4...')."""
+
+
+def build_messages(question: str, context_chunks: list[dict], history: list = None, memory_context: str = "") -> list[dict]:
+    #neighbouring chunks share text, merge them and keep the prompt within budget
+    context = build_context(pack_context(context_chunks, settings.context_token_budget))
+    trimmed_history = trim_history(history)
+
+    if settings.prompt_layout == "stable":
+        #most to least stable: fixed instructions, the user's facts, past turns, then this
+        #turn's documents and question. ollama reuses its cache for the unchanged prefix,
+        #so only the last message has to be evaluated again
+        messages = [{"role":"system","content":_STABLE_SYSTEM_PROMPT + memory_context}]
+        messages += trimmed_history
+        messages.append({"role":"user","content":f"Context:\n{context}\n\nQuestion: {question}"})
+        return messages
 
-    context = build_context(context_chunks)
-    
     system_prompt = f"""You are an engineering document assistant.
 Answer using ONLY the context provided below.
 If the answer is not present in the cntext, say:
@@ -79,45 +166,50 @@ Always reference the page nubmer when possible (e.g. 'According to page 4...').{
 
 Context:
 {context}"""
-    
-
-    trimmed_history = trim_history(history)
 
     messages = [{"role":"system","content":system_prompt}]
     messages+=trimmed_history
     messages.append({"role":"user","content":question})
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{settings.ollama_base_url}/api/chat",
-            json={
+    return messages
+
+
+async def ask(question:str, context_chunks: list[dict], history: list= None, memory_context: str = "" )-> str:
+    messages = build_messages(question, context_chunks, history, memory_context)
+    async with _scheduler.slot(PRIORITY_INTERACTIVE):
+        data = await get_ollama_client().chat(
+            {
                 "model": settings.ollama_model,
                 "messages": messages,
                 "stream": False,
-                "options": {
-                    "num_predict": 1024,
-                    "temperature":0.7,
-                    "think":False
-                    }
+                "options": _ASK_OPTIONS
             },
-            timeout=120.0
+            call_type="chat"
         )
-        response.raise_for_status()
-        
-        # parse all lines, collect full content
-        full_content = ""
-        print(response.text)
-        for line in response.text.strip().split("\n"):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                data = json.loads(line)
-                if "message" in data and data["message"].get("content"):
-                    full_content += data["message"]["content"]
-            except json.JSONDecodeError:
-                continue
-        
-        return full_content if full_content else "I could not generate an answer."
+    full_content = data.get("message", {}).get("content", "")
+    return full_content if full_content else "I could not generate an answer."
+
+
+async def ask_stream(
+        question: str,
+        context_chunks: list[dict],
+        history: list = None,
+        memory_context: str = ""
+) -> AsyncGenerator[str, None]:
+    #same prompt as ask, but yields tokens as ollama produces them
+    messages = build_messages(question, context_chunks, history, memory_context)
+    #the slot is held until the last token, generation is what it limits
+    async with _scheduler.slot(PRIORITY_INTERACTIVE):
+        async for data in get_ollama_client().chat_stream(
+            {
+                "model": settings.ollama_model,
+                "messages": messages,
+                "stream": True,
+                "options": _ASK_OPTIONS
+            },
+            call_type="chat"
+        ):
+            if data.get("message", {}).get("content"):
+                yield data["message"]["content"]
     
 # {'model': 'qwen2.5', 'created_at': '2026-02-23T13:56:32.714972504Z',
 #   'message': {'role': 'assistant', 'content': 'I could not find this information in the uploaded document.'}, 'done': True, 'done_reason': 'stop', 'total_duration': 46482115639, 'load_duration': 19111339252, 'prompt_eval_count': 1953, 'prompt_eval_duration': 23648915076, 'eval_count': 12, 'eval_duration': 3551022719}
@@ -134,40 +226,63 @@ Assistant answer: {answer}
 
 Return only JSON array, nothing else:"""
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{settings.ollama_base_url}/api/chat",
-            json={
+    #background work: queued behind every interactive question
+    async with _scheduler.slot(PRIORITY_BACKGROUND):
+        data = await get_ollama_client().chat(
+            {
                 "model":settings.ollama_model,
                 "messages":[{"role":"user","content":prompt}],
                 "stream":False,
-                "options":{"num_predit":256}
+                "options":{"num_predict":256}
             },
-            timeout=30
+            call_type="facts"
         )
-        response.raise_for_status()
-
-        full_content = ""
-        for line in response.text.strip().split("\n"):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                data = json.loads(line)
-                if "message" in data and data["message"].get("content"):
-                    full_content += data["message"]["content"]
-            except json.JSONDecodeError:
-                continue
-        
-        try:
-            start = full_content.find("[")
-            end = full_content.rfind("]") + 1
-            if start == -1 or end == 0:
-                return []
-            facts = json.loads(full_content[start:end])
-            return [f for f in facts if isinstance(f,str)]
-        except Exception:
+    full_content = data.get("message", {}).get("content", "")
+
+    try:
+        start = full_content.find("[")
+        end = full_content.rfind("]") + 1
+        if start == -1 or end == 0:
             return []
+        facts = json.loads(full_content[start:end])
+        return [f for f in facts if isinstance(f,str)]
+    except Exception:
+        return []
+
+
+async def summarize_conversation(summary: str, turns: list[tuple[str, str]]) -> str:
+    #folds older turns into the running summary that stands in for them in the prompt
+    conversation = "\n\n".join(
+        f"User: {question}\nAssistant: {answer[:_SUMMARY_ANSWER_CHARS]}" for question, answer in turns
+    )
+    prompt = f"""Update the summary of a conversation between a user and a document assistant.
+Keep what the user asked about, the answers given (with page numbers and values), and
+anything the user said they want. Drop greetings and repetition. At most 150 words.
+
+Current summary:
+{summary or "(none yet)"}
+
+New turns:
+{conversation}
+
+Return only the updated summary:"""
+
+    #background work: queued behind every interactive question
+    async with _scheduler.slot(PRIORITY_BACKGROUND):
+        data = await get_ollama_client().chat(
+            {
+                "model":settings.ollama_model,
+                "messages":[{"role":"user","content":prompt}],
+                "stream":False,
+                "options":{"num_predict":settings.summary_max_tokens, "temperature":0.2}
+            },
+            call_type="summary"
+        )
+    return data.get("message", {}).get("content", "").strip()
+
+
+def llm_scheduler_stats() -> dict:
+    return _scheduler.stats()
         
 
 _embedding_semaphore = asyncio.Semaphore(10) # max 10 concurrent
@@ -1,43 +1,208 @@
 import io
+import re
+import mmap
+import time
+import asyncio
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncGenerator
+from concurrent.futures import ProcessPoolExecutor
 import pypdf # for plain text
 import pdfplumber # for tables
+from core.config import settings
 
 
+_pdf_pool = None
 
-def extract_content_by_page(file_bytes: bytes) -> list[dict]:
+#path construction operators (rect, line, curves) plus Do for xobjects
+_PATH_OPERATORS = re.compile(rb"(?:^|\s)(?:re|l|c|v|y|Do)(?=[\s/\[(<%]|$)")
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    if _pdf_pool is None:
+        # spawn instead of fork so workers don't inherit the api's threads (chroma, onnx)
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=settings.pdf_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pdf_pool
+
+
+#sources are either the raw bytes or the path of the spooled upload
+def extract_content_by_page(source: str | bytes, stats: dict | None = None) -> list[dict]:
+    pages, range_stats = _extract_page_range(source, 0, None)
+    if stats is not None:
+        _merge_stats(stats, range_stats)
+    return pages
+
+
+def count_pages(source: str | bytes) -> int:
+    with _pdf_stream(source) as stream:
+        return len(pypdf.PdfReader(stream).pages)
+
+
+@contextmanager
+def _pdf_stream(source: str | bytes):
+    if isinstance(source, (bytes, bytearray)):
+        yield io.BytesIO(source)
+        return
+    #pypdf reads a path fully into memory; a read-only mmap leaves the bytes in the page cache
+    with open(source, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        yield buffer
+
+
+async def extract_content_parallel(
+        source: str | bytes,
+        workers: int | None = None,
+        stats: dict | None = None
+) -> list[dict]:
     pages = []
-    pdf_reader = pypdf.PdfReader(io.BytesIO(file_bytes))
-
-    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-        for page_num, (pypdf_page,plumber_page) in enumerate(
-            zip(pdf_reader.pages,pdf.pages), start=1
-        ):
-            #plain text via pypdf
-            text= pypdf_page.extract_text() or ""
-
-            #tables via pdfplumber > convert to markdown
-            tables_markdown = ""
-            tables = plumber_page.extract_tables()
-            for table in tables:
-                #convert tables to markdown
-                tables_markdown += _table_to_markdown(table) + "\n\n"
-
-            combined = text.strip()
-            if tables_markdown:
-            #merges plain text and markdown tables into one string
-            #double newline separates them cleanly
-                combined += "\n\n" + tables_markdown.strip()
-            #only pages that have content
-            if combined.strip():
-                pages.append(
-                    {
-                        "text":combined,
-                        "page_number":page_num
-                    }
-                )
-    
+    async for batch in iter_page_batches(source, workers, stats):
+        pages.extend(batch)
     return pages
 
+
+async def iter_page_batches(
+        source: str | bytes,
+        workers: int | None = None,
+        stats: dict | None = None
+) -> AsyncGenerator[list[dict], None]:
+    workers = workers or settings.pdf_workers
+    total_pages = await asyncio.to_thread(count_pages, source)
+    ranges = _split_page_range(total_pages, workers, settings.pdf_range_pages)
+
+    #small documents are not worth the round trip to the pool
+    if workers <= 1 or total_pages < settings.pdf_parallel_min_pages:
+        for start, end in ranges:
+            range_pages, range_stats = await asyncio.to_thread(_extract_page_range, source, start, end)
+            if stats is not None:
+                _merge_stats(stats, range_stats)
+            yield range_pages
+        return
+
+    loop = asyncio.get_running_loop()
+    pool = get_pdf_pool()
+    pending = deque()
+    try:
+        for start, end in ranges:
+            #a path is cheap to send to the pool, bytes get pickled per range
+            pending.append(loop.run_in_executor(pool, _extract_page_range, source, start, end))
+            #at most one range per worker in flight, a slow consumer holds back extraction
+            if len(pending) < workers:
+                continue
+            yield await _collect_range(pending.popleft(), stats)
+
+        #ranges are awaited in submission order, so pages stay in document order
+        while pending:
+            yield await _collect_range(pending.popleft(), stats)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def _collect_range(future, stats: dict | None) -> list[dict]:
+    range_pages, range_stats = await future
+    if stats is not None:
+        _merge_stats(stats, range_stats)
+    return range_pages
+
+
+def describe_table_stats(stats: dict) -> str:
+    skipped = stats.get("table_pass_skipped", 0)
+    total = stats.get("pages", 0)
+    ran = total - skipped
+    if not ran:
+        return f"Table pass skipped on {skipped}/{total} pages"
+
+    #estimate: skipped pages would have cost the average of the pages that ran
+    avg_table_seconds = stats.get("table_pass_seconds", 0.0) / ran
+    saved = skipped * avg_table_seconds - stats.get("precheck_seconds", 0.0)
+    return f"Table pass skipped on {skipped}/{total} pages (~{max(saved, 0.0):.1f}s saved)"
+
+
+def _split_page_range(total_pages: int, workers: int, max_pages: int) -> list[tuple[int, int]]:
+    #contiguous ranges, so each worker only parses the pages it owns.
+    #capped so a range's pages are never more than a bounded slice of the document
+    size = max(1, min(-(-total_pages // workers), max_pages))
+    return [(start, min(start + size, total_pages)) for start in range(0, total_pages, size)]
+
+
+def _merge_stats(into: dict, stats: dict):
+    for key, value in stats.items():
+        into[key] = into.get(key, 0) + value
+
+
+def _extract_page_range(source: str | bytes, start: int, end: int | None) -> tuple[list[dict], dict]:
+    pages = []
+    stats = {"pages": 0, "table_pass_skipped": 0, "table_pass_seconds": 0.0, "precheck_seconds": 0.0}
+    plumber_source = source if isinstance(source, str) else io.BytesIO(source)
+
+    with _pdf_stream(source) as stream:
+        pdf_reader = pypdf.PdfReader(stream)
+        if end is None:
+            end = len(pdf_reader.pages)
+
+        #pdfplumber only builds the pages we ask for (1-based)
+        with pdfplumber.open(plumber_source, pages=range(start + 1, end + 1)) as pdf:
+            for page_num, (pypdf_page,plumber_page) in enumerate(
+                zip(pdf_reader.pages[start:end],pdf.pages), start=start + 1
+            ):
+                combined = _extract_page(pypdf_page, plumber_page, stats)
+                #only pages that have content
+                if combined.strip():
+                    pages.append(
+                        {
+                            "text":combined,
+                            "page_number":page_num
+                        }
+                    )
+
+    return pages, stats
+
+
+def _extract_page(pypdf_page, plumber_page, stats: dict) -> str:
+    #plain text via pypdf
+    text= pypdf_page.extract_text() or ""
+    stats["pages"] += 1
+
+    started = time.perf_counter()
+    needs_table_pass = _may_contain_table(pypdf_page)
+    stats["precheck_seconds"] += time.perf_counter() - started
+
+    #tables via pdfplumber > convert to markdown
+    tables_markdown = ""
+    if needs_table_pass:
+        started = time.perf_counter()
+        tables = plumber_page.extract_tables()
+        stats["table_pass_seconds"] += time.perf_counter() - started
+        for table in tables:
+            #convert tables to markdown
+            tables_markdown += _table_to_markdown(table) + "\n\n"
+    else:
+        stats["table_pass_skipped"] += 1
+
+    combined = text.strip()
+    if tables_markdown:
+    #merges plain text and markdown tables into one string
+    #double newline separates them cleanly
+        combined += "\n\n" + tables_markdown.strip()
+    return combined
+
+
+def _may_contain_table(pypdf_page) -> bool:
+    #pdfplumber's default table finder builds cells from ruling lines, rects and curves.
+    #a page whose content stream draws no paths has no edges, so it can't have a table.
+    #anything we can't read (or form xobjects that may draw paths) falls back to the full pass
+    try:
+        contents = pypdf_page.get_contents()
+        if contents is None:
+            return False
+        data = contents.get_data()
+    except Exception:
+        return True
+    return _PATH_OPERATORS.search(data) is not None
+
 def _table_to_markdown(table: list[list]) -> str:
     if not table or not table[0]:
         return ""
@@ -0,0 +1,67 @@
+import logging
+import shutil
+from pathlib import Path
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+#every backend exposes predict(pairs, batch_size) -> scores, higher is more relevant.
+#the onnx and torch backends score on different scales (logits vs sigmoid), ranks agree
+
+
+class OnnxCrossEncoder:
+    def __init__(self, model_name: str, quantize: bool = False, threads: int | None = None):
+        from fastembed.rerank.cross_encoder import TextCrossEncoder
+
+        model_path = _quantized_model(model_name) if quantize else None
+        self.model = TextCrossEncoder(model_name, threads=threads, specific_model_path=model_path)
+
+    def predict(self, pairs: list[tuple[str, str]], batch_size: int = 64) -> list[float]:
+        return list(self.model.rerank_pairs(pairs, batch_size=batch_size))
+
+
+class TorchCrossEncoder:
+    def __init__(self, model_name: str):
+        #torch is only imported when this backend is selected
+        from sentence_transformers import CrossEncoder
+
+        # device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = CrossEncoder(model_name, device="cpu")
+
+    def predict(self, pairs: list[tuple[str, str]], batch_size: int = 64) -> list[float]:
+        return list(self.model.predict(pairs, batch_size=batch_size))
+
+
+def load_reranker(model_name: str | None = None):
+    model_name = model_name or settings.reranker_model
+    backend = settings.reranker_backend
+    if backend == "onnx":
+        return OnnxCrossEncoder(model_name, settings.reranker_quantize, settings.reranker_threads)
+    if backend == "torch":
+        return TorchCrossEncoder(model_name)
+    raise ValueError(f"Unknown reranker backend: {backend}")
+
+
+def _quantized_model(model_name: str) -> str | None:
+    #dynamic int8 copy of fastembed's onnx export, built once next to the other caches
+    from fastembed.rerank.cross_encoder import TextCrossEncoder
+
+    target = Path(settings.reranker_cache_dir) / f"{model_name.replace('/', '--')}-int8"
+    description = next(m for m in TextCrossEncoder.list_supported_models() if m["model"] == model_name)
+    model_file = description["model_file"]
+    if (target / model_file).exists():
+        return str(target)
+
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        #onnxruntime's quantization tools need the onnx package, which fastembed doesn't install
+        logger.warning("onnx is not installed, running the reranker without int8 quantization")
+        return None
+
+    source = Path(TextCrossEncoder(model_name, lazy_load=True).model._model_dir)
+    shutil.copytree(source, target, ignore=shutil.ignore_patterns("*.onnx", "*.onnx_data"), dirs_exist_ok=True)
+    (target / model_file).parent.mkdir(parents=True, exist_ok=True)
+    logger.info("quantizing %s to int8 in %s", model_name, target)
+    quantize_dynamic(str(source / model_file), str(target / model_file), weight_type=QuantType.QInt8)
+    return str(target)
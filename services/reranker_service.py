@@ -1,33 +1,105 @@
-from sentence_transformers import CrossEncoder
-import torch
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from core.config import settings
+from services.batcher import MicroBatcher
+from services.reranker_backends import load_reranker
 
 
-_model = None
+#"final" is bge-reranker-base, "first" the optional cheap cascade stage (e.g. MiniLM)
+_models = {}
+_rerank_executor = None
+_rerank_batchers: dict[str, MicroBatcher] = {}
 
-def get_reranker():
-    global _model
-    if _model is None:
-        # device = "cuda" if torch.cuda.is_available() else "cpu"
-        # _model = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2",device=device)
-        _model = CrossEncoder("BAAI/bge-reranker-base", device="cpu")
-    return _model
+#running cost per scored pair, used to estimate what the rerank policy saves
+_pair_timing = {}
+_pair_timing_lock = threading.Lock()
+
+def get_reranker(stage: str = "final"):
+    if stage not in _models:
+        #RERANKER_BACKEND picks onnx runtime (optionally int8) or the torch CrossEncoder
+        model_name = settings.reranker_first_stage_model if stage == "first" else settings.reranker_model
+        _models[stage] = load_reranker(model_name)
+    return _models[stage]
+
+
+def get_rerank_executor() -> ThreadPoolExecutor:
+    global _rerank_executor
+    if _rerank_executor is None:
+        #one thread owns the models, forward passes never run on the event loop
+        _rerank_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+    return _rerank_executor
 
 
 def rerank(question:str, chunks: list[dict], top_k: int = 4) -> list[dict]:
     if not chunks:
         return chunks
-    
-    reranker = get_reranker()
-    pairs = [(question,chunk["text"])for chunk in chunks]
-    scores = reranker.predict(pairs)
+    return _rerank_many([(question, chunks, top_k)])[0]
+
+
+async def rerank_async(question: str, chunks: list[dict], top_k: int = 4, stage: str = "final") -> list[dict]:
+    if not chunks:
+        return chunks
+    return await _get_rerank_batcher(stage).submit((question, chunks, top_k))
+
+
+def rerank_batcher_stats(stage: str = "final") -> dict:
+    batcher = _rerank_batchers.get(stage)
+    return batcher.stats() if batcher else {"batches":0, "items":0, "avg_batch_size":0.0}
+
+
+def seconds_per_pair(stage: str = "final") -> float | None:
+    with _pair_timing_lock:
+        pairs, seconds = _pair_timing.get(stage, (0, 0.0))
+    return seconds / pairs if pairs else None
+
 
-    scored_chunks = list(zip(scores, chunks))
-    scored_chunks.sort(key=lambda x: x[0],reverse=True)
+def _get_rerank_batcher(stage: str) -> MicroBatcher:
+    if stage not in _rerank_batchers:
+        _rerank_batchers[stage] = MicroBatcher(
+            partial(_rerank_many, stage=stage),
+            max_batch_size=settings.rerank_max_requests,
+            max_wait_ms=settings.rerank_batch_window_ms,
+            executor=get_rerank_executor()
+        )
+    return _rerank_batchers[stage]
 
-    return [chunk for _, chunk in scored_chunks[:top_k]]
 
+def _rerank_many(requests: list[tuple[str, list[dict], int]], stage: str = "final") -> list[list[dict]]:
+    #pairs from every request go through the model together
+    pairs = []
+    owners = []
+    for request_index, (question, chunks, _) in enumerate(requests):
+        for chunk_index, chunk in enumerate(chunks):
+            pairs.append((question, chunk["text"]))
+            owners.append((request_index, chunk_index))
+    if not pairs:
+        return [[] for _ in requests]
 
+    #similar lengths end up in the same padded batch, so less padding is wasted
+    order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+    started = time.perf_counter()
+    sorted_scores = get_reranker(stage).predict(
+        [pairs[i] for i in order],
+        batch_size=settings.rerank_batch_size
+    )
+    _record_timing(stage, len(pairs), time.perf_counter() - started)
 
+    scores = [[0.0] * len(chunks) for _, chunks, _ in requests]
+    for position, score in zip(order, sorted_scores):
+        request_index, chunk_index = owners[position]
+        scores[request_index][chunk_index] = float(score)
 
+    results = []
+    for (_, chunks, top_k), chunk_scores in zip(requests, scores):
+        scored_chunks = list(zip(chunk_scores, chunks))
+        scored_chunks.sort(key=lambda x: x[0],reverse=True)
+        results.append([chunk for _, chunk in scored_chunks[:top_k]])
+    return results
 
 
+def _record_timing(stage: str, pairs: int, seconds: float):
+    with _pair_timing_lock:
+        total_pairs, total_seconds = _pair_timing.get(stage, (0, 0.0))
+        _pair_timing[stage] = (total_pairs + pairs, total_seconds + seconds)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from core.config import settings
+from services.chroma_service import query
+from services.reranker_service import rerank_async, seconds_per_pair
+
+logger = logging.getLogger(__name__)
+
+
+#/ask used to fetch 10 candidates and cross-encode all of them, savings are measured against that
+_BASELINE_CANDIDATES = 10
+
+_stats = {"skip":0, "cascade":0, "full":0, "estimated_seconds_saved":0.0}
+_stats_lock = threading.Lock()
+
+
+def candidate_depth(corpus_chunks: int, top_k: int) -> int:
+    #grows with the corpus, a user with a handful of chunks gets all of them
+    depth = top_k + int(math.sqrt(corpus_chunks))
+    depth = max(settings.rerank_min_candidates, min(settings.rerank_max_candidates, depth))
+    return min(depth, corpus_chunks)
+
+
+def trim_candidates(chunks: list[dict], top_k: int) -> list[dict]:
+    #hits far behind the best one never win the rerank, don't pay to score them.
+    #keyword hits stay: they are the ones the embedding is expected to misjudge
+    if len(chunks) <= top_k:
+        return chunks
+    cutoff = min(chunk["distance"] for chunk in chunks) + settings.rerank_distance_margin
+    return [
+        chunk for i, chunk in enumerate(chunks)
+        if i < top_k or chunk["distance"] <= cutoff or chunk.get("lexical")
+    ]
+
+
+def plan_rerank(chunks: list[dict], top_k: int) -> tuple[str, float | None]:
+    #"skip": retrieval order is kept, "cascade": cheap model narrows first, "full": bge on everything
+    if len(chunks) <= top_k:
+        return "skip", None
+    #a clear gap after the k-th nearest hit means the top k are already decided,
+    #as long as keyword fusion agrees on which chunks those are
+    by_distance = sorted(range(len(chunks)), key=lambda i: chunks[i]["distance"])
+    gap = chunks[by_distance[top_k]]["distance"] - chunks[by_distance[top_k - 1]]["distance"]
+    if gap >= settings.rerank_skip_gap and set(by_distance[:top_k]) == set(range(top_k)):
+        return "skip", gap
+    if settings.reranker_first_stage_model and len(chunks) > settings.rerank_cascade_keep:
+        return "cascade", gap
+    return "full", gap
+
+
+async def retrieve(question: str, embedding: list[float], user_id: int, corpus_chunks: int, top_k: int) -> list[dict]:
+    #corpus_chunks comes from the document catalog
+    depth = candidate_depth(corpus_chunks, top_k)
+    if not depth:
+        return []
+
+    fetched = await asyncio.to_thread(query, embedding, user_id, n_results=depth, question=question)
+    chunks = trim_candidates(fetched, top_k)
+    action, gap = plan_rerank(chunks, top_k)
+
+    started = time.perf_counter()
+    if action == "skip":
+        result = chunks[:top_k]
+    else:
+        if action == "cascade":
+            chunks = await rerank_async(question, chunks, top_k=settings.rerank_cascade_keep, stage="first")
+        result = await rerank_async(question, chunks, top_k=top_k)
+    rerank_seconds = time.perf_counter() - started
+
+    saved = _estimate_saved(rerank_seconds)
+    _record(action, saved)
+    logger.info(
+        "rerank policy: user=%s corpus=%s depth=%s fetched=%s kept=%s action=%s gap=%s rerank=%.0fms saved~%s",
+        user_id, corpus_chunks, depth, len(fetched), len(chunks), action,
+        f"{gap:.3f}" if gap is not None else "-",
+        rerank_seconds * 1000,
+        f"{saved * 1000:.0f}ms" if saved is not None else "unknown"
+    )
+    return result
+
+
+def retrieval_policy_stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _estimate_saved(rerank_seconds: float) -> float | None:
+    #what cross-encoding the old 10 candidates would have cost, minus what we spent
+    per_pair = seconds_per_pair("final")
+    if per_pair is None:
+        return None
+    return _BASELINE_CANDIDATES * per_pair - rerank_seconds
+
+
+def _record(action: str, saved: float | None):
+    with _stats_lock:
+        _stats[action] += 1
+        if saved is not None:
+            _stats["estimated_seconds_saved"] += saved
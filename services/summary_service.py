@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import httpx
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from core.config import settings
+from core.database import AsyncSessionLocal
+from models.user import Conversation, ConversationSummary
+from services.llm_scheduler import SchedulerBusy
+from services.ollama_service import summarize_conversation
+
+logger = logging.getLogger(__name__)
+
+
+#turns folded per update, a backlog (summaries failing for a while) catches up over a few turns
+_FOLD_BATCH = 10
+
+#one update at a time per user, a second one would fold the same turns again
+_locks: dict[int, asyncio.Lock] = {}
+
+#running updates, referenced so they aren't garbage collected mid-flight
+_tasks = set()
+
+
+#instead of replaying the last 10 question/answer pairs, the prompt carries a rolling
+#summary of the conversation plus the turns that aren't folded into it yet. after each
+#turn everything but the latest SUMMARY_RAW_TURNS is folded in, in the background
+
+
+async def load_history(db: AsyncSession, user_id: int) -> list[dict]:
+    #chat messages for the prompt: the summary as its own message, then the raw turns
+    #newer than it. the summary changes every turn, so it sits after the system prompt
+    #instead of inside it, which keeps the instructions and facts a stable cached prefix
+    summary = await _get_summary(db, user_id)
+    folded = summary.last_conversation_id if summary else 0
+    result = await db.execute(
+        select(Conversation)
+        .where(Conversation.user_id==user_id, Conversation.id > folded)
+        .order_by(Conversation.id.desc())
+        .limit(settings.summary_raw_turns)
+    )
+    history = []
+    if summary and summary.summary:
+        history.append({"role":"system","content":f"Summary of the earlier conversation:\n{summary.summary}"})
+    for conv in reversed(result.scalars().all()):
+        history.append({"role":"user","content":conv.question})
+        history.append({"role":"assistant","content":conv.answer})
+    return history
+
+
+def schedule_summary_update(user_id: int):
+    if not settings.conversation_summary:
+        return
+    task = asyncio.create_task(_update_logged(user_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def update_summary(user_id: int) -> bool:
+    #True when turns were folded in. the session is closed while the model runs,
+    #so a slow summary doesn't hold a pooled connection
+    async with _locks.setdefault(user_id, asyncio.Lock()):
+        async with AsyncSessionLocal() as db:
+            summary = await _get_summary(db, user_id)
+            current = summary.summary if summary else ""
+            folded = summary.last_conversation_id if summary else 0
+            result = await db.execute(
+                select(Conversation)
+                .where(Conversation.user_id==user_id, Conversation.id > folded)
+                .order_by(Conversation.id)
+            )
+            pending = result.scalars().all()
+
+        to_fold = pending[:max(0, len(pending) - settings.summary_raw_turns)][:_FOLD_BATCH]
+        if not to_fold:
+            return False
+        updated = await summarize_conversation(current, [(conv.question, conv.answer) for conv in to_fold])
+        if not updated:
+            return False
+
+        async with AsyncSessionLocal() as db:
+            summary = await _get_summary(db, user_id)
+            if (summary.last_conversation_id if summary else 0) != folded:
+                #another api process got there first
+                return False
+            if summary is None:
+                summary = ConversationSummary(user_id=user_id)
+                db.add(summary)
+            summary.summary = updated
+            summary.last_conversation_id = to_fold[-1].id
+            try:
+                await db.commit()
+            except IntegrityError:
+                return False
+        logger.info("conversation summary for user %s: folded %s turns", user_id, len(to_fold))
+        return True
+
+
+async def _get_summary(db: AsyncSession, user_id: int) -> ConversationSummary | None:
+    result = await db.execute(select(ConversationSummary).where(ConversationSummary.user_id==user_id))
+    return result.scalar_one_or_none()
+
+
+async def _update_logged(user_id: int):
+    try:
+        await update_summary(user_id)
+    except (SchedulerBusy, httpx.HTTPError) as e:
+        #the turns are folded after the next question, until then only the newest are replayed
+        logger.warning("conversation summary for user %s not updated (%s)", user_id, type(e).__name__)
+    except Exception:
+        logger.exception("conversation summary for user %s failed", user_id)
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+#runs before the app modules are imported: chroma, the lexical and compact indexes and
+#the embedding cache all write under these paths, keep them out of the working tree
+_data_dir = tempfile.mkdtemp(prefix="rag-tests-")
+os.environ.setdefault("CHROMA_PATH", os.path.join(_data_dir, "chroma_db"))
+os.environ.setdefault("EMBEDDING_CACHE_PATH", os.path.join(_data_dir, "embedding_cache", "embeddings.sqlite3"))
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_data_dir, "uploads"))
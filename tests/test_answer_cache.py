@@ -0,0 +1,148 @@
+import asyncio
+import pytest
+from services.answer_cache import AnswerCache, normalize_question, question_identifiers, context_key
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_compute(result="answer"):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return result
+    return compute, calls
+
+
+def test_exact_hit_after_normalizing():
+    cache = AnswerCache(10, 60, similarity=0)
+    compute, calls = make_compute()
+
+    async def scenario():
+        await cache.get_or_compute(1, "v1", "ctx", "What is the max pressure?", [1.0, 0.0], compute)
+        return await cache.get_or_compute(1, "v1", "ctx", "  what is the MAX pressure ", [1.0, 0.0], compute)
+
+    assert run(scenario()) == "answer"
+    assert len(calls) == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_different_facts_never_share_answers():
+    cache = AnswerCache(10, 60, similarity=0)
+    compute, calls = make_compute()
+
+    async def scenario():
+        await asyncio.gather(
+            cache.get_or_compute(1, "v1", context_key(""), "q", [1.0], compute),
+            cache.get_or_compute(1, "v1", context_key("- likes metric units"), "q", [1.0], compute),
+        )
+
+    run(scenario())
+    assert len(calls) == 2
+
+
+def test_near_duplicates_off_by_default_setting():
+    cache = AnswerCache(10, 60, similarity=0)
+    compute, calls = make_compute()
+
+    async def scenario():
+        await cache.get_or_compute(1, "v1", "ctx", "max operating pressure?", [1.0, 0.0], compute)
+        await cache.get_or_compute(1, "v1", "ctx", "maximum operating pressure", [1.0, 0.0], compute)
+
+    run(scenario())
+    assert len(calls) == 2
+
+
+def test_near_duplicate_hit_within_scope():
+    cache = AnswerCache(10, 60, similarity=0.95)
+    compute, calls = make_compute()
+
+    async def scenario():
+        await cache.get_or_compute(1, "v1", "ctx", "max operating pressure?", [1.0, 0.0], compute)
+        await cache.get_or_compute(1, "v1", "ctx", "maximum operating pressure", [0.99, 0.05], compute)
+        #other user and other corpus version never share answers
+        await cache.get_or_compute(2, "v1", "ctx", "maximum operating pressure", [0.99, 0.05], compute)
+        await cache.get_or_compute(1, "v2", "ctx", "maximum operating pressure", [0.99, 0.05], compute)
+        #unrelated question
+        await cache.get_or_compute(1, "v1", "ctx", "who wrote this?", [0.0, 1.0], compute)
+
+    run(scenario())
+    assert len(calls) == 4
+    assert cache.stats()["near_hits"] == 1
+
+
+def test_near_duplicate_requires_same_identifiers():
+    cache = AnswerCache(10, 60, similarity=0.9)
+    compute, calls = make_compute()
+
+    async def scenario():
+        await cache.get_or_compute(1, "v1", "ctx", "max pressure of PV-204?", [1.0, 0.0], compute)
+        #embeds almost identically, but asks about another part
+        await cache.get_or_compute(1, "v1", "ctx", "max pressure of PV-205?", [0.999, 0.01], compute)
+        await cache.get_or_compute(1, "v1", "ctx", "maximum pressure for PV-204", [0.999, 0.01], compute)
+
+    run(scenario())
+    assert len(calls) == 2
+    assert cache.stats()["near_hits"] == 1
+
+
+def test_concurrent_questions_share_one_generation():
+    cache = AnswerCache(10, 60, similarity=0)
+    compute, calls = make_compute()
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_compute(1, "v1", "ctx", "q", [1.0], compute) for _ in range(5)))
+
+    assert run(scenario()) == ["answer"] * 5
+    assert len(calls) == 1
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_failures_are_not_cached():
+    cache = AnswerCache(10, 60, similarity=0)
+
+    async def failing():
+        raise RuntimeError("ollama down")
+
+    compute, calls = make_compute()
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await cache.get_or_compute(1, "v1", "ctx", "q", [1.0], failing)
+        return await cache.get_or_compute(1, "v1", "ctx", "q", [1.0], compute)
+
+    assert run(scenario()) == "answer"
+    assert len(calls) == 1
+
+
+def test_ttl_and_lru_eviction():
+    cache = AnswerCache(2, 60, similarity=0)
+    compute, calls = make_compute()
+
+    async def scenario():
+        for question in ("a", "b", "c"):
+            await cache.get_or_compute(1, "v1", "ctx", question, [1.0], compute)
+        #"a" was the least recently used
+        await cache.get_or_compute(1, "v1", "ctx", "a", [1.0], compute)
+
+    run(scenario())
+    assert len(calls) == 4
+    assert cache.stats()["size"] == 2
+
+    cache = AnswerCache(10, 0.05, similarity=0)
+
+    async def expired():
+        await cache.get_or_compute(1, "v1", "ctx", "a", [1.0], compute)
+        await asyncio.sleep(0.1)
+        await cache.get_or_compute(1, "v1", "ctx", "a", [1.0], compute)
+
+    run(expired())
+    assert len(calls) == 6
+
+
+def test_normalize_question():
+    assert normalize_question("  What  is IT? ") == "what is it"
+    assert question_identifiers("Is PV-204 rated per clause 4.2.1.?") == {"pv-204", "4.2.1"}
@@ -0,0 +1,48 @@
+import asyncio
+from services.batcher import MicroBatcher
+
+
+def test_concurrent_requests_share_one_batch():
+    calls = []
+
+    def handler(items):
+        calls.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(handler, max_batch_size=10, max_wait_ms=20)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8]
+    assert calls == [[0, 1, 2, 3, 4]]
+    assert batcher.stats()["avg_batch_size"] == 5
+
+
+def test_batch_flushes_at_max_size():
+    calls = []
+
+    def handler(items):
+        calls.append(len(items))
+        return items
+
+    batcher = MicroBatcher(handler, max_batch_size=2, max_wait_ms=1000)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(i) for i in range(4)))
+
+    assert asyncio.run(run()) == [0, 1, 2, 3]
+    assert calls == [2, 2]
+
+
+def test_handler_error_reaches_every_caller():
+    def handler(items):
+        raise RuntimeError("model failed")
+
+    batcher = MicroBatcher(handler, max_batch_size=10, max_wait_ms=1)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
@@ -0,0 +1,75 @@
+import asyncio
+from unittest.mock import patch
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from core.database import Base
+import models.user # registers users for the foreign keys
+from services import catalog_service
+
+
+def run_with_catalog(scenario):
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+        with patch.object(catalog_service, "AsyncSessionLocal", sessions):
+            async with sessions() as db:
+                return await scenario(db)
+    return asyncio.run(run())
+
+
+def test_record_list_and_count():
+    async def scenario(db):
+        await catalog_service.record_document(1, "b.pdf", 10, 3, 2048, "h1")
+        await catalog_service.record_document(1, "a.pdf", 5, 2, 1024, "h2")
+        await catalog_service.record_document(2, "c.pdf", 7, 1, 512, "h3")
+        #re-ingest updates the existing row
+        await catalog_service.record_document(1, "b.pdf", 12, 4, 4096, "h4")
+
+        documents = await catalog_service.list_documents(db, 1)
+        assert [d.filename for d in documents] == ["a.pdf", "b.pdf"]
+        assert (documents[1].chunk_count, documents[1].page_count, documents[1].file_hash) == (12, 4, "h4")
+        assert (await catalog_service.corpus_state(db, 1))[0] == 17
+        assert (await catalog_service.corpus_state(db, 3))[0] == 0
+
+    run_with_catalog(scenario)
+
+
+def test_remove_and_clear():
+    async def scenario(db):
+        await catalog_service.record_document(1, "a.pdf", 5, 2, 1024, "h1")
+        await catalog_service.record_document(1, "b.pdf", 5, 2, 1024, "h2")
+        await catalog_service.record_document(2, "a.pdf", 5, 2, 1024, "h1")
+
+        await catalog_service.remove_document(db, 1, "a.pdf")
+        assert [d.filename for d in await catalog_service.list_documents(db, 1)] == ["b.pdf"]
+
+        await catalog_service.clear_documents(db, 1)
+        assert await catalog_service.list_documents(db, 1) == []
+        assert (await catalog_service.corpus_state(db, 2))[0] == 5
+
+    run_with_catalog(scenario)
+
+
+def test_backfill_only_when_catalog_empty():
+    stats = {(1, "a.pdf"): {"chunks":4, "pages":{1, 2}, "file_hash":"h1"}}
+
+    async def scenario(db):
+        with patch.object(catalog_service, "scan_document_stats", return_value=stats) as scan:
+            assert await catalog_service.backfill_catalog() == 1
+            assert await catalog_service.backfill_catalog() == 0
+        assert scan.call_count == 1
+        documents = await catalog_service.list_documents(db, 1)
+        assert (documents[0].chunk_count, documents[0].page_count) == (4, 2)
+
+    run_with_catalog(scenario)
+
+
+def test_is_recorded_matches_the_file_hash():
+    async def scenario(db):
+        await catalog_service.record_document(1, "a.pdf", 5, 2, 1024, "h1")
+        assert await catalog_service.is_recorded(1, "a.pdf", "h1")
+        assert not await catalog_service.is_recorded(1, "a.pdf", "h2")
+        assert not await catalog_service.is_recorded(2, "a.pdf", "h1")
+
+    run_with_catalog(scenario)
@@ -1,5 +1,19 @@
 import pytest
-from services.chroma_service import store_chunks, query, clear, has_documents
+from unittest.mock import patch
+from services.chroma_service import (
+    store_chunks,
+    query,
+    clear,
+    has_documents,
+    find_document_by_hash,
+    copy_document,
+    get_page_embeddings,
+    delete_document,
+    count_document_chunks,
+    shard_name,
+    get_collection,
+    migrate_to_shards
+)
 
 
 TEST_USER_ID = 9999
@@ -65,4 +79,131 @@ def test_user_isolation():
     embeddings = make_embeddings(1)
     store_chunks(chunks, embeddings, "test.pdf",TEST_USER_ID)
 
-    assert has_documents(8888) == False
\ No newline at end of file
+    assert has_documents(8888) == False
+
+
+def test_find_document_by_hash():
+    chunks = [{**chunk, "file_hash":"abc"} for chunk in make_chunks(1)]
+    store_chunks(chunks, make_embeddings(1), "test.pdf", TEST_USER_ID)
+    assert find_document_by_hash(TEST_USER_ID, "abc") == "test.pdf"
+    assert find_document_by_hash(TEST_USER_ID, "other") is None
+    assert find_document_by_hash(8888, "abc") is None
+
+
+def test_copy_document():
+    store_chunks(make_chunks(3), make_embeddings(3), "test.pdf", TEST_USER_ID)
+    copied = copy_document(TEST_USER_ID, "test.pdf", "copy.pdf", "abc")
+    assert copied == 3
+    assert find_document_by_hash(TEST_USER_ID, "abc") == "copy.pdf"
+
+
+def test_get_page_embeddings():
+    chunks = [{**chunk, "page_hash":"p1"} for chunk in make_chunks(2)]
+    store_chunks(chunks, make_embeddings(2), "test.pdf", TEST_USER_ID)
+    found = get_page_embeddings(TEST_USER_ID, ["p1", "p2"])
+    assert set(found) == {("p1", 0), ("p1", 1)}
+    assert get_page_embeddings(8888, ["p1"]) == {}
+
+
+def test_query_with_compact_index(tmp_path):
+    with patch("services.chroma_service.settings.vector_compression", "int8"), \
+         patch("services.chroma_service.settings.chroma_path", str(tmp_path)):
+        clear(TEST_USER_ID)
+        embeddings = [[0.1]*384, [0.1]*192 + [-0.1]*192]
+        store_chunks(make_chunks(2), embeddings, "test.pdf", TEST_USER_ID)
+        results = query([0.1]*192 + [-0.1]*192, TEST_USER_ID, n_results=1)
+        assert results[0]["text"] == "This is test chunk number 1"
+
+        assert delete_document(TEST_USER_ID, "test.pdf") == 2
+        assert query([0.1]*384, TEST_USER_ID, n_results=1) == []
+        clear(TEST_USER_ID)
+
+
+def test_query_reports_distance():
+    store_chunks(make_chunks(2), make_embeddings(2), "test.pdf", TEST_USER_ID)
+    results = query([0.1] * 384, TEST_USER_ID, n_results=2)
+    assert all(result["distance"] == pytest.approx(0.0, abs=1e-4) for result in results)
+    assert count_document_chunks(TEST_USER_ID, "test.pdf") == (2, 1)
+
+
+def test_shard_names():
+    with patch("services.chroma_service.settings.chroma_shard_mode", "user"):
+        assert shard_name(42) == "documents_u42"
+    with patch("services.chroma_service.settings.chroma_shard_mode", "bucket"), \
+         patch("services.chroma_service.settings.chroma_shard_buckets", 8):
+        assert shard_name(42) == "documents_b2"
+    with patch("services.chroma_service.settings.chroma_shard_mode", "none"):
+        assert shard_name(42) == "documents"
+
+
+def test_bucket_shards_keep_users_apart():
+    with patch("services.chroma_service.settings.chroma_shard_mode", "bucket"), \
+         patch("services.chroma_service.settings.chroma_shard_buckets", 1):
+        clear(TEST_USER_ID)
+        clear(8888)
+        store_chunks(make_chunks(1), make_embeddings(1), "test.pdf", TEST_USER_ID)
+        assert has_documents(TEST_USER_ID)
+        assert not has_documents(8888)
+        assert query([0.1] * 384, 8888, n_results=1) == []
+        clear(TEST_USER_ID)
+
+
+def test_migrate_legacy_collection_to_user_shards():
+    with patch("services.chroma_service.settings.chroma_shard_mode", "none"):
+        clear(TEST_USER_ID)
+        store_chunks(make_chunks(3), make_embeddings(3), "test.pdf", TEST_USER_ID)
+
+    with patch("services.chroma_service.settings.chroma_shard_mode", "user"):
+        assert not has_documents(TEST_USER_ID)
+        assert migrate_to_shards() >= 3
+        assert get_collection(TEST_USER_ID).count() == 3
+        assert query([0.1] * 384, TEST_USER_ID, n_results=1)[0]["filename"] == "test.pdf"
+        #keyword rows moved into the shard's own index with their chunks
+        assert query([0.1] * 384, TEST_USER_ID, n_results=1, question="chunk number 2")[0]["lexical"]
+        #nothing left to move
+        assert migrate_to_shards() == 0
+
+    with patch("services.chroma_service.settings.chroma_shard_mode", "none"):
+        assert not has_documents(TEST_USER_ID)
+
+
+def test_query_fuses_keyword_hits():
+    chunks = [
+        {"text":"General notes on valves", "page_number":1, "chunk_index":0},
+        {"text":"Valve PV-204 is rated to 16 bar", "page_number":2, "chunk_index":0},
+        {"text":"Inspection intervals", "page_number":3, "chunk_index":0},
+    ]
+    #the part number chunk is far from the query vector
+    embeddings = [[0.1]*384, [0.1]*192 + [-0.1]*192, [0.1]*383 + [0.0]]
+    store_chunks(chunks, embeddings, "test.pdf", TEST_USER_ID)
+
+    assert [c["page_number"] for c in query([0.1]*384, TEST_USER_ID, n_results=2)] == [1, 3]
+    results = query([0.1]*384, TEST_USER_ID, n_results=2, question="PV-204 rating")
+    assert [c["page_number"] for c in results] == [1, 2]
+    assert results[1]["lexical"] and not results[0]["lexical"]
+    #fetched outside the vector results, its distance is computed from the stored embedding
+    assert results[1]["distance"] == pytest.approx(7.68, abs=1e-3)
+
+    with patch("services.chroma_service.settings.lexical_search", False):
+        assert [c["page_number"] for c in query([0.1]*384, TEST_USER_ID, n_results=2, question="PV-204")] == [1, 3]
+
+
+def test_compact_index_backfills_existing_chunks(tmp_path):
+    from services import compact_index
+    from services.chroma_service import rebuild_compact_index
+    with patch("services.chroma_service.settings.chroma_path", str(tmp_path)):
+        clear(TEST_USER_ID)
+        embeddings = [[0.1]*384, [0.1]*192 + [-0.1]*192]
+        #stored while compression was off
+        store_chunks(make_chunks(2), embeddings, "test.pdf", TEST_USER_ID)
+
+        with patch("services.chroma_service.settings.vector_compression", "int8"):
+            #before the backfill, queries fall back to chroma instead of finding nothing
+            assert query([0.1]*192 + [-0.1]*192, TEST_USER_ID, n_results=1)[0]["text"] == "This is test chunk number 1"
+            assert not compact_index.compact_index_built()
+
+            assert rebuild_compact_index() >= 2
+            assert compact_index.compact_index_built()
+            assert len(compact_index.get_index(TEST_USER_ID)) == 2
+            assert compact_index.get_index(TEST_USER_ID).search([0.1]*192 + [-0.1]*192, 1, 2)[0][0].endswith("_1_page1")
+        clear(TEST_USER_ID)
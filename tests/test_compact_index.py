@@ -0,0 +1,162 @@
+import multiprocessing
+import numpy as np
+import pytest
+from services.compact_index import CompactIndex
+
+
+def make_vectors(n, dims=384, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(n, dims)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_top(vectors, query, k):
+    return list(np.argsort(-(vectors @ query))[:k])
+
+
+@pytest.mark.parametrize("compression,truncate_dims", [("int8", 0), ("binary", 0), ("int8", 128)])
+def test_search_matches_exact_top_hit(tmp_path, compression, truncate_dims):
+    vectors = make_vectors(500)
+    index = CompactIndex(tmp_path, compression, truncate_dims)
+    index.add([f"id{i}" for i in range(500)], vectors)
+
+    for row in (3, 42, 311):
+        #a slightly perturbed stored vector should find its source first
+        query = vectors[row] + make_vectors(1, seed=row)[0] * 0.05
+        query /= np.linalg.norm(query)
+        results = index.search(query, 5, rescore_factor=10)
+        assert results[0][0] == f"id{row}"
+        #rescoring returns exact cosine scores
+        assert results[0][1] == pytest.approx(float(vectors[row] @ query), abs=1e-5)
+
+
+def test_int8_recall_against_exact(tmp_path):
+    vectors = make_vectors(1000)
+    index = CompactIndex(tmp_path, "int8")
+    index.add([str(i) for i in range(1000)], vectors)
+
+    query = make_vectors(1, seed=7)[0]
+    expected = {str(i) for i in exact_top(vectors, query, 10)}
+    found = {chunk_id for chunk_id, _ in index.search(query, 10, rescore_factor=4)}
+    assert len(found & expected) >= 9
+
+
+def test_compact_codes_are_smaller(tmp_path):
+    vectors = make_vectors(100)
+    int8_index = CompactIndex(tmp_path / "int8", "int8")
+    int8_index.add([str(i) for i in range(100)], vectors)
+    binary_index = CompactIndex(tmp_path / "binary", "binary")
+    binary_index.add([str(i) for i in range(100)], vectors)
+
+    assert int8_index.memory_bytes() < vectors.nbytes / 3
+    assert binary_index.memory_bytes() == 100 * 384 // 8
+
+
+def test_remove_drops_rows(tmp_path):
+    vectors = make_vectors(10)
+    index = CompactIndex(tmp_path, "int8")
+    index.add([str(i) for i in range(10)], vectors)
+    index.remove(["3", "4"])
+
+    assert len(index) == 8
+    results = index.search(vectors[3], 10, rescore_factor=1)
+    assert "3" not in {chunk_id for chunk_id, _ in results}
+    #remaining rows keep their full vectors
+    assert index.search(vectors[5], 1, rescore_factor=1)[0][0] == "5"
+
+
+def test_append_after_interrupted_write_drops_orphan_rows(tmp_path):
+    vectors = make_vectors(6)
+    index = CompactIndex(tmp_path, "int8")
+    index.add([str(i) for i in range(3)], vectors[:3])
+    #a crash after the data files were written but before ids.txt was complete
+    with open(tmp_path / "full.f32", "ab") as fh:
+        fh.write(vectors[3:5].tobytes())
+    with open(tmp_path / "codes.bin", "ab") as fh:
+        fh.write(b"\x01" * 384 * 2)
+    with open(tmp_path / "scales.f32", "ab") as fh:
+        fh.write(np.ones(2, dtype=np.float32).tobytes())
+    with open(tmp_path / "ids.txt", "a") as fh:
+        fh.write("torn")
+
+    assert len(CompactIndex(tmp_path, "int8")) == 3
+    index.add(["5"], vectors[5:])
+
+    assert len(index) == 4
+    assert index.search(vectors[5], 1, rescore_factor=1)[0] == ("5", pytest.approx(1.0, abs=1e-5))
+    assert (tmp_path / "full.f32").stat().st_size == 4 * 384 * 4
+
+
+def test_reencodes_when_compression_changes(tmp_path):
+    vectors = make_vectors(50)
+    CompactIndex(tmp_path, "int8").add([str(i) for i in range(50)], vectors)
+
+    index = CompactIndex(tmp_path, "binary", 128)
+    assert index.memory_bytes() == 50 * 128 // 8
+    assert index.search(vectors[7], 1, rescore_factor=10)[0][0] == "7"
+
+
+def test_sees_rows_added_by_another_instance(tmp_path):
+    #the ingest worker and the api hold separate instances over the same files
+    vectors = make_vectors(20)
+    reader = CompactIndex(tmp_path, "int8")
+    assert reader.search(vectors[0], 1, rescore_factor=1) == []
+
+    CompactIndex(tmp_path, "int8").add([str(i) for i in range(20)], vectors)
+    assert reader.search(vectors[0], 1, rescore_factor=1)[0][0] == "0"
+
+
+def test_remove_tombstones_rows_until_compaction(tmp_path):
+    vectors = make_vectors(20)
+    index = CompactIndex(tmp_path, "int8")
+    index.add([str(i) for i in range(20)], vectors)
+    full_size = (tmp_path / "full.f32").stat().st_size
+
+    #a small delete only appends to the tombstone file
+    index.remove(["3"])
+    assert (tmp_path / "full.f32").stat().st_size == full_size
+    assert len(index) == 19
+    assert "3" not in {chunk_id for chunk_id, _ in index.search(vectors[3], 20, rescore_factor=1)}
+
+    #a re-ingested chunk keeps its id but gets a new row, which isn't tombstoned
+    index.add(["3"], vectors[3:4])
+    assert index.search(vectors[3], 1, rescore_factor=1)[0][0] == "3"
+
+    #past the threshold the files are rewritten with only the live rows
+    index.remove([str(i) for i in range(10)])
+    assert not (tmp_path / "deleted.u32").exists()
+    assert (tmp_path / "ids.txt").read_text().splitlines() == [str(i) for i in range(10, 20)]
+    assert index.search(vectors[15], 1, rescore_factor=1)[0][0] == "15"
+
+
+def test_another_instance_sees_tombstones(tmp_path):
+    vectors = make_vectors(20)
+    reader = CompactIndex(tmp_path, "int8")
+    CompactIndex(tmp_path, "int8").add([str(i) for i in range(20)], vectors)
+    assert reader.search(vectors[4], 1, rescore_factor=1)[0][0] == "4"
+
+    CompactIndex(tmp_path, "int8").remove(["4"])
+    assert reader.search(vectors[4], 1, rescore_factor=1)[0][0] != "4"
+
+
+def _add_from_process(directory, worker):
+    vectors = make_vectors(50, seed=worker)
+    index = CompactIndex(directory, "int8")
+    for start in range(0, 50, 5):
+        index.add([f"{worker}-{i}" for i in range(start, start + 5)], vectors[start:start + 5])
+
+
+def test_concurrent_writers_in_separate_processes(tmp_path):
+    #the api and the ingest worker write the same files; appends must not interleave
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_add_from_process, args=(tmp_path, worker)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    index = CompactIndex(tmp_path, "int8")
+    assert len(index) == 200
+    for worker in range(4):
+        vectors = make_vectors(50, seed=worker)
+        assert index.search(vectors[17], 1, rescore_factor=2)[0][0] == f"{worker}-17"
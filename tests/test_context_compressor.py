@@ -0,0 +1,68 @@
+import asyncio
+from unittest.mock import patch
+from services import context_compressor
+from services.context_compressor import compress_context, split_units
+
+
+def test_split_units_keeps_table_rows_with_their_header():
+    text = "Intro sentence. Second one!\n| part | torque |\n| --- | --- |\n| M8 | 25 Nm |\n| M10 | 49 Nm |\nAfter the table."
+    units = split_units(text)
+    assert [unit["text"] for unit in units] == [
+        "Intro sentence.",
+        "Second one!",
+        "| part | torque |\n| --- | --- |",
+        "| M8 | 25 Nm |",
+        "| M10 | 49 Nm |",
+        "After the table."
+    ]
+    assert units[3]["header"] == 2 and units[4]["header"] == 2
+    assert units[5]["header"] is None
+
+
+def fake_embeddings(relevant):
+    #unit vectors: [1, 0] for text containing a relevant word, [0, 1] otherwise
+    async def embed(texts):
+        return [[1.0, 0.0] if any(word in text for word in relevant) else [0.0, 1.0] for text in texts]
+    return embed
+
+
+def test_keeps_relevant_sentences_and_rows_within_budget():
+    filler = " ".join(f"Unrelated filler sentence number {i}." for i in range(20))
+    chunks = [
+        {"text":f"{filler} The relief valve opens at 16 bar. {filler}", "page_number":4, "filename":"spec.pdf"},
+        {"text":"| part | torque |\n| --- | --- |\n| M8 | 25 Nm |\n| valve cap | 40 Nm |", "page_number":7, "filename":"spec.pdf"}
+    ]
+
+    with patch.object(context_compressor, "get_sentence_embeddings", fake_embeddings(["valve"])):
+        compressed = asyncio.run(compress_context([1.0, 0.0], chunks, token_budget=20))
+
+    assert compressed[0]["text"] == "The relief valve opens at 16 bar."
+    assert compressed[0]["page_number"] == 4
+    #a kept row brings its header, the unrelated row is skipped
+    assert compressed[1]["text"] == "| part | torque |\n| --- | --- |\n...\n| valve cap | 40 Nm |"
+    #the caller's chunks, used as sources, are left alone
+    assert chunks[0]["text"].startswith("Unrelated")
+
+
+def test_every_chunk_keeps_its_best_sentence():
+    chunks = [
+        {"text":"Alpha one. Alpha two.", "page_number":1, "filename":"a.pdf"},
+        {"text":"Beta one. Beta two.", "page_number":2, "filename":"a.pdf"}
+    ]
+
+    with patch.object(context_compressor, "get_sentence_embeddings", fake_embeddings(["Alpha"])):
+        compressed = asyncio.run(compress_context([1.0, 0.0], chunks, token_budget=5))
+
+    assert [chunk["page_number"] for chunk in compressed] == [1, 2]
+    assert all(len(chunk["text"].split(". ")) == 1 for chunk in compressed)
+
+
+def test_context_within_budget_is_not_compressed():
+    chunks = [{"text":"Short.", "page_number":1, "filename":"a.pdf"}]
+
+    async def fail(texts):
+        raise AssertionError("nothing should be embedded")
+
+    with patch.object(context_compressor, "get_sentence_embeddings", fail):
+        assert asyncio.run(compress_context([1.0], chunks, token_budget=100)) is chunks
+        assert asyncio.run(compress_context([1.0], chunks * 50, token_budget=0)) == chunks * 50
@@ -0,0 +1,58 @@
+from services.context_packer import pack_context, context_packing_stats, estimate_tokens
+from services.pdf_service import chunk_text
+
+
+def page_chunks(text, page_number=1, filename="a.pdf"):
+    chunks = chunk_text([{"text":text, "page_number":page_number}], chunk_size=1000, overlap=200)
+    return [{**chunk, "filename":filename} for chunk in chunks]
+
+
+def test_adjacent_chunks_merge_without_the_overlap():
+    text = "".join(f"sentence {i}. " for i in range(250))
+    chunks = page_chunks(text)
+    assert len(chunks) >= 3
+
+    blocks = pack_context([chunks[1], chunks[0]], token_budget=0)
+    assert len(blocks) == 1
+    assert blocks[0]["text"] == text[:1800]
+    assert blocks[0]["chunks"] == 2
+
+
+def test_other_pages_and_gaps_stay_separate():
+    text = "".join(f"sentence {i}. " for i in range(250))
+    chunks = page_chunks(text)
+    other_page = page_chunks("other page text", page_number=2)[0]
+
+    blocks = pack_context([chunks[2], other_page, chunks[0]], token_budget=0)
+    #relevance order of the best chunk is kept
+    assert [(block["page_number"], block["chunk_index"]) for block in blocks] == [(1, 2), (2, 0), (1, 0)]
+
+
+def test_duplicate_chunks_are_sent_once():
+    chunk = page_chunks("some text on a page")[0]
+    blocks = pack_context([chunk, dict(chunk)], token_budget=0)
+    assert len(blocks) == 1
+    assert blocks[0]["text"] == "some text on a page"
+
+
+def test_budget_is_filled_in_relevance_order():
+    chunks = [page_chunks("x" * 800, page_number=page)[0] for page in range(1, 5)]
+    #room for two blocks and their headers
+    blocks = pack_context(chunks, token_budget=2 * estimate_tokens("x" * 800) + 30)
+    assert [block["page_number"] for block in blocks] == [1, 2]
+
+    #the best chunk is kept even when it alone is over budget
+    assert len(pack_context(chunks, token_budget=10)) == 1
+
+
+def test_savings_are_reported():
+    before = context_packing_stats()
+    text = "".join(f"sentence {i}. " for i in range(250))
+    chunks = page_chunks(text)[:2]
+    pack_context(chunks, token_budget=0)
+
+    after = context_packing_stats()
+    assert after["requests"] == before["requests"] + 1
+    assert after["merged"] == before["merged"] + 1
+    #the 200 repeated characters are no longer sent
+    assert after["saved_tokens"] - before["saved_tokens"] >= 50
@@ -0,0 +1,66 @@
+import itertools
+from unittest.mock import patch
+from services.embedding_cache import EmbeddingCache
+
+
+def make_cache(tmp_path, model="model-a", memory_entries=10, disk_entries=100):
+    return EmbeddingCache(str(tmp_path / "cache.sqlite3"), model, memory_entries, disk_entries)
+
+
+def test_miss_then_hit(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get_many(["hello"]) == [None]
+    cache.put_many(["hello"], [[0.5, 0.25]])
+    assert cache.get_many(["hello", "other"]) == [[0.5, 0.25], None]
+    stats = cache.stats()
+    assert stats["memory_hits"] == 1
+    assert stats["misses"] == 2
+
+
+def test_key_normalizes_whitespace(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_many(["max  operating\npressure "], [[1.0]])
+    assert cache.get_many(["max operating pressure"]) == [[1.0]]
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    make_cache(tmp_path).put_many(["hello"], [[0.5]])
+    cache = make_cache(tmp_path)
+    assert cache.get_many(["hello"]) == [[0.5]]
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_model_change_invalidates(tmp_path):
+    make_cache(tmp_path, model="model-a").put_many(["hello"], [[0.5]])
+    cache = make_cache(tmp_path, model="model-b")
+    assert cache.get_many(["hello"]) == [None]
+    assert cache.stats()["disk_size"] == 0
+
+
+def test_memory_lru_eviction(tmp_path):
+    cache = make_cache(tmp_path, memory_entries=2)
+    cache.put_many(["a", "b", "c"], [[1.0], [2.0], [3.0]])
+    assert cache.stats()["memory_size"] == 2
+    #evicted from memory, still served from disk
+    assert cache.get_many(["a"]) == [[1.0]]
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_size_limit(tmp_path):
+    cache = make_cache(tmp_path, disk_entries=10)
+    cache.put_many([str(i) for i in range(25)], [[float(i)] for i in range(25)])
+    assert cache.stats()["disk_size"] <= 10
+
+
+def test_disk_hits_keep_entries_from_eviction(tmp_path):
+    clock = itertools.count()
+    with patch("services.embedding_cache.time.time", side_effect=lambda: float(next(clock))):
+        cache = make_cache(tmp_path, memory_entries=1, disk_entries=10)
+        cache.put_many(["old"], [[0.0]])
+        cache.put_many([f"a{i}" for i in range(9)], [[1.0]] * 9)
+        #served from disk, its last_used is written with the next insert
+        assert cache.get_many(["old"]) == [[0.0]]
+        cache.put_many([f"b{i}" for i in range(5)], [[2.0]] * 5)
+
+    assert cache.get_many(["old"]) == [[0.0]]
+    assert cache.stats()["disk_size"] == 9
@@ -0,0 +1,24 @@
+from unittest.mock import patch
+from services.embedding_engine import ThroughputMeter, embed_options, get_query_executor, get_bulk_executor
+
+
+def test_throughput_meter():
+    meter = ThroughputMeter("test")
+    meter.record(100, 2.0)
+    meter.record(50, 0.5)
+    stats = meter.stats()
+    assert stats["chunks"] == 150
+    assert stats["chunks_per_sec"] == 60.0
+    assert stats["last_chunks_per_sec"] == 100.0
+
+
+def test_embed_options_from_settings():
+    with patch("services.embedding_engine.settings.embed_batch_size", 64), \
+         patch("services.embedding_engine.settings.embed_parallel", None):
+        assert embed_options() == {"batch_size":64}
+    with patch("services.embedding_engine.settings.embed_parallel", 0):
+        assert embed_options()["parallel"] == 0
+
+
+def test_query_and_bulk_pools_are_separate():
+    assert get_query_executor() is not get_bulk_executor()
@@ -0,0 +1,174 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock
+from services import ingest_service
+from services.ingest_service import _produce_chunk_batches, _consume_chunk_batches, page_hash
+from tests.test_pdf_service import make_pdf
+
+
+def fake_store(chunks, embeddings, filename, user_id):
+    return len(chunks)
+
+
+async def run_pipeline(pdf: bytes) -> tuple[int, int, int]:
+    queue = asyncio.Queue(maxsize=1)
+    producer = asyncio.create_task(_produce_chunk_batches(pdf, queue, {}, "filehash"))
+    stored, pages_reused = await _consume_chunk_batches(queue, "test.pdf", 9999, "task")
+    return await producer, stored, pages_reused
+
+
+def test_pipeline_stores_in_fixed_size_batches():
+    pdf = make_pdf([f"page {i}" for i in range(1, 6)])
+    embed = AsyncMock(side_effect=lambda texts: [[0.1] * 384 for _ in texts])
+
+    with patch.object(ingest_service, "get_embeddings_batch", embed), \
+         patch.object(ingest_service, "store_chunks", side_effect=fake_store) as store, \
+         patch.object(ingest_service, "update_progress", new_callable=AsyncMock) as progress, \
+         patch.object(ingest_service.settings, "ingest_batch_size", 2):
+        pages, stored, pages_reused = asyncio.run(run_pipeline(pdf))
+
+    assert pages == 5
+    assert stored == 5
+    assert [len(call.args[0]) for call in store.call_args_list] == [2, 2, 1]
+    assert progress.call_count == 3
+    assert pages_reused == 0
+
+
+def test_pipeline_empty_pdf_stores_nothing():
+    pdf = make_pdf([""])
+    with patch.object(ingest_service, "store_chunks", side_effect=fake_store) as store, \
+         patch.object(ingest_service, "update_progress", new_callable=AsyncMock):
+        pages, stored, pages_reused = asyncio.run(run_pipeline(pdf))
+
+    assert pages == 0
+    assert stored == 0
+    store.assert_not_called()
+
+
+def test_pipeline_reuses_embeddings_of_known_pages():
+    pdf = make_pdf(["page 1", "page 2", "page 3"])
+    known = {(page_hash("page 2"), 0): [0.5] * 384}
+    embed = AsyncMock(side_effect=lambda texts: [[0.1] * 384 for _ in texts])
+
+    with patch.object(ingest_service, "get_embeddings_batch", embed), \
+         patch.object(ingest_service, "get_page_embeddings", return_value=known), \
+         patch.object(ingest_service, "store_chunks", side_effect=fake_store) as store, \
+         patch.object(ingest_service, "update_progress", new_callable=AsyncMock):
+        pages, stored, pages_reused = asyncio.run(run_pipeline(pdf))
+
+    assert stored == 3
+    assert pages_reused == 1
+    embedded = [text for call in embed.call_args_list for text in call.args[0]]
+    assert embedded == ["page 1", "page 3"]
+    chunks, embeddings = store.call_args.args[0], store.call_args.args[1]
+    assert embeddings[1] == [0.5] * 384
+    assert all(chunk["file_hash"] == "filehash" for chunk in chunks)
+
+
+def test_reupload_only_reembeds_changed_pages():
+    from services.chroma_service import clear, get_stored_pages
+    from services.ingest_service import process_upload
+    embed = AsyncMock(side_effect=lambda texts: [[0.1] * 384 for _ in texts])
+
+    clear(9999)
+    try:
+        with patch.object(ingest_service, "get_embeddings_batch", embed), \
+             patch.object(ingest_service, "update_progress", new_callable=AsyncMock), \
+             patch.object(ingest_service, "is_recorded", AsyncMock(return_value=False)), \
+             patch.object(ingest_service, "record_document", new_callable=AsyncMock) as record:
+            asyncio.run(process_upload(make_pdf(["one", "two", "three"]), "spec.pdf", 9999, "task"))
+            embed.reset_mock()
+            asyncio.run(process_upload(make_pdf(["one", "TWO"]), "spec.pdf", 9999, "task"))
+
+        embedded = [text for call in embed.call_args_list for text in call.args[0]]
+        assert embedded == ["TWO"]
+        stored = get_stored_pages(9999, "spec.pdf")
+        assert set(stored) == {1, 2}
+        assert stored[2] == page_hash("TWO")
+        #catalog gets the document's totals, not just what this run stored
+        user_id, filename, chunk_count, page_count = record.call_args.args[:4]
+        assert (user_id, filename, chunk_count, page_count) == (9999, "spec.pdf", 2, 2)
+    finally:
+        clear(9999)
+
+
+def test_retry_after_partial_ingest_completes_the_document():
+    from services.chroma_service import clear, count_document_chunks
+    from services.ingest_service import process_upload
+    embed = AsyncMock(side_effect=lambda texts: [[0.1] * 384 for _ in texts])
+    catalog = {}
+
+    async def record(user_id, filename, chunk_count, page_count, size, file_hash):
+        catalog[(user_id, filename)] = (chunk_count, file_hash)
+
+    async def is_recorded(user_id, filename, file_hash):
+        return catalog.get((user_id, filename), (0, None))[1] == file_hash
+
+    real_store = ingest_service.store_chunks
+    stores = []
+    def store_then_crash(chunks, embeddings, filename, user_id):
+        #the second batch lands in chroma, then the worker dies before finishing
+        stores.append(real_store(chunks, embeddings, filename, user_id))
+        if len(stores) == 2:
+            raise RuntimeError("worker died")
+        return stores[-1]
+
+    pdf = make_pdf(["one", "two", "three"])
+    clear(9999)
+    try:
+        with patch.object(ingest_service, "get_embeddings_batch", embed), \
+             patch.object(ingest_service, "update_progress", new_callable=AsyncMock), \
+             patch.object(ingest_service, "is_recorded", side_effect=is_recorded), \
+             patch.object(ingest_service, "record_document", side_effect=record), \
+             patch.object(ingest_service.settings, "ingest_batch_size", 1):
+            with patch.object(ingest_service, "store_chunks", side_effect=store_then_crash):
+                with pytest.raises(RuntimeError):
+                    asyncio.run(process_upload(pdf, "spec.pdf", 9999, "task"))
+            assert catalog == {}
+            assert count_document_chunks(9999, "spec.pdf") == (2, 2)
+
+            #the retry must not mistake the partial chunks for a finished upload
+            embed.reset_mock()
+            asyncio.run(process_upload(pdf, "spec.pdf", 9999, "task"))
+
+        assert count_document_chunks(9999, "spec.pdf") == (3, 3)
+        assert catalog[(9999, "spec.pdf")][0] == 3
+        #the chunks stored before the crash kept their embeddings
+        embedded = [text for call in embed.call_args_list for text in call.args[0]]
+        assert embedded == ["three"]
+    finally:
+        clear(9999)
+
+
+def test_copy_after_revision_uses_the_matching_bytes():
+    from services.chroma_service import clear, get_collection
+    from services.ingest_service import process_upload
+    embed = AsyncMock(side_effect=lambda texts: [[0.1] * 384 for _ in texts])
+    first = make_pdf(["one", "two"])
+    revised = make_pdf(["one", "TWO CHANGED"])
+
+    def page_texts(filename):
+        results = get_collection(9999).get(where={"$and":[{"user_id":9999},{"filename":filename}]})
+        pages = sorted(zip(results["metadatas"], results["documents"]), key=lambda item: item[0]["page_number"])
+        return [document for _, document in pages]
+
+    clear(9999)
+    try:
+        with patch.object(ingest_service, "get_embeddings_batch", embed), \
+             patch.object(ingest_service, "update_progress", new_callable=AsyncMock) as progress, \
+             patch.object(ingest_service, "is_recorded", AsyncMock(return_value=False)), \
+             patch.object(ingest_service, "record_document", new_callable=AsyncMock):
+            asyncio.run(process_upload(first, "a.pdf", 9999, "task"))
+            asyncio.run(process_upload(revised, "a.pdf", 9999, "task"))
+            #the first revision's bytes under a new name must not be served from a.pdf
+            asyncio.run(process_upload(first, "c.pdf", 9999, "task"))
+            #reverting a.pdf is an ordinary re-upload, not a resumed one
+            progress.reset_mock()
+            asyncio.run(process_upload(first, "a.pdf", 9999, "task"))
+
+        assert page_texts("c.pdf") == ["one", "two"]
+        assert page_texts("a.pdf") == ["one", "two"]
+        messages = [call.args[1] for call in progress.call_args_list]
+        assert not any("Resuming" in message for message in messages)
+    finally:
+        clear(9999)
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from core.database import Base
+import models.user # registers users for the foreign keys
+from models.document import IngestJob
+from services import job_service
+
+
+def test_stale_jobs_out_of_attempts_fail_instead_of_requeueing(tmp_path):
+    spooled = tmp_path / "exhausted.pdf"
+    spooled.write_bytes(b"%PDF")
+    long_ago = datetime.now(timezone.utc) - timedelta(hours=2)
+
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+        async with sessions() as db:
+            for job_id, attempts, path in (("retry", 1, "retry.pdf"), ("exhausted", 3, str(spooled))):
+                db.add(IngestJob(
+                    id=job_id, user_id=1, filename="a.pdf", file_path=path, status="running",
+                    progress="", attempts=attempts, max_attempts=3, updated_at=long_ago
+                ))
+            await db.commit()
+
+        with patch.object(job_service, "AsyncSessionLocal", sessions):
+            requeued = await job_service.requeue_stale_jobs()
+        async with sessions() as db:
+            return requeued, (await db.get(IngestJob, "retry")).status, (await db.get(IngestJob, "exhausted")).status
+
+    requeued, retry_status, exhausted_status = asyncio.run(run())
+    assert requeued == 1
+    assert retry_status == "queued"
+    assert exhausted_status == "failed"
+    assert not spooled.exists()
+
+
+class StopWorker(Exception):
+    pass
+
+
+def test_worker_loop_backs_off_on_database_errors():
+    down = OperationalError("select", {}, Exception("connection refused"))
+    job = MagicMock(id="j1", filename="a.pdf")
+    #claim fails twice, then the job's status write fails, then the loop is stopped
+    claim = AsyncMock(side_effect=[down, down, job, StopWorker()])
+    sleep = AsyncMock()
+
+    with patch.object(job_service, "claim_next_job", claim), \
+         patch.object(job_service, "run_job", AsyncMock(side_effect=down)) as run_job, \
+         patch.object(job_service.asyncio, "sleep", sleep), \
+         patch.object(job_service.settings, "job_poll_interval", 1.0):
+        with pytest.raises(StopWorker):
+            asyncio.run(job_service._worker_loop(0))
+
+    run_job.assert_awaited_once_with(job)
+    assert [c.args[0] for c in sleep.await_args_list] == [1.0, 2.0, 4.0]
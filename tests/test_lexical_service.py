@@ -0,0 +1,62 @@
+from unittest.mock import patch
+from services import lexical_service
+from services.lexical_service import LexicalIndex, build_match_query, reciprocal_rank_fusion, get_lexical_index
+
+
+def make_chunks(*texts):
+    return [{"text":text, "page_number":i + 1} for i, text in enumerate(texts)]
+
+
+def test_match_query_keeps_part_numbers():
+    match = build_match_query("What is the max pressure of PV-204 per clause 4.2.1?")
+    assert match == '"max" OR "pressure" OR "pv-204" OR "per" OR "clause" OR "4.2.1"'
+    assert build_match_query("what is the") == ""
+    #quotes in the question can't break out of the phrase
+    assert build_match_query('say "hi"') == '"say" OR "hi"'
+
+
+def test_search_ranks_exact_identifier(tmp_path):
+    index = LexicalIndex(tmp_path / "lexical.sqlite3")
+    index.add(1, "spec.pdf", ["a", "b", "c"], make_chunks(
+        "General valve maintenance and inspection schedule",
+        "Valve PV-204 is rated to 16 bar per clause 4.2.1",
+        "Clause 4.3 covers pipe supports",
+    ))
+    index.add(2, "other.pdf", ["d"], make_chunks("Valve PV-204 of another user"))
+
+    assert index.search("rating of PV-204?", 1, 5) == ["b"]
+    assert index.search("clause 4.2.1", 1, 5)[0] == "b"
+    assert index.search("PV-204", 2, 5) == ["d"]
+
+
+def test_delete_and_readd(tmp_path):
+    index = LexicalIndex(tmp_path / "lexical.sqlite3")
+    index.add(1, "spec.pdf", ["a", "b"], make_chunks("alpha torque", "beta torque"))
+    index.add(1, "spec.pdf", ["a"], make_chunks("alpha torque revised"))
+    assert sorted(index.search("torque", 1, 5)) == ["a", "b"]
+
+    index.delete(["a"])
+    assert index.search("torque", 1, 5) == ["b"]
+    index.delete_user(1)
+    assert index.is_empty()
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]], k=60)
+    #c is found by both retrievers
+    assert fused[0] == "c"
+    assert set(fused) == {"a", "b", "c", "d"}
+
+
+def test_each_shard_has_its_own_index_file(tmp_path):
+    with patch.object(lexical_service.settings, "chroma_path", str(tmp_path)):
+        get_lexical_index("documents_u1").add(1, "spec.pdf", ["a"], make_chunks("Valve PV-204"))
+        get_lexical_index("documents_u2").add(2, "spec.pdf", ["b"], make_chunks("Valve PV-204"))
+
+        assert get_lexical_index("documents_u1").search("PV-204", 1, 5) == ["a"]
+        assert sorted(path.name for path in (tmp_path / "lexical").glob("*.sqlite3")) == [
+            "documents_u1.sqlite3", "documents_u2.sqlite3"
+        ]
+        assert not lexical_service.lexical_index_built()
+        lexical_service.mark_lexical_index_built()
+        assert lexical_service.lexical_index_built()
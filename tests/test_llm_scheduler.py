@@ -0,0 +1,87 @@
+import asyncio
+import pytest
+from services.llm_scheduler import LLMScheduler, SchedulerBusy, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+
+def test_slots_bound_concurrency():
+    scheduler = LLMScheduler(slots=2, queue_timeout=5)
+    running = []
+    peak = []
+
+    async def job():
+        async with scheduler.slot():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+    async def scenario():
+        await asyncio.gather(*(job() for _ in range(6)))
+
+    asyncio.run(scenario())
+    assert max(peak) == 2
+    stats = scheduler.stats()
+    assert stats["granted"] == 6
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+
+def test_interactive_runs_before_background():
+    scheduler = LLMScheduler(slots=1, queue_timeout=5)
+    order = []
+
+    async def job(name, priority):
+        async with scheduler.slot(priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        first = asyncio.create_task(job("first", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        #queued in this order, but the question overtakes the background work
+        background = asyncio.create_task(job("facts", PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        question = asyncio.create_task(job("question", PRIORITY_INTERACTIVE))
+        await asyncio.gather(first, background, question)
+
+    asyncio.run(scenario())
+    assert order == ["first", "question", "facts"]
+
+
+def test_queue_deadline_sheds_with_retry_after():
+    scheduler = LLMScheduler(slots=1, queue_timeout=0.02)
+
+    async def hold():
+        async with scheduler.slot():
+            await asyncio.sleep(0.1)
+
+    async def late():
+        await asyncio.sleep(0)
+        async with scheduler.slot():
+            pass
+
+    async def scenario():
+        return await asyncio.gather(hold(), late(), return_exceptions=True)
+
+    _, error = asyncio.run(scenario())
+    assert isinstance(error, SchedulerBusy)
+    assert error.retry_after >= 1
+    assert scheduler.stats()["shed"] == 1
+    #the shed request left the queue, the slot is free again
+    assert scheduler.stats()["active"] == 0 and scheduler.stats()["queued"] == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    scheduler = LLMScheduler(slots=1, queue_timeout=5)
+
+    async def scenario():
+        async with scheduler.slot():
+            waiter = asyncio.create_task(scheduler.slot().__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+        async with scheduler.slot():
+            pass
+
+    asyncio.run(scenario())
+    assert scheduler.stats()["active"] == 0
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import httpx
+import pytest
+from services.ollama_client import OllamaClient, _timeout, ollama_urls
+
+
+def make_client(handler, retries=2):
+    return OllamaClient(["http://ollama"], 4, retries=retries, backoff_seconds=0, transport=httpx.MockTransport(handler))
+
+
+def test_chat_retries_transient_failures():
+    calls = []
+
+    def handler(request):
+        calls.append(1)
+        if len(calls) == 1:
+            raise httpx.ConnectError("refused")
+        if len(calls) == 2:
+            return httpx.Response(503, text="server busy")
+        return httpx.Response(200, json={"message":{"content":"ok"}, "done":True})
+
+    data = asyncio.run(make_client(handler).chat({"model":"m"}, call_type="chat"))
+    assert data["message"]["content"] == "ok"
+    assert len(calls) == 3
+
+
+def test_chat_gives_up_after_retries():
+    def handler(request):
+        return httpx.Response(503)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(make_client(handler, retries=1).chat({"model":"m"}, call_type="chat"))
+
+
+def test_client_errors_are_not_retried():
+    calls = []
+
+    def handler(request):
+        calls.append(1)
+        return httpx.Response(404, json={"error":"model not found"})
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(make_client(handler).chat({"model":"m"}, call_type="chat"))
+    assert len(calls) == 1
+
+
+def test_stream_retries_before_the_first_line_only():
+    calls = []
+
+    def handler(request):
+        calls.append(1)
+        if len(calls) == 1:
+            return httpx.Response(503)
+        lines = [{"message":{"content":"a"}, "done":False}, {"message":{"content":""}, "done":True}]
+        return httpx.Response(200, text="\n".join(json.dumps(line) for line in lines))
+
+    async def collect():
+        return [data async for data in make_client(handler).chat_stream({"model":"m"}, call_type="chat")]
+
+    assert [data["done"] for data in asyncio.run(collect())] == [False, True]
+    assert len(calls) == 2
+
+
+def test_timeouts_per_call_type():
+    assert _timeout("chat").read > _timeout("facts").read
+    assert _timeout("facts").connect == _timeout("chat").connect
+
+
+def make_pool(handler, urls, retries=2, hedge_percentile=0.0):
+    return OllamaClient(urls, 4, retries=retries, backoff_seconds=0, hedge_percentile=hedge_percentile, transport=httpx.MockTransport(handler))
+
+
+def test_routes_to_the_backend_with_fewest_outstanding():
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        return httpx.Response(200, json={"message":{"content":"ok"}, "done":True})
+
+    client = make_pool(handler, ["http://a", "http://b"])
+    client.backends[0].outstanding = 3
+    asyncio.run(client.chat({"model":"m"}, call_type="chat"))
+    assert hosts == ["b"]
+
+
+def test_fails_over_to_another_backend():
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        if request.url.host == "a":
+            raise httpx.ConnectError("refused")
+        return httpx.Response(200, json={"message":{"content":"ok"}, "done":True})
+
+    client = make_pool(handler, ["http://a", "http://b"])
+    client.backends[1].outstanding = 1 # so the first pick is a
+    asyncio.run(client.chat({"model":"m"}, call_type="chat"))
+    assert hosts == ["a", "b"]
+    assert client.failovers == 1
+    assert not client.backends[0].healthy
+    assert client.backends[0].outstanding == 0
+
+    #a stays out of rotation until a probe passes
+    hosts.clear()
+    client.backends[1].outstanding = 5
+    asyncio.run(client.chat({"model":"m"}, call_type="chat"))
+    assert hosts == ["b"]
+
+
+def test_probe_marks_health_and_loaded_model():
+    def handler(request):
+        if request.url.host == "down":
+            raise httpx.ConnectError("refused")
+        models = [{"name":"qwen3:8b"}] if request.url.host == "warm" else []
+        return httpx.Response(200, json={"models":models})
+
+    client = make_pool(handler, ["http://warm", "http://cold", "http://down"])
+    asyncio.run(client.probe("qwen3:8b"))
+    warm, cold, down = client.backends
+    assert (warm.healthy, warm.model_loaded) == (True, True)
+    assert (cold.healthy, cold.model_loaded) == (True, False)
+    assert not down.healthy
+
+    #a backend that would have to load the model first is picked last
+    cold.outstanding = 0
+    warm.outstanding = 2
+    assert client._pick() is warm
+
+
+def test_slow_request_is_hedged_to_another_backend():
+    async def run():
+        release = asyncio.Event()
+
+        async def handler(request):
+            if request.url.host == "slow":
+                await release.wait()
+            return httpx.Response(200, json={"message":{"content":request.url.host}, "done":True})
+
+        client = make_pool(handler, ["http://slow", "http://fast"], hedge_percentile=95)
+        client._latencies["chat"] = [0.01] * 20
+        client.backends[1].outstanding = 1 # first pick is the slow one
+        data = await client.chat({"model":"m"}, call_type="chat")
+        release.set()
+        return client, data
+
+    client, data = asyncio.run(run())
+    assert data["message"]["content"] == "fast"
+    assert (client.hedged, client.hedge_wins) == (1, 1)
+    assert client.backends[0].outstanding == 0
+
+
+def test_ollama_urls_prefers_the_pool(monkeypatch):
+    from core.config import settings
+    monkeypatch.setattr(settings, "ollama_base_urls", "http://a:11434, http://b:11434")
+    assert ollama_urls() == ["http://a:11434", "http://b:11434"]
+    monkeypatch.setattr(settings, "ollama_base_urls", "")
+    assert ollama_urls() == [settings.ollama_base_url]
+
+
+def test_generation_timings_are_recorded():
+    def handler(request):
+        return httpx.Response(200, json={
+            "message":{"content":"ok"}, "done":True,
+            "load_duration":2_000_000_000, "prompt_eval_count":100, "prompt_eval_duration":500_000_000,
+            "eval_count":10, "eval_duration":250_000_000
+        })
+
+    client = make_client(handler)
+    asyncio.run(client.chat({"model":"m", "messages":[{"role":"user", "content":"x" * 1600}]}, call_type="chat"))
+    generation = client.stats()["generation"]
+    assert generation["model_loads"] == 1
+    assert generation["load_ms"] == 2000
+    assert generation["prompt_tokens_evaluated"] == 100
+    #400 tokens sent, 100 evaluated: the rest came from ollama's prompt cache
+    assert generation["prompt_reuse"] == 0.75
+
+
+def test_preload_only_loads_cold_backends():
+    loaded = []
+
+    def handler(request):
+        loaded.append((request.url.host, json.loads(request.content)))
+        return httpx.Response(200, json={"done":True})
+
+    client = make_pool(handler, ["http://warm", "http://cold"])
+    client.backends[0].model_loaded = True
+    client.backends[1].model_loaded = False
+    asyncio.run(client.preload("qwen3:8b"))
+    assert [host for host, _ in loaded] == ["cold"]
+    assert loaded[0][1]["keep_alive"] == "30m"
+    assert client.backends[1].model_loaded
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import httpx
+from unittest.mock import patch
+from services import ollama_service
+from services.ollama_client import OllamaClient
+
+
+def chat_lines(*tokens):
+    lines = [json.dumps({"message":{"role":"assistant", "content":token}, "done":False}) for token in tokens]
+    lines.append(json.dumps({"message":{"role":"assistant", "content":""}, "done":True, "eval_count":len(tokens)}))
+    return "\n".join(lines) + "\n"
+
+
+def stub_client(handler):
+    return OllamaClient(["http://ollama"], 4, retries=0, backoff_seconds=0, transport=httpx.MockTransport(handler))
+
+
+def test_ask_stream_yields_tokens_as_they_arrive():
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, text=chat_lines("Page ", "4 says ", "16 bar."))
+
+    chunks = [{"text":"16 bar", "page_number":4, "filename":"spec.pdf"}]
+
+    async def collect():
+        return [token async for token in ollama_service.ask_stream("max pressure?", chunks)]
+
+    with patch.object(ollama_service, "get_ollama_client", return_value=stub_client(handler)):
+        tokens = asyncio.run(collect())
+
+    assert tokens == ["Page ", "4 says ", "16 bar."]
+    assert requests[0]["stream"] is True
+    assert requests[0]["messages"][-1]["content"].endswith("Question: max pressure?")
+    assert "Page: 4" in requests[0]["messages"][-1]["content"]
+    #every call keeps the model resident with the same context window
+    assert requests[0]["keep_alive"] == "30m"
+    assert requests[0]["options"]["num_ctx"] == 8192
+
+
+def test_ask_and_extract_facts_parse_the_reply():
+    def handler(request):
+        payload = json.loads(request.content)
+        content = '["works as a welder"]' if payload["options"].get("num_predict") == 256 else "16 bar."
+        return httpx.Response(200, json={"message":{"role":"assistant", "content":content}, "done":True})
+
+    with patch.object(ollama_service, "get_ollama_client", return_value=stub_client(handler)):
+        assert asyncio.run(ollama_service.ask("max pressure?", [])) == "16 bar."
+        assert asyncio.run(ollama_service.extract_facts("I'm a welder", "ok")) == ["works as a welder"]
+
+
+def test_stable_layout_keeps_the_prompt_prefix_across_turns():
+    history = [{"role":"user", "content":"first?"}, {"role":"assistant", "content":"first answer"}]
+    memory = "\n\nPersonal facts about the user: \n- works as a welder"
+    turn_one = ollama_service.build_messages("max pressure?", [{"text":"16 bar", "page_number":4, "filename":"spec.pdf"}], history, memory)
+    history += [{"role":"user", "content":"max pressure?"}, {"role":"assistant", "content":"16 bar"}]
+    turn_two = ollama_service.build_messages("max torque?", [{"text":"40 Nm", "page_number":7, "filename":"spec.pdf"}], history, memory)
+
+    #only the final message (documents + question) differs, everything before it is reused
+    assert turn_two[:len(turn_one) - 1] == turn_one[:-1]
+    assert "40 Nm" in turn_two[-1]["content"] and "40 Nm" not in turn_two[0]["content"]
+
+
+def test_legacy_layout_puts_context_in_the_system_prompt(monkeypatch):
+    monkeypatch.setattr(ollama_service.settings, "prompt_layout", "legacy")
+    messages = ollama_service.build_messages("max pressure?", [{"text":"16 bar", "page_number":4, "filename":"spec.pdf"}])
+    assert "16 bar" in messages[0]["content"]
+    assert messages[-1] == {"role":"user", "content":"max pressure?"}
+
+
+def test_summary_message_keeps_the_system_prompt_stable():
+    memory = "\n\nPersonal facts about the user: \n- works as a welder"
+    chunks = [{"text":"16 bar", "page_number":4, "filename":"spec.pdf"}]
+    turn_one = ollama_service.build_messages("q1?", chunks, [{"role":"system", "content":"Summary: asked about valves"}], memory)
+    turn_two = ollama_service.build_messages("q2?", chunks, [{"role":"system", "content":"Summary: asked about valves and bolts"}], memory)
+
+    #the rolling summary changes each turn, the first message doesn't
+    assert turn_one[0] == turn_two[0]
+    assert "valves" not in turn_one[0]["content"]
+    assert turn_one[1]["content"] == "Summary: asked about valves"
@@ -1,5 +1,38 @@
+import asyncio
 import pytest
-from services.pdf_service import chunk_text, extract_content_by_page
+from services.pdf_service import (
+    chunk_text,
+    extract_content_by_page,
+    extract_content_parallel,
+    describe_table_stats
+)
+
+
+def make_pdf(texts: list[str], drawings: dict[int, str] | None = None) -> bytes:
+    #minimal multi-page pdf with one line of helvetica text per page
+    #drawings maps a page index to extra content stream operators (e.g. ruling lines)
+    drawings = drawings or {}
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for i, text in enumerate(texts):
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET {drawings.get(i, '')}".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R /Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
 
 
 def test_chunk_text_basic():
@@ -49,4 +82,34 @@ def test_chunk_text_multiple_pages():
 
 def test_extract_content_invalid_pdf():
     with pytest.raises(Exception):
-        extract_content_by_page(b"not a pdf")
\ No newline at end of file
+        extract_content_by_page(b"not a pdf")
+
+
+def test_extract_content_by_page():
+    pages = extract_content_by_page(make_pdf(["first page", "second page"]))
+    assert [p["page_number"] for p in pages] == [1, 2]
+    assert pages[0]["text"] == "first page"
+
+
+def test_extract_content_parallel_matches_sequential():
+    pdf = make_pdf([f"page number {i}" for i in range(1, 31)])
+    parallel = asyncio.run(extract_content_parallel(pdf, workers=3))
+    assert parallel == extract_content_by_page(pdf)
+    assert [p["page_number"] for p in parallel] == list(range(1, 31))
+
+
+def test_table_pass_skipped_on_prose_pages():
+    grid = "72 600 m 300 600 l S 72 500 m 300 500 l S 72 500 m 72 600 l S 300 500 m 300 600 l S"
+    stats = {}
+    extract_content_by_page(make_pdf(["prose", "table", "more prose"], {1: grid}), stats=stats)
+    assert stats["pages"] == 3
+    assert stats["table_pass_skipped"] == 2
+    assert "2/3 pages" in describe_table_stats(stats)
+
+
+def test_extract_content_from_path(tmp_path):
+    pdf = make_pdf([f"page number {i}" for i in range(1, 31)])
+    path = tmp_path / "test.pdf"
+    path.write_bytes(pdf)
+    assert extract_content_by_page(str(path)) == extract_content_by_page(pdf)
+    assert asyncio.run(extract_content_parallel(str(path), workers=3)) == extract_content_by_page(pdf)
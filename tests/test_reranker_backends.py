@@ -0,0 +1,44 @@
+import subprocess
+import sys
+from unittest.mock import patch, MagicMock
+import pytest
+from services import reranker_backends
+from services.reranker_backends import load_reranker, OnnxCrossEncoder
+
+
+def test_load_reranker_picks_backend():
+    with patch("services.reranker_backends.settings.reranker_backend", "onnx"), \
+         patch("services.reranker_backends.OnnxCrossEncoder") as onnx:
+        assert load_reranker() is onnx.return_value
+    with patch("services.reranker_backends.settings.reranker_backend", "torch"), \
+         patch("services.reranker_backends.TorchCrossEncoder") as torch_backend:
+        assert load_reranker() is torch_backend.return_value
+    with patch("services.reranker_backends.settings.reranker_backend", "other"):
+        with pytest.raises(ValueError):
+            load_reranker()
+
+
+def test_onnx_predict_scores_pairs():
+    model = MagicMock()
+    model.rerank_pairs = MagicMock(return_value=iter([0.5, -1.0]))
+    with patch("fastembed.rerank.cross_encoder.TextCrossEncoder", return_value=model) as cross_encoder:
+        backend = OnnxCrossEncoder("BAAI/bge-reranker-base")
+
+    assert cross_encoder.call_args.kwargs["specific_model_path"] is None
+    assert backend.predict([("q", "a"), ("q", "b")], batch_size=8) == [0.5, -1.0]
+    model.rerank_pairs.assert_called_once_with([("q", "a"), ("q", "b")], batch_size=8)
+
+
+def test_reuses_existing_quantized_model(tmp_path):
+    target = tmp_path / "BAAI--bge-reranker-base-int8" / "onnx"
+    target.mkdir(parents=True)
+    (target / "model.onnx").write_bytes(b"")
+    with patch("services.reranker_backends.settings.reranker_cache_dir", str(tmp_path)):
+        path = reranker_backends._quantized_model("BAAI/bge-reranker-base")
+    assert path == str(tmp_path / "BAAI--bge-reranker-base-int8")
+
+
+def test_torch_not_imported_by_default():
+    code = "import sys, services.reranker_service; print('torch' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
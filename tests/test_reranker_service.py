@@ -0,0 +1,60 @@
+import asyncio
+from unittest.mock import patch, MagicMock
+from services import reranker_service
+from services.reranker_service import rerank, rerank_async
+
+
+def make_chunks(*texts):
+    return [{"text":text, "page_number":1, "filename":"test.pdf"} for text in texts]
+
+
+def fake_reranker():
+    #scores a pair by the length of the chunk text
+    model = MagicMock()
+    model.predict = MagicMock(side_effect=lambda pairs, batch_size=None: [float(len(text)) for _, text in pairs])
+    return model
+
+
+def test_rerank_orders_by_score():
+    with patch("services.reranker_service.get_reranker", return_value=fake_reranker()):
+        result = rerank("q", make_chunks("aa", "aaaa", "a"), top_k=2)
+    assert [chunk["text"] for chunk in result] == ["aaaa", "aa"]
+
+
+def test_rerank_batches_pairs_sorted_by_length():
+    model = fake_reranker()
+    requests = [("q", make_chunks("aaaa", "a"), 1), ("qq", make_chunks("aaa", "aa"), 2)]
+    with patch("services.reranker_service.get_reranker", return_value=model):
+        results = reranker_service._rerank_many(requests)
+
+    #one forward pass over every request's pairs, shortest first
+    model.predict.assert_called_once()
+    pairs = model.predict.call_args.args[0]
+    lengths = [len(question) + len(text) for question, text in pairs]
+    assert lengths == sorted(lengths) and len(pairs) == 4
+
+    assert [chunk["text"] for chunk in results[0]] == ["aaaa"]
+    assert [chunk["text"] for chunk in results[1]] == ["aaa", "aa"]
+
+
+def test_rerank_async_coalesces_concurrent_requests():
+    model = fake_reranker()
+
+    async def run():
+        reranker_service._rerank_batchers.clear()
+        return await asyncio.gather(
+            rerank_async("q1", make_chunks("a", "aaa"), top_k=1),
+            rerank_async("q2", make_chunks("bb", "b"), top_k=1),
+        )
+
+    with patch("services.reranker_service.get_reranker", return_value=model):
+        first, second = asyncio.run(run())
+
+    assert first[0]["text"] == "aaa"
+    assert second[0]["text"] == "bb"
+    assert model.predict.call_count == 1
+    assert reranker_service.rerank_batcher_stats()["items"] == 2
+
+
+def test_rerank_async_empty_chunks():
+    assert asyncio.run(rerank_async("q", [])) == []
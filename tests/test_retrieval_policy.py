@@ -0,0 +1,80 @@
+import asyncio
+from unittest.mock import patch, AsyncMock
+from services import retrieval_policy
+from services.retrieval_policy import candidate_depth, trim_candidates, plan_rerank, retrieve
+
+
+def make_chunks(*distances):
+    return [{"text":f"chunk {i}", "page_number":1, "filename":"test.pdf", "distance":d} for i, d in enumerate(distances)]
+
+
+def test_candidate_depth_follows_corpus_size():
+    assert candidate_depth(0, 4) == 0
+    assert candidate_depth(3, 4) == 3
+    assert candidate_depth(30, 4) == 9
+    assert candidate_depth(100000, 4) == 20
+
+
+def test_trim_drops_far_tail_but_keeps_top_k():
+    chunks = make_chunks(0.2, 0.3, 0.9, 1.0, 1.1, 1.2)
+    assert len(trim_candidates(chunks, 4)) == 4
+    assert len(trim_candidates(chunks, 2)) == 2
+    assert trim_candidates(chunks[:2], 4) == chunks[:2]
+
+
+def test_plan_skips_on_clear_gap():
+    assert plan_rerank(make_chunks(0.2, 0.21, 0.5, 0.52), 2)[0] == "skip"
+    assert plan_rerank(make_chunks(0.2, 0.21), 2) == ("skip", None)
+    assert plan_rerank(make_chunks(0.2, 0.21, 0.22, 0.23), 2)[0] == "full"
+
+
+def test_keyword_hits_survive_trim_and_block_skip():
+    chunks = make_chunks(0.2, 0.9, 0.21, 0.22)
+    chunks[1]["lexical"] = True
+    assert len(trim_candidates(chunks, 1)) == 4
+    #fused order put a keyword hit ahead of a nearer chunk, let the reranker decide
+    assert plan_rerank(chunks, 2)[0] == "full"
+
+
+def test_plan_cascades_when_first_stage_configured():
+    chunks = make_chunks(*(0.2 + i * 0.01 for i in range(12)))
+    with patch("services.retrieval_policy.settings.reranker_first_stage_model", "Xenova/ms-marco-MiniLM-L-6-v2"):
+        assert plan_rerank(chunks, 4)[0] == "cascade"
+        #already within what the first stage would keep
+        assert plan_rerank(chunks[:8], 4)[0] == "full"
+
+
+def test_retrieve_skips_reranker_when_decisive():
+    chunks = make_chunks(0.1, 0.12, 0.8, 0.85)
+    rerank = AsyncMock()
+    with patch("services.retrieval_policy.query", return_value=chunks) as query, \
+         patch("services.retrieval_policy.rerank_async", rerank):
+        result = asyncio.run(retrieve("q", [0.1], 1, 4, top_k=2))
+
+    assert query.call_args.kwargs["n_results"] == 4
+    assert result == chunks[:2]
+    rerank.assert_not_called()
+    assert retrieval_policy.retrieval_policy_stats()["skip"] >= 1
+
+
+def test_retrieve_cascades_through_both_stages():
+    chunks = make_chunks(*(0.2 + i * 0.01 for i in range(12)))
+    calls = []
+
+    async def fake_rerank(question, candidates, top_k=4, stage="final"):
+        calls.append((stage, len(candidates)))
+        return candidates[:top_k]
+
+    with patch("services.retrieval_policy.settings.reranker_first_stage_model", "minilm"), \
+         patch("services.retrieval_policy.query", return_value=chunks), \
+         patch("services.retrieval_policy.rerank_async", fake_rerank):
+        result = asyncio.run(retrieve("q", [0.1], 1, 1000, top_k=4))
+
+    assert calls == [("first", 12), ("final", 8)]
+    assert len(result) == 4
+
+
+def test_retrieve_empty_corpus():
+    with patch("services.retrieval_policy.query") as query:
+        assert asyncio.run(retrieve("q", [0.1], 1, 0, top_k=4)) == []
+    query.assert_not_called()
@@ -1,3 +1,4 @@
+import json
 import pytest
 from fastapi.testclient import TestClient
 from main import app
@@ -79,6 +80,57 @@ def test_upload_wrong_file_type():
     assert response.status_code == 400
 
 
+def test_upload_enqueues_job(tmp_path):
+    headers = get_auth_headers()
+    job = MagicMock(id="job-1")
+    with patch("routes.routes.enqueue_job", AsyncMock(return_value=job)) as enqueue, \
+         patch("services.job_service.settings.upload_dir", str(tmp_path)):
+        response = client.post(
+            "/upload",
+            files={"file":("test.pdf",b"%PDF-1.4","application/pdf")},
+            headers=headers
+            )
+    assert response.status_code == 200
+    assert response.json()["task_id"] == "job-1"
+    user_id, filename, file_path = enqueue.call_args.args[1:]
+    assert (user_id, filename) == (TEST_USER_ID, "test.pdf")
+    assert file_path.read_bytes() == b"%PDF-1.4"
+
+
+def test_upload_too_large(tmp_path):
+    headers = get_auth_headers()
+    with patch("services.job_service.settings.upload_dir", str(tmp_path)), \
+         patch("services.job_service.settings.max_upload_mb", 0):
+        response = client.post(
+            "/upload",
+            files={"file":("test.pdf",b"%PDF-1.4","application/pdf")},
+            headers=headers
+            )
+    assert response.status_code == 413
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_upload_empty_file(tmp_path):
+    headers = get_auth_headers()
+    with patch("services.job_service.settings.upload_dir", str(tmp_path)):
+        response = client.post(
+            "/upload",
+            files={"file":("test.pdf",b"","application/pdf")},
+            headers=headers
+            )
+    assert response.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_upload_progress_unknown_task(mock_db):
+    headers = get_auth_headers()
+    mock_db.execute = AsyncMock(
+        return_value=MagicMock(scalar_one_or_none=MagicMock(return_value=None))
+    )
+    response = client.get("/upload-progress/missing", headers=headers)
+    assert response.status_code == 404
+
+
 def test_ask_no_document():
     headers = get_auth_headers()
     response = client.post(
@@ -116,3 +168,93 @@ def test_protected_routes_require_auth():
     response = client.delete("/clear")
     assert response.status_code == 401
 
+
+
+def parse_events(body: str) -> list[tuple[str, str]]:
+    events = []
+    for block in body.replace("\r\n", "\n").strip().split("\n\n"):
+        fields = {}
+        for line in block.split("\n"):
+            name, _, value = line.partition(": ")
+            fields[name] = fields[name] + "\n" + value if name in fields else value
+        events.append((fields.get("event"), fields.get("data", "")))
+    return events
+
+
+def test_ask_stream_sends_sources_then_tokens_and_saves_conversation():
+    from services.answer_cache import AnswerCache
+    headers = get_auth_headers()
+    chunks = [{"text":"Valve PV-204 is rated to 16 bar", "page_number":2, "filename":"spec.pdf"}]
+
+    async def fake_stream(question, context_chunks, history, memory_context):
+        for token in ("Rated ", "to 16 bar."):
+            yield token
+
+    #the conversation is written through its own session after the stream
+    saved = MagicMock()
+    session = saved.return_value.__aenter__.return_value
+    session.add = MagicMock()
+    session.commit = AsyncMock()
+
+    with patch("routes.routes.catalog_service.corpus_state", AsyncMock(return_value=(1, "v1"))), \
+         patch("routes.routes.get_embedding", AsyncMock(return_value=[0.1] * 384)), \
+         patch("routes.routes.retrieve", AsyncMock(return_value=chunks)), \
+         patch("routes.routes.ask_stream", fake_stream), \
+         patch("routes.routes.get_answer_cache", return_value=AnswerCache(10, 60, 0)), \
+         patch("routes.routes.AsyncSessionLocal", saved), \
+         patch("routes.routes.schedule_summary_update") as summarize:
+        response = client.post("/ask/stream", json={"question":"PV-204 rating?"}, headers=headers)
+
+    assert response.status_code == 200
+    events = parse_events(response.text)
+    assert [name for name, _ in events] == ["sources", "token", "token", "done"]
+    assert json.loads(events[0][1])[0]["page"] == 2
+    assert "".join(data for name, data in events if name == "token") == "Rated to 16 bar."
+    conversation = session.add.call_args.args[0]
+    assert conversation.answer == "Rated to 16 bar."
+    session.commit.assert_awaited_once()
+    #the new turn is folded into the conversation summary in the background
+    summarize.assert_called_once_with(conversation.user_id)
+
+
+def test_ask_stream_no_document():
+    headers = get_auth_headers()
+    response = client.post("/ask/stream", json={"question": "what is this?"}, headers=headers)
+    assert response.status_code == 404
+
+
+def test_ask_returns_503_with_retry_after_when_llm_is_busy():
+    from services.answer_cache import AnswerCache
+    from services.llm_scheduler import SchedulerBusy
+    headers = get_auth_headers()
+    with patch("routes.routes.catalog_service.corpus_state", AsyncMock(return_value=(1, "v1"))), \
+         patch("routes.routes.get_embedding", AsyncMock(return_value=[0.1] * 384)), \
+         patch("routes.routes.retrieve", AsyncMock(return_value=[])), \
+         patch("routes.routes.ask", AsyncMock(side_effect=SchedulerBusy(7))), \
+         patch("routes.routes.get_answer_cache", return_value=AnswerCache(10, 60, 0)):
+        response = client.post("/ask", json={"question":"PV-204 rating?"}, headers=headers)
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "7"
+
+
+def test_repeated_question_hits_the_cache_after_the_conversation_grew():
+    from services.answer_cache import AnswerCache
+    headers = get_auth_headers()
+    chunks = [{"text":"Valve PV-204 is rated to 16 bar", "page_number":2, "filename":"spec.pdf"}]
+    #the first answer adds a turn, so the second request sees a longer history
+    histories = [[], [{"role":"user", "content":"PV-204 rating?"}, {"role":"assistant", "content":"16 bar."}]]
+    generate = AsyncMock(return_value="16 bar.")
+
+    with patch("routes.routes.catalog_service.corpus_state", AsyncMock(return_value=(1, "v1"))), \
+         patch("routes.routes.load_history", AsyncMock(side_effect=histories)), \
+         patch("routes.routes.get_embedding", AsyncMock(return_value=[0.1] * 384)), \
+         patch("routes.routes.retrieve", AsyncMock(return_value=chunks)), \
+         patch("routes.routes.ask", generate), \
+         patch("routes.routes.get_answer_cache", return_value=AnswerCache(10, 60, 0)), \
+         patch("routes.routes.schedule_summary_update"):
+        first = client.post("/ask", json={"question":"PV-204 rating?"}, headers=headers)
+        second = client.post("/ask", json={"question":"PV-204 rating?"}, headers=headers)
+
+    assert first.json() == second.json()
+    assert generate.await_count == 1
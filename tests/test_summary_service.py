@@ -0,0 +1,74 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from core.database import Base
+from models.user import Conversation, ConversationSummary
+from services import summary_service
+
+
+async def make_sessions(turns):
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as db:
+        for i in range(turns):
+            db.add(Conversation(user_id=1, question=f"question {i}", answer=f"answer {i}"))
+        await db.commit()
+    return sessions
+
+
+def test_older_turns_are_folded_and_the_latest_stay_raw():
+    async def run():
+        sessions = await make_sessions(5)
+        summarize = AsyncMock(return_value="user asked about questions 0-2")
+        with patch.object(summary_service, "AsyncSessionLocal", sessions), \
+             patch.object(summary_service, "summarize_conversation", summarize):
+            assert await summary_service.update_summary(1)
+            #nothing new to fold until another turn is added
+            assert not await summary_service.update_summary(1)
+        async with sessions() as db:
+            history = await summary_service.load_history(db, 1)
+        return summarize, history
+
+    summarize, history = asyncio.run(run())
+    current, turns = summarize.await_args.args
+    assert current == ""
+    assert turns == [(f"question {i}", f"answer {i}") for i in range(3)]
+    #the summary is its own message ahead of the raw turns, not part of the system prompt
+    assert history[0] == {"role":"system", "content":"Summary of the earlier conversation:\nuser asked about questions 0-2"}
+    #with the default SUMMARY_RAW_TURNS=2 only the last two turns are replayed
+    assert [message["content"] for message in history[1:]] == ["question 3", "answer 3", "question 4", "answer 4"]
+
+
+def test_summary_builds_on_the_previous_one():
+    async def run():
+        sessions = await make_sessions(4)
+        async with sessions() as db:
+            db.add(ConversationSummary(user_id=1, summary="earlier summary", last_conversation_id=1))
+            await db.commit()
+        summarize = AsyncMock(return_value="newer summary")
+        with patch.object(summary_service, "AsyncSessionLocal", sessions), \
+             patch.object(summary_service, "summarize_conversation", summarize):
+            await summary_service.update_summary(1)
+        async with sessions() as db:
+            return summarize, await db.get(ConversationSummary, 1)
+
+    summarize, stored = asyncio.run(run())
+    assert summarize.await_args.args == ("earlier summary", [("question 1", "answer 1")])
+    assert (stored.summary, stored.last_conversation_id) == ("newer summary", 2)
+
+
+def test_failed_summary_leaves_turns_raw():
+    async def run():
+        sessions = await make_sessions(4)
+        summarize = AsyncMock(return_value="")
+        with patch.object(summary_service, "AsyncSessionLocal", sessions), \
+             patch.object(summary_service, "summarize_conversation", summarize):
+            assert not await summary_service.update_summary(1)
+        async with sessions() as db:
+            return await summary_service.load_history(db, 1)
+
+    history = asyncio.run(run())
+    #only the latest SUMMARY_RAW_TURNS are replayed even while the summary lags behind
+    assert [message["content"] for message in history] == ["question 2", "answer 2", "question 3", "answer 3"]
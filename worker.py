@@ -0,0 +1,9 @@
+import asyncio
+import logging
+from services.job_service import run_worker
+
+#ingest worker: python worker.py (run as many as needed next to the api)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_worker())